@@ -18,6 +18,7 @@ from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 db = SQLAlchemy()
 login_manager = LoginManager()
@@ -33,6 +34,17 @@ def internal_server_error(e):
     return render_template('errors/500.html'), 500
 
 
+def is_reflected(table_name, metadata):
+    """
+    Passed to MetaData.reflect, so that the full-text search index (see app/search.py), and the FTS5 shadow tables
+    behind it, are not reflected as ordinary tables. RecipeNutrition and RecipeSummary are not reflected either, as their
+    models declare their indexes, which would otherwise be added to the reflected ones a second time.
+
+    :return: whether the table should be reflected
+    """
+    return not table_name.startswith('RecipeSearch') and table_name not in ('RecipeNutrition', 'RecipeSummary')
+
+
 def create_app(config_class=DevConfig):
     """
     Creates an application instance to run
@@ -57,12 +69,33 @@ def create_app(config_class=DevConfig):
 
     mail.init_app(app)
 
+    # Behind a proxy, read the client's address and scheme from the headers the proxy adds
+    if app.config['PROXY_FIX_X_FOR'] or app.config['PROXY_FIX_X_PROTO']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'],
+                                x_proto=app.config['PROXY_FIX_X_PROTO'])
+
     with app.app_context():
-        db.Model.metadata.reflect(db.engine)
+        db.Model.metadata.reflect(db.engine, only=is_reflected)
 
     app.register_error_handler(404, page_not_found)
     app.register_error_handler(500, internal_server_error)
 
+    # Compress dynamic responses, and serve static files from their precompressed copies
+    from app.compression import compress_response, send_static_file
+    app.after_request(compress_response)
+    app.view_functions['static'] = send_static_file
+
+    # Build the in-memory search filter, typo-tolerance, pantry and suggestion indexes of each worker process when it
+    # starts serving
+    from app.filter_index import filter_index
+    from app.fuzzy import fuzzy_index
+    from app.pantry import pantry_index
+    from app.suggest import suggest_index
+    app.before_first_request(filter_index)
+    app.before_first_request(fuzzy_index)
+    app.before_first_request(pantry_index)
+    app.before_first_request(suggest_index)
+
     # Register Blueprints
     from app.main.routes import bp_main
     app.register_blueprint(bp_main)
@@ -73,4 +106,14 @@ def create_app(config_class=DevConfig):
     from app.api.routes import bp_api
     app.register_blueprint(bp_api)
 
+    # Register CLI commands
+    from app.catalog import catalog_cli
+    app.cli.add_command(catalog_cli)
+
+    from app.compression import static_cli
+    app.cli.add_command(static_cli)
+
+    from app.api.api_keys import api_keys_cli
+    app.cli.add_command(api_keys_cli)
+
     return app
@@ -0,0 +1,683 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/api/api_functions.py:
+
+This document includes functions that assists the API routes, including:
+- wants_ndjson
+- recipe_catalog_query and serialize_recipes
+- parse_sparse_fieldsets, sparse_recipe_query and serialize_sparse
+- recipe_source
+- generate_chunks and generate_ndjson
+- recipe_etag, recipes_etag and results_etag
+- encode_cursor and decode_cursor
+- parse_limit
+- paginate_recipes and next_cursor
+- parse_batch_ids and batch_etag
+- snapshot_etag
+- results_page, search_results_page and serialize_search_results
+- pantry_results_page and serialize_pantry_results
+- similar_etag, similar_results and serialize_similar_results
+- search_facets
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.api.encoders import JSON, NDJSON_MIMETYPE, negotiate_format
+from app.catalog import current_catalog, make_etag
+from app.filter_index import filter_index
+from app.main.main_functions import search_args, search_result_ids, nutrient_ranges
+from app.search import fts_query
+from app.models import Recipes, RecipeIngredients, RecipeInstructions, RecipeAllergies, RecipeDietTypes, \
+    NutritionValues, CatalogRecipes, RecipeSimilarities
+from app.pantry import parse_pantry, pantry_index
+import config
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import defaultdict, namedtuple
+from flask import abort, json, request
+from itertools import islice
+import re
+from sqlalchemy.orm import joinedload, lazyload, selectinload
+
+# Columns which can be requested with ?fields=, keyed by their name in the API response. Nutrition values are nested
+# under 'nutrition_values', as they are in Recipes.serialize.
+RECIPE_FIELDS = {'recipe_id': Recipes.recipe_id,
+                 'recipe_name': Recipes.recipe_name,
+                 'photo': Recipes.photo,
+                 'serves': Recipes.serves,
+                 'cook_time': Recipes.cook_time,
+                 'prep_time': Recipes.prep_time,
+                 'total_time': Recipes.total_time,
+                 'nutrition_values.calories': NutritionValues.calories,
+                 'nutrition_values.fats': NutritionValues.fats,
+                 'nutrition_values.saturates': NutritionValues.saturates,
+                 'nutrition_values.carbs': NutritionValues.carbs,
+                 'nutrition_values.sugars': NutritionValues.sugars,
+                 'nutrition_values.fibres': NutritionValues.fibres,
+                 'nutrition_values.proteins': NutritionValues.proteins,
+                 'nutrition_values.salts': NutritionValues.salts}
+DEFAULT_SPARSE_FIELDS = ['recipe_id', 'recipe_name']  # Used when ?include= is given without ?fields=
+
+# Columns returned for each recipe by the search API: just enough to show a search result, as on the search results
+# page
+SEARCH_RESULT_FIELDS = ['recipe_id', 'recipe_name', 'photo', 'total_time', 'nutrition_values.calories']
+
+MAX_RECIPE_ID = 2 ** 63 - 1  # Largest integer SQLite stores: larger ids would overflow when bound to a query
+
+# Settings which search and pantry results depend on when they are worked out (rather than when the catalog is rebuilt),
+# so that changing them changes the results' entity tags
+RESULTS_ETAG_SETTINGS = ['FUZZY_MIN_RESULTS', 'FUZZY_MIN_SIMILARITY', 'FUZZY_MAX_WORDS', 'PANTRY_MAX_INGREDIENTS',
+                         'PANTRY_STAPLES']
+
+# Where the recipes for a request are read from: an SQLAlchemy query ordered by recipe_id, the recipe_id column of that
+# query (for cursor pagination), and a function which encodes a list of rows from the query in the response format
+RecipeSource = namedtuple('RecipeSource', ['query', 'recipe_id', 'encode'])
+
+
+def wants_ndjson():
+    """
+    Checks whether the client asked for a streamed, newline-delimited JSON response, either through the Accept header
+    or through the ?stream=1 query parameter.
+
+    :return: True if the response should be streamed as NDJSON
+    """
+    if request.args.get('stream', 0, type=int):
+        return True
+    return request.accept_mimetypes.best_match([JSON.mimetype, NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def recipe_catalog_query():
+    """
+    Query over the whole recipe catalog which loads every relationship used by Recipes.serialize with one SELECT ... IN
+    per relationship for each chunk of recipes, instead of one lazy load per recipe.
+
+    :return: an SQLAlchemy query of recipes, ordered by recipe_id
+    """
+    return Recipes.query \
+        .options(lazyload(Recipes.mealplanrecipes),  # joined collection backref, not compatible with yield_per
+                 selectinload(Recipes.ingredients),
+                 selectinload(Recipes.instructions),
+                 selectinload(Recipes.nutrition_values),
+                 selectinload(Recipes.allergies).joinedload(RecipeAllergies.allergy),
+                 selectinload(Recipes.diet_type).joinedload(RecipeDietTypes.diet)) \
+        .order_by(Recipes.recipe_id)
+
+
+def serialize_recipes(recipes):
+    """
+    Serializes a list of recipes in full (see Recipes.serialize).
+
+    :param recipes: list of Recipes objects
+    :return: list of dictionaries
+    """
+    return [recipe.serialize for recipe in recipes]
+
+
+# Relationship loaders for ?include=. Each one loads a relationship for a list of recipe_ids with a single
+# SELECT ... IN query, and returns the serialized values keyed by recipe_id. lazyload('*') stops the joined backrefs on
+# these models from joining the recipes back in.
+def load_ingredients(recipe_ids):
+    ingredients = RecipeIngredients.query \
+        .options(lazyload('*')) \
+        .filter(RecipeIngredients.recipe_id.in_(recipe_ids)) \
+        .order_by(RecipeIngredients.recipe_ingredient_id)
+    loaded = defaultdict(list)
+    for ingredient in ingredients:
+        loaded[ingredient.recipe_id].append(ingredient.serialize)
+    return loaded
+
+
+def load_instructions(recipe_ids):
+    instructions = RecipeInstructions.query \
+        .options(lazyload('*')) \
+        .filter(RecipeInstructions.recipe_id.in_(recipe_ids)) \
+        .order_by(RecipeInstructions.recipe_instruction_id, RecipeInstructions.step_num)
+    loaded = defaultdict(list)
+    for instruction in instructions:
+        loaded[instruction.recipe_id].append(instruction.serialize)
+    return loaded
+
+
+def load_nutrition_values(recipe_ids):
+    nutrition_values = NutritionValues.query \
+        .options(lazyload('*')) \
+        .filter(NutritionValues.recipe_id.in_(recipe_ids))
+    return {nutrition.recipe_id: nutrition.serialize for nutrition in nutrition_values}
+
+
+def load_allergies(recipe_ids):
+    allergies = RecipeAllergies.query \
+        .options(lazyload('*'), joinedload(RecipeAllergies.allergy)) \
+        .filter(RecipeAllergies.recipe_id.in_(recipe_ids)) \
+        .order_by(RecipeAllergies.allergy_id)
+    loaded = defaultdict(list)
+    for allergy in allergies:
+        loaded[allergy.recipe_id].append(allergy.serialize)
+    return loaded
+
+
+def load_diet_types(recipe_ids):
+    diet_types = RecipeDietTypes.query \
+        .options(lazyload('*'), joinedload(RecipeDietTypes.diet)) \
+        .filter(RecipeDietTypes.recipe_id.in_(recipe_ids))
+    return {diet_type.recipe_id: diet_type.serialize for diet_type in diet_types}
+
+
+# Relationships which can be expanded with ?include=, mapped to their key in the API response and a function that loads
+# them for a list of recipe_ids with a single SELECT ... IN query
+RECIPE_INCLUDES = {'ingredients': ('recipe_ingredients', load_ingredients),
+                   'instructions': ('recipe_instructions', load_instructions),
+                   'nutrition_values': ('nutrition_values', load_nutrition_values),
+                   'allergies': ('recipe_allergies', load_allergies),
+                   'diet_type': ('diet_type', load_diet_types)}
+
+
+def split_arg(name):
+    """
+    :return: the comma-separated query parameter as a list of strings, or None if it was not given
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_sparse_fieldsets():
+    """
+    Reads the ?fields= and ?include= parameters. Aborts with 400 if an unknown field or relationship is requested.
+
+    :return: a tuple of (fields, includes), or (None, None) if the full recipe was requested
+    """
+    fields = split_arg('fields')
+    includes = split_arg('include')
+    if fields is None and includes is None:
+        return None, None
+
+    fields = fields or DEFAULT_SPARSE_FIELDS
+    includes = includes or []
+    for field in fields:
+        if field not in RECIPE_FIELDS:
+            abort(400, 'Unknown field: ' + field)
+    for include in includes:
+        if include not in RECIPE_INCLUDES:
+            abort(400, 'Unknown include: ' + include)
+    return fields, includes
+
+
+def sparse_recipe_query(fields):
+    """
+    Builds one narrow query which selects only the requested columns (recipe_id is always selected, as it is needed to
+    key the recipes and to paginate). NutritionValues is only joined when one of its columns is requested.
+
+    :param fields: list of keys of RECIPE_FIELDS
+    :return: an SQLAlchemy query of column tuples, ordered by recipe_id
+    """
+    columns = [Recipes.recipe_id] + [RECIPE_FIELDS[field].label(field) for field in fields if field != 'recipe_id']
+    query = db.session.query(*columns)
+    if any(field.startswith('nutrition_values.') for field in fields):
+        query = query.outerjoin(NutritionValues, Recipes.recipe_id == NutritionValues.recipe_id)
+    return query.order_by(Recipes.recipe_id)
+
+
+def serialize_sparse(rows, fields, includes):
+    """
+    Serializes rows of a sparse_recipe_query, expanding each requested relationship with one query for all rows.
+
+    :param rows: list of column tuples from sparse_recipe_query
+    :param fields: list of keys of RECIPE_FIELDS
+    :param includes: list of keys of RECIPE_INCLUDES
+    :return: list of dictionaries
+    """
+    recipe_ids = [row.recipe_id for row in rows]
+    loaded = {include: RECIPE_INCLUDES[include][1](recipe_ids) for include in includes}
+
+    serialized = []
+    for row in rows:
+        recipe = {'recipe_id': row.recipe_id}
+        for field in fields:
+            if '.' in field:
+                parent, child = field.split('.', 1)
+                recipe.setdefault(parent, {})[child] = getattr(row, field)
+            elif field != 'recipe_id':
+                recipe[field] = getattr(row, field)
+        for include in includes:
+            key = RECIPE_INCLUDES[include][0]
+            # Nutrition values and diet type are single values, the other relationships are lists
+            recipe[key] = loaded[include].get(row.recipe_id, None if include in ('nutrition_values', 'diet_type')
+                                              else [])
+        serialized.append(recipe)
+    return serialized
+
+
+def recipe_source(response_format=JSON):
+    """
+    Chooses where recipes are read from for this request:
+    - only the fields and relationships asked for with ?fields= and ?include=, or
+    - full recipes, pre-encoded in the CatalogRecipes store by `flask catalog rebuild`, so that each recipe costs one
+      row read and no serialization (the stored JSON is only decoded when a binary format was negotiated), or
+    - full recipes serialized from the recipe tables, if the catalog has not been built.
+
+    :param response_format: the ResponseFormat the recipes are encoded in (see app/api/encoders.py)
+    :return: a RecipeSource
+    """
+    encode = response_format.encode
+    fields, includes = parse_sparse_fieldsets()
+    if fields is not None:
+        return RecipeSource(sparse_recipe_query(fields), Recipes.recipe_id,
+                            lambda rows: [encode(recipe) for recipe in serialize_sparse(rows, fields, includes)])
+
+    if current_catalog() is not None:
+        query = db.session.query(CatalogRecipes.recipe_id, CatalogRecipes.payload).order_by(CatalogRecipes.recipe_id)
+        if response_format is JSON:
+            return RecipeSource(query, CatalogRecipes.recipe_id, lambda rows: [row.payload for row in rows])
+        return RecipeSource(query, CatalogRecipes.recipe_id,
+                            lambda rows: [encode(json.loads(row.payload)) for row in rows])
+
+    return RecipeSource(recipe_catalog_query(), Recipes.recipe_id,
+                        lambda recipes: [encode(recipe) for recipe in serialize_recipes(recipes)])
+
+
+def generate_chunks(query):
+    """
+    Generator which fetches the rows of a query from the database in chunks of config.API_STREAM_CHUNK_SIZE, so that
+    only one chunk is held in memory at a time.
+
+    :param query: an SQLAlchemy query
+    :return: a generator of lists of rows
+    """
+    rows = iter(query.yield_per(config.API_STREAM_CHUNK_SIZE))
+    while True:
+        chunk = list(islice(rows, config.API_STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        yield chunk
+
+
+def generate_ndjson(query, encode):
+    """
+    Generator which encodes one recipe per line, one chunk of recipes at a time (see generate_chunks).
+
+    :param query: an SQLAlchemy query of recipes
+    :param encode: function which encodes a list of rows from the query into JSON bytes
+    :return: a generator of JSON lines
+    """
+    for chunk in generate_chunks(query):
+        yield b''.join(recipe + b'\n' for recipe in encode(chunk))
+
+
+def encode_cursor(recipe_id):
+    """
+    Encodes the last recipe_id of a page into an opaque cursor, which the client passes back as ?after= to fetch the
+    next page.
+
+    :param recipe_id: recipe_id of the last recipe on the current page
+    :return: a URL-safe cursor string
+    """
+    return urlsafe_b64encode(json.dumps({'after': recipe_id}).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor made by encode_cursor. A bare recipe_id (ASCII digits only) is also accepted, so that clients can
+    start a page after a known recipe. Aborts with 400 if the cursor is malformed, or its recipe_id is outside the
+    range of ids SQLite can store.
+
+    :param cursor: cursor string from the ?after= parameter
+    :return: the recipe_id to continue after
+    """
+    try:
+        if re.fullmatch(r'[0-9]+', cursor):
+            recipe_id = int(cursor)
+        else:
+            padded = cursor + '=' * (-len(cursor) % 4)  # Restore base64 padding stripped by encode_cursor
+            recipe_id = json.loads(urlsafe_b64decode(padded.encode()))['after']
+            if type(recipe_id) is not int:
+                raise TypeError(recipe_id)
+    except (ValueError, TypeError, KeyError):
+        abort(400, 'Invalid cursor: ' + cursor)
+    if not 0 <= recipe_id <= MAX_RECIPE_ID:
+        abort(400, 'Invalid cursor: ' + cursor)
+    return recipe_id
+
+
+def parse_limit(default=None):
+    """
+    Parses the ?limit= parameter. Aborts with 400 if it is not a positive integer, rather than ignoring it (which for
+    read_recipes would return the whole catalog).
+
+    :param default: limit to use if ?limit= was not given
+    :return: the limit, or default
+    """
+    value = request.args.get('limit')
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        abort(400, 'limit must be a positive integer')
+    return limit
+
+
+def paginate_recipes(query, recipe_id, after=None, limit=None):
+    """
+    Keyset (cursor) pagination over a query of recipes ordered by recipe_id. Rather than OFFSET, the page starts with
+    WHERE recipe_id > :after, which is a primary key range scan, so deep pages cost the same as the first page. One
+    extra row is fetched to decide whether there is a next page, so no COUNT(*) is needed either.
+
+    :param query: an SQLAlchemy query of recipes, ordered by recipe_id
+    :param recipe_id: the recipe_id column of the query
+    :param after: cursor from the ?after= parameter, or None for the first page
+    :param limit: maximum number of recipes on the page (capped at config.API_MAX_PAGE_SIZE)
+    :return: a tuple of (query for the page, limit applied)
+    """
+    if after:
+        query = query.filter(recipe_id > decode_cursor(after))
+    if limit is not None:
+        if limit < 1:
+            abort(400, 'limit must be a positive integer')
+        limit = min(limit, config.API_MAX_PAGE_SIZE)
+        query = query.limit(limit + 1)
+    return query, limit
+
+
+def next_cursor(recipes, limit):
+    """
+    Trims the extra row fetched by paginate_recipes and works out the cursor for the next page.
+
+    :param recipes: list of recipes fetched for the page (up to limit + 1)
+    :param limit: the limit applied by paginate_recipes
+    :return: a tuple of (recipes on the page, next cursor or None if this is the last page)
+    """
+    if limit is None or len(recipes) <= limit:
+        return recipes, None
+    recipes = recipes[:limit]
+    return recipes, encode_cursor(recipes[-1].recipe_id)
+
+
+def recipes_etag(catalog):
+    """
+    Entity tag for read_recipes: the whole catalog's digest, varied by the query string (pagination, fields), by
+    whether the response is streamed and by the negotiated response format.
+
+    :param catalog: the current Catalog (see app/catalog.py)
+    :return: an entity tag
+    """
+    return make_etag(catalog.catalog_digest, request.query_string.decode(), wants_ndjson(),
+                     negotiate_format().mimetype)
+
+
+def results_etag(catalog):
+    """
+    Entity tag for search_recipes and search_pantry: the catalog generation, as the results depend on the derived tables
+    and indexes rebuilt with each generation (not only on the recipes' content), and the RESULTS_ETAG_SETTINGS, varied
+    by the query string and by the negotiated response format.
+
+    :param catalog: the current Catalog (see app/catalog.py)
+    :return: an entity tag
+    """
+    return make_etag(catalog.generation, *(getattr(config, name) for name in RESULTS_ETAG_SETTINGS),
+                     request.query_string.decode(), negotiate_format().mimetype)
+
+
+def recipe_etag(catalog, recipe_id):
+    """
+    Entity tag for read_recipe: the recipe's own content digest, varied by the query string (fields) and by the
+    negotiated response format.
+
+    :param catalog: the current Catalog (see app/catalog.py)
+    :param recipe_id: recipe_id from the route
+    :return: an entity tag, or None if the recipe is not in the catalog
+    """
+    digest = catalog.recipe_digests.get(recipe_id)
+    if digest is None:
+        return None
+    return make_etag(digest, request.query_string.decode(), negotiate_format().mimetype)
+
+
+def parse_batch_ids():
+    """
+    Reads the recipe ids for a batch lookup, from ?ids=1,5,9 on GET requests or from a JSON body {"ids": [1, 5, 9]} on
+    POST requests (for lists too long for a URL). Aborts with 400 if the ids are malformed, outside the range of ids
+    SQLite can store, or there are more than config.API_MAX_BATCH_SIZE of them.
+
+    :return: list of unique recipe ids, in the order requested
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        ids = body.get('ids') if isinstance(body, dict) else None
+    else:
+        ids = split_arg('ids')
+    if not isinstance(ids, list) or not ids:
+        abort(400, 'ids must be a non-empty list of recipe ids')
+
+    if request.method == 'POST':
+        # JSON ids must be integers: int() would also accept true (as 1), 1.7 (as 1) and "5"
+        if not all(type(recipe_id) is int for recipe_id in ids):
+            abort(400, 'ids must be a non-empty list of recipe ids')
+    else:
+        try:
+            ids = [int(recipe_id) for recipe_id in ids]
+        except ValueError:
+            abort(400, 'ids must be a non-empty list of recipe ids')
+    if not all(0 <= recipe_id <= MAX_RECIPE_ID for recipe_id in ids):  # Larger ids would overflow in the IN query
+        abort(400, 'ids must be a non-empty list of recipe ids')
+    ids = list(dict.fromkeys(ids))  # De-duplicate, keeping the requested order
+    if len(ids) > config.API_MAX_BATCH_SIZE:
+        abort(400, f'At most {config.API_MAX_BATCH_SIZE} recipes can be requested at once')
+    return ids
+
+
+def batch_etag(catalog):
+    """
+    Entity tag for GET batch lookups: the content digests of the requested recipes, varied by the query string and by
+    the negotiated response format.
+
+    :param catalog: the current Catalog (see app/catalog.py)
+    :return: an entity tag, or None for POST requests
+    """
+    if request.method != 'GET':
+        return None
+    digests = [catalog.recipe_digests.get(recipe_id) for recipe_id in parse_batch_ids()]
+    return make_etag(request.query_string.decode(), negotiate_format().mimetype, *digests)
+
+
+def snapshot_etag(catalog):
+    """
+    Entity tag for read_catalog_snapshot: the catalog generation (which the snapshot URLs are made from), varied by the
+    negotiated response format.
+
+    :param catalog: the current Catalog (see app/catalog.py)
+    :return: an entity tag
+    """
+    return make_etag(catalog.generation, negotiate_format().mimetype)
+
+
+def results_page(recipe_ids, after=None, limit=config.RECIPES_PER_PAGE):
+    """
+    Loads a page of compact results from a list of recipe ids, keeping their order. As in paginate_recipes, the page
+    starts after the recipe_id in the cursor (here, after its position in the list) and one extra row is fetched for
+    next_cursor. Only the SEARCH_RESULT_FIELDS columns of the recipes on the page are selected, so no full recipes are
+    loaded. Aborts with 400 if the cursor or limit are malformed.
+
+    :param recipe_ids: list of recipe ids, in order
+    :param after: cursor from the ?after= parameter, or None for the first page
+    :param limit: maximum number of recipes on the page (capped at config.API_MAX_PAGE_SIZE)
+    :return: a tuple of (column tuples of the page in order, limit applied)
+    """
+    if limit < 1:
+        abort(400, 'limit must be a positive integer')
+    limit = min(limit, config.API_MAX_PAGE_SIZE)
+
+    start = 0
+    if after:
+        try:
+            start = recipe_ids.index(decode_cursor(after)) + 1
+        except ValueError:
+            abort(400, 'Invalid cursor: ' + after)
+    page_ids = recipe_ids[start:start + limit + 1]
+
+    columns = [RECIPE_FIELDS[field].label(field) for field in SEARCH_RESULT_FIELDS]
+    rows = db.session.query(*columns) \
+        .select_from(Recipes) \
+        .join(NutritionValues, Recipes.recipe_id == NutritionValues.recipe_id) \
+        .filter(Recipes.recipe_id.in_(page_ids)) if page_ids else []
+    rows = {row.recipe_id: row for row in rows}
+    return [rows[recipe_id] for recipe_id in page_ids if recipe_id in rows], limit
+
+
+def search_results_page(after=None, limit=config.RECIPES_PER_PAGE):
+    """
+    Finds a page of search API results from the same parameters as the recipes (search results) page, by way of
+    search_result_ids, so results are in the same order as on the site: by relevance, or by the ?sort= order. Aborts
+    with 400 if the search parameters, cursor or limit are malformed.
+
+    :param after: cursor from the ?after= parameter, or None for the first page
+    :param limit: maximum number of recipes on the page (capped at config.API_MAX_PAGE_SIZE)
+    :return: a tuple of (column tuples of the page in order, number of matching recipes, limit applied)
+    """
+    try:
+        args_dict = search_args()
+    except ValueError:
+        abort(400, 'allergy_list must be a comma-separated list of allergy ids, and sort one of: ' +
+              ', '.join(config.NUTRIENT_SORTS) + " (with '-' in front for descending order)")
+
+    # The ids come from the cached search results, and their number is the total, rather than a COUNT(*) every page
+    recipe_ids = search_result_ids(args_dict)
+    rows, limit = results_page(list(recipe_ids), after, limit)
+    return rows, len(recipe_ids), limit
+
+
+def pantry_results_page(after=None, limit=config.RECIPES_PER_PAGE):
+    """
+    Finds a page of pantry search results for the ingredients in ?ingredients= (separated by commas), among the
+    recipes suiting ?diet_type= and ?allergy_list=, ranked by how few more ingredients they need (see app/pantry.py).
+    Aborts with 400 if no ingredients are given, or if the allergy list, cursor or limit are malformed.
+
+    :param after: cursor from the ?after= parameter, or None for the first page
+    :param limit: maximum number of recipes on the page (capped at config.API_MAX_PAGE_SIZE)
+    :return: a tuple of (column tuples of the page in order, dictionary of (ingredients used, ingredients missing) of
+        each recipe found, number of recipes found, limit applied)
+    """
+    pantry = parse_pantry(request.args.get('ingredients', ''))
+    if not pantry:
+        abort(400, 'ingredients must be a comma-separated list of ingredients')
+    try:
+        args_dict = search_args()
+    except ValueError:
+        abort(400, 'allergy_list must be a comma-separated list of allergy ids')
+
+    index = filter_index()
+    eligible_ids = index.recipe_ids(index.eligible(args_dict['diet_type'], args_dict['allergy_list']))
+    found = pantry_index().search(pantry, eligible_ids)
+    rows, limit = results_page([recipe_id for recipe_id, used, missing in found], after, limit)
+    return rows, {recipe_id: (used, missing) for recipe_id, used, missing in found}, len(found), limit
+
+
+def serialize_search_results(rows, response_format=JSON):
+    """
+    :param rows: list of column tuples from results_page
+    :param response_format: the ResponseFormat the results are encoded in
+    :return: list of compact search results, encoded in the response format
+    """
+    return [response_format.encode(recipe) for recipe in serialize_sparse(rows, SEARCH_RESULT_FIELDS, [])]
+
+
+def serialize_pantry_results(rows, scores, response_format=JSON):
+    """
+    :param rows: list of column tuples from results_page
+    :param scores: dictionary of (ingredients used, ingredients missing) of each recipe, from pantry_results_page
+    :param response_format: the ResponseFormat the results are encoded in
+    :return: list of compact pantry search results, with how many of their ingredients are used and missing, encoded in
+        the response format
+    """
+    results = serialize_sparse(rows, SEARCH_RESULT_FIELDS, [])
+    for result in results:
+        result['ingredients_used'], result['ingredients_missing'] = scores[result['recipe_id']]
+    return [response_format.encode(result) for result in results]
+
+
+def similar_etag(catalog, recipe_id):
+    """
+    Entity tag for read_similar_recipes: the catalog generation (as the similar recipes are worked out again with each
+    generation, and change with any recipe), varied by the recipe, the query string and the negotiated response format.
+
+    :param catalog: the current Catalog (see app/catalog.py)
+    :param recipe_id: recipe_id from the route
+    :return: an entity tag, or None if the recipe is not in the catalog
+    """
+    if recipe_id not in catalog.recipe_digests:
+        return None
+    return make_etag(catalog.generation, recipe_id, request.query_string.decode(), negotiate_format().mimetype)
+
+
+def similar_results(recipe_id, limit=config.SIMILAR_RECIPES):
+    """
+    Looks up the recipes most similar to a recipe, precomputed in RecipeSimilarities (see app/similar.py), with the
+    SEARCH_RESULT_FIELDS columns of each.
+
+    :param recipe_id: id of the recipe
+    :param limit: the most similar recipes to return (at most config.SIMILAR_RECIPES are stored)
+    :return: list of column tuples, with the similarity of each, most similar first
+    """
+    columns = [RECIPE_FIELDS[field].label(field) for field in SEARCH_RESULT_FIELDS]
+    return db.session.query(*columns, RecipeSimilarities.similarity) \
+        .select_from(RecipeSimilarities) \
+        .join(Recipes, Recipes.recipe_id == RecipeSimilarities.similar_recipe_id) \
+        .join(NutritionValues, Recipes.recipe_id == NutritionValues.recipe_id) \
+        .filter(RecipeSimilarities.recipe_id == recipe_id) \
+        .order_by(RecipeSimilarities.rank) \
+        .limit(limit) \
+        .all()
+
+
+def serialize_similar_results(rows, response_format=JSON):
+    """
+    :param rows: list of column tuples from similar_results
+    :param response_format: the ResponseFormat the results are encoded in
+    :return: list of compact results with their similarity, encoded in the response format
+    """
+    results = serialize_sparse(rows, SEARCH_RESULT_FIELDS, [])
+    for result, row in zip(results, rows):
+        result['similarity'] = row.similarity
+    return [response_format.encode(result) for result in results]
+
+
+def search_facets():
+    """
+    Counts how many recipes a search with the recipes page's parameters would find, and how many it would find with
+    each diet type, with each allergy also excluded, in each calorie range and under each maximum time (see
+    FilterIndex.facets). The recipes matching the search term come from the cached search results, and the counts from
+    the in-memory filter index. Aborts with 400 if the search parameters are malformed.
+
+    :return: a dictionary of the counts, with the names of the diet types and allergies
+    """
+    try:
+        args_dict = search_args()
+    except ValueError:
+        abort(400, 'allergy_list must be a comma-separated list of allergy ids')
+
+    recipe_ids = None
+    if fts_query(args_dict['search_term']) is not None:
+        # Only the search term, as the facets count the other filters themselves
+        recipe_ids = search_result_ids({'search_term': args_dict['search_term'], 'min_cal': None, 'max_cal': None,
+                                        'time': None})
+    facets = filter_index().facets(args_dict['diet_type'], args_dict['allergy_list'], args_dict['min_cal'],
+                                   args_dict['max_cal'], args_dict['time'], nutrient_ranges(args_dict), recipe_ids)
+
+    edges = config.FACET_CALORIE_BUCKETS
+    return {'total': facets['total'],
+            'diet_types': [{'diet_type_id': diet_type_id, 'diet_name': diet_name,
+                            'count': facets['diet_types'][diet_type_id]}
+                           for diet_type_id, diet_name in config.DIET_CHOICES],
+            'allergies': [{'allergy_id': allergy_id, 'allergy_name': allergy_name,
+                           'count': facets['allergies'][allergy_id]}
+                          for allergy_id, allergy_name in config.ALLERGY_CHOICES],
+            'calories': [{'min_cal': low, 'max_cal': high, 'count': count}
+                         for low, high, count in zip(edges, edges[1:], facets['calories'])],
+            'time': [{'time': time, 'count': count} for time, count in zip(config.FACET_TIME_BUCKETS, facets['time'])]}
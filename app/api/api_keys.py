@@ -0,0 +1,138 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/api/api_keys.py:
+
+This document includes API key authentication and rate limiting for the Mealtime API, including:
+- create_api_key and the `flask apikeys` commands
+- verify_api_key, which checks keys against their stored hashes, caching the result for config.API_KEY_CACHE_TTL seconds
+- TokenBucketLimiter, which limits the rate of requests made with each key
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.cache import MISSING, TTLCache
+from app.models import ApiKeys
+import config
+
+import click
+from collections import OrderedDict
+from datetime import datetime
+from flask.cli import AppGroup
+from hashlib import sha256
+import secrets
+from threading import Lock
+import time
+
+api_keys_cli = AppGroup('apikeys', help='Manage API keys.')
+
+# Results of verify_api_key, keyed by a SHA-256 of the key (so raw keys are not kept in memory). Keys that failed
+# verification are cached too (as None), so that repeated requests with a bad key do not each cost a hash check.
+_verified_keys = TTLCache(config.API_KEY_CACHE_SIZE, config.API_KEY_CACHE_TTL)
+
+
+def create_api_key(name):
+    """
+    Creates an API key. Only a hash of the key is stored, so it cannot be shown again later.
+
+    The key is made of a public prefix, used to look up the key's row, and a secret: '<prefix>.<secret>'.
+
+    :param name: who or what the key is for
+    :return: a tuple of (ApiKeys row, the key)
+    """
+    prefix = secrets.token_hex(4)
+    key = prefix + '.' + secrets.token_urlsafe(32)
+    api_key = ApiKeys(name=name, key_prefix=prefix, created_at=str(datetime.utcnow()), revoked=0)
+    api_key.set_key(key)
+    db.session.add(api_key)
+    db.session.commit()
+    return api_key, key
+
+
+def verify_api_key(key):
+    """
+    Checks an API key against the stored hash of the key with the same prefix. Results are cached per process (see
+    _verified_keys), so a key is only hashed about once every config.API_KEY_CACHE_TTL seconds.
+
+    :param key: the key sent by the client
+    :return: key_id of the key, or None if the key is unknown, revoked or wrong
+    """
+    if not key:
+        return None
+    cache_key = sha256(key.encode()).digest()
+    key_id = _verified_keys.get(cache_key)
+    if key_id is MISSING:
+        prefix = key.split('.', 1)[0]
+        api_key = ApiKeys.query.filter_by(key_prefix=prefix, revoked=0).first()
+        key_id = api_key.key_id if api_key is not None and api_key.check_key(key) else None
+        _verified_keys.set(cache_key, key_id)
+    return key_id
+
+
+class TokenBucketLimiter(object):
+    """
+    Per-key token bucket rate limiter. Each key's bucket holds up to `burst` tokens and refills at `rate` tokens per
+    second; a request spends one token. A bucket is two floats in a dictionary, updated in place under a lock, so a
+    check costs about a microsecond.
+
+    Buckets are kept per worker process, so the limits apply to each worker separately. At most max_buckets are kept:
+    the least recently used are dropped, which only forgets keys (or client addresses) that have been idle the longest,
+    whose buckets have most likely refilled anyway.
+    """
+
+    def __init__(self, max_buckets=config.API_RATE_LIMIT_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # key: (tokens, time of last update), least recently used first
+        self._lock = Lock()
+
+    def consume(self, key, rate, burst):
+        """
+        Spends one token from key's bucket, if there is one.
+
+        :param key: the key (e.g. key_id) whose bucket to use
+        :param rate: tokens added to the bucket per second
+        :param burst: size of the bucket
+        :return: 0 if the request is allowed, otherwise the number of seconds until a token is available
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+rate_limiter = TokenBucketLimiter()
+
+
+@api_keys_cli.command('create')
+@click.argument('name')
+def create_command(name):
+    """Create an API key for NAME."""
+    api_key, key = create_api_key(name)
+    click.echo(f"Created API key {api_key.key_prefix} for {name}. Store it now, it will not be shown again:\n{key}")
+
+
+@api_keys_cli.command('revoke')
+@click.argument('prefix')
+def revoke_command(prefix):
+    """Revoke the API key starting with PREFIX."""
+    api_key = ApiKeys.query.filter_by(key_prefix=prefix).first()
+    if api_key is None:
+        raise click.ClickException(f"No API key with prefix {prefix}")
+    api_key.revoked = 1
+    db.session.commit()
+    _verified_keys.clear()
+    click.echo(f"Revoked API key {prefix}. Other worker processes stop accepting it within "
+               f"{config.API_KEY_CACHE_TTL} seconds.")
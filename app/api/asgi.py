@@ -0,0 +1,172 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/api/asgi.py:
+
+This document includes an asynchronous (ASGI) serving mode for the Mealtime API, for use with an ASGI server such as
+uvicorn (see asgi.py in the project root). It includes:
+- AsgiApp, which serves the Flask application from an event loop, running the (synchronous) views on a bounded thread
+  pool
+- build_environ, which translates an ASGI HTTP request into a WSGI environ
+
+Behind gunicorn sync workers, a client downloading the whole catalog slowly holds a worker for the whole transfer. Here,
+requests wait for a pool thread on the event loop rather than in a worker's accept queue, and the event loop sends the
+response, so a response shorter than the buffer frees its pool thread at once. A response longer than the buffer still
+holds its pool thread until the client has read all but the last max_buffered_chunks chunks: the bounded queue applies
+backpressure to the thread, which keeps the memory used per slow client bounded.
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+import config
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import sys
+from threading import Event
+
+
+def build_environ(scope, body):
+    """
+    :param scope: ASGI HTTP connection scope
+    :param body: the request body, as bytes
+    :return: the WSGI environ for the request
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+class AsgiApp(object):
+    """
+    ASGI application serving a WSGI (Flask) application. Each request is run on a pool of at most max_threads threads.
+    The pool thread calls the view and iterates the response body, handing chunks to the event loop through a queue of
+    at most max_buffered_chunks chunks, and the event loop sends the chunks to the client at whatever pace the client
+    reads them. When the queue is full the pool thread blocks until the client has read a chunk, so a slow client holds
+    its pool thread until the rest of the body fits in the queue; the thread is released once the body has been
+    produced, or at once if the client goes away.
+
+    The response is iterated on the thread which called the view, because Flask's request contexts and SQLAlchemy's
+    scoped sessions are bound to the thread.
+    """
+
+    def __init__(self, wsgi_app, max_threads=config.ASGI_MAX_THREADS,
+                 max_buffered_chunks=config.ASGI_MAX_BUFFERED_CHUNKS):
+        self.wsgi_app = wsgi_app
+        self.max_buffered_chunks = max_buffered_chunks
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type: ' + scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        environ = build_environ(scope, b''.join(body))
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=self.max_buffered_chunks)
+        stopped = Event()  # Set if the client goes away, so the pool thread stops producing the response
+        future = loop.run_in_executor(self.executor, self.run_wsgi, environ, loop, queue, stopped)
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                await send(message)
+            await future  # Re-raises any error from the view
+        finally:
+            stopped.set()
+            while not future.done():  # Unblock the pool thread if it is waiting for room in the queue
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.wait([future], timeout=0.01)
+
+    def run_wsgi(self, environ, loop, queue, stopped):
+        """
+        Runs on a pool thread: calls the WSGI application and iterates its response, putting ASGI messages on the
+        queue. A final None marks the end of the response. Putting a message blocks this thread while the queue is
+        full, i.e. while the client is reading more slowly than the response is produced.
+        """
+        def put(message):
+            if not stopped.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start.update(type='http.response.start', status=int(status.split(' ', 1)[0]),
+                                  headers=[(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                           for name, value in headers])
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                put(response_start)
+                for chunk in iterable:
+                    if stopped.is_set():
+                        break
+                    if chunk:
+                        put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                put({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        finally:
+            put(None)
+
+
+def create_asgi_app(config_class):
+    """
+    Creates the Flask application, served as an ASGI application. The configuration must be given, as unlike
+    create_app, there is no development default (which would serve with DEBUG on).
+
+    :param config_class: the configuration class, or its import name (e.g. 'config.ProdConfig')
+    :return: an AsgiApp
+    """
+    from app import create_app
+    return AsgiApp(create_app(config_class).wsgi_app)
@@ -0,0 +1,184 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/api/encoders.py:
+
+This document includes the response formats the API can negotiate through the Accept header, including:
+- encode_json and json_object (JSON, the default)
+- encode_msgpack and msgpack_object (MessagePack, application/msgpack)
+- encode_cbor and cbor_object (CBOR, application/cbor)
+- negotiate_format and format_response
+
+Each format can assemble an object from members which are already encoded in that format, so that pre-encoded recipes
+are never decoded and re-encoded.
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+import cbor2
+from collections import namedtuple
+from flask import Response, json, request
+import msgpack
+import struct
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# A response format: its mimetype, a function encoding one value to bytes, and a function assembling an object from
+# (possibly pre-encoded) members
+ResponseFormat = namedtuple('ResponseFormat', ['mimetype', 'encode', 'encode_object'])
+
+
+def is_pre_encoded(value):
+    """
+    :return: True if value is already encoded (bytes), or is a list/ dictionary of encoded items
+    """
+    if isinstance(value, bytes):
+        return True
+    items = list(value.values()) if isinstance(value, dict) else value
+    return isinstance(value, (list, dict)) and all(isinstance(item, bytes) for item in items)
+
+
+def encode_json(value):
+    """
+    :return: compact JSON encoding of value, as bytes
+    """
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def json_object(**members):
+    """
+    Assembles a JSON object from members which are already JSON-encoded (bytes), or lists/ dictionaries of
+    JSON-encoded items, so pre-encoded recipes can be sent without being decoded and re-encoded. Any other member is
+    encoded as usual.
+
+    :return: the JSON object, as bytes
+    """
+    parts = []
+    for name, value in members.items():
+        if not is_pre_encoded(value):
+            value = encode_json(value)
+        elif isinstance(value, list):
+            value = b'[' + b','.join(value) + b']'
+        elif isinstance(value, dict):
+            value = b'{' + b','.join(encode_json(str(key)) + b':' + item for key, item in value.items()) + b'}'
+        parts.append(encode_json(name) + b':' + value)
+    return b'{' + b','.join(parts) + b'}'
+
+
+def binary_object(members, encode, array_header, map_header):
+    """
+    Assembles an object in a binary format (MessagePack or CBOR) from members, pre-encoded or not (see json_object).
+    Both formats prefix arrays and maps with a header giving their length, followed by the encoded items, so
+    pre-encoded items can simply be concatenated after the header.
+
+    :param members: dictionary of members
+    :param encode: function encoding one value in the format
+    :param array_header: function returning the header of an array of n items
+    :param map_header: function returning the header of a map of n pairs
+    :return: the object, as bytes
+    """
+    parts = [map_header(len(members))]
+    for name, value in members.items():
+        parts.append(encode(name))
+        if not is_pre_encoded(value):
+            parts.append(encode(value))
+        elif isinstance(value, list):
+            parts.append(array_header(len(value)))
+            parts.extend(value)
+        elif isinstance(value, dict):
+            # Keys are strings, as in JSON, so that every format returns the same document
+            parts.append(map_header(len(value)))
+            for key, item in value.items():
+                parts.append(encode(str(key)))
+                parts.append(item)
+        else:
+            parts.append(value)
+    return b''.join(parts)
+
+
+def encode_msgpack(value):
+    """
+    :return: MessagePack encoding of value, as bytes
+    """
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def msgpack_header(small_type, type_16, length):
+    """
+    :return: header of a MessagePack array or map with length items (fixarray/ fixmap, array 16/ map 16 or 32)
+    """
+    if length < 16:
+        return bytes([small_type | length])
+    if length < 1 << 16:
+        return bytes([type_16]) + struct.pack('>H', length)
+    return bytes([type_16 + 1]) + struct.pack('>I', length)
+
+
+def msgpack_object(**members):
+    """
+    Assembles a MessagePack map from members, pre-encoded or not (see json_object).
+
+    :return: the MessagePack map, as bytes
+    """
+    return binary_object(members, encode_msgpack,
+                         lambda length: msgpack_header(0x90, 0xdc, length),
+                         lambda length: msgpack_header(0x80, 0xde, length))
+
+
+def encode_cbor(value):
+    """
+    :return: CBOR encoding of value, as bytes
+    """
+    return cbor2.dumps(value)
+
+
+def cbor_header(major_type, length):
+    """
+    :return: header of a CBOR array (major type 4) or map (major type 5) with length items
+    """
+    if length < 24:
+        return bytes([major_type << 5 | length])
+    if length < 1 << 8:
+        return bytes([major_type << 5 | 24, length])
+    if length < 1 << 16:
+        return bytes([major_type << 5 | 25]) + struct.pack('>H', length)
+    return bytes([major_type << 5 | 26]) + struct.pack('>I', length)
+
+
+def cbor_object(**members):
+    """
+    Assembles a CBOR map from members, pre-encoded or not (see json_object).
+
+    :return: the CBOR map, as bytes
+    """
+    return binary_object(members, encode_cbor, lambda length: cbor_header(4, length),
+                         lambda length: cbor_header(5, length))
+
+
+JSON = ResponseFormat(JSON_MIMETYPE, encode_json, json_object)
+
+# Formats the API responds in, keyed by the mimetype a client can ask for. JSON comes first, so it is chosen when the
+# client accepts any format.
+RESPONSE_FORMATS = {JSON_MIMETYPE: JSON,
+                    'application/msgpack': ResponseFormat('application/msgpack', encode_msgpack, msgpack_object),
+                    'application/x-msgpack': ResponseFormat('application/x-msgpack', encode_msgpack, msgpack_object),
+                    'application/cbor': ResponseFormat('application/cbor', encode_cbor, cbor_object)}
+
+
+def negotiate_format():
+    """
+    :return: the ResponseFormat which best matches the request's Accept header (JSON if none of them match)
+    """
+    mimetype = request.accept_mimetypes.best_match(list(RESPONSE_FORMATS), default=JSON_MIMETYPE)
+    return RESPONSE_FORMATS[mimetype]
+
+
+def format_response(response_format, **members):
+    """
+    :param response_format: the negotiated ResponseFormat
+    :return: a 200 response holding an object assembled from members in the given format
+    """
+    return Response(response_format.encode_object(**members), mimetype=response_format.mimetype)
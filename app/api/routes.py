@@ -11,23 +11,91 @@ __email__ = "justin.wong.17@ucl.ac.uk"
 __credits__ = ["Justin Wong"]
 __status__ = "Development"
 
-from app.models import Recipes
+from app.api.api_functions import wants_ndjson, recipe_source, generate_ndjson, paginate_recipes, next_cursor, \
+    recipes_etag, recipe_etag, parse_batch_ids, batch_etag, search_results_page, serialize_search_results, \
+    pantry_results_page, serialize_pantry_results, similar_etag, similar_results, serialize_similar_results, \
+    search_facets, snapshot_etag, parse_limit, results_etag
+from app.api.api_keys import verify_api_key, rate_limiter
+from app.api.encoders import JSON, NDJSON_MIMETYPE, negotiate_format, format_response
+from app.catalog import conditional, current_catalog
+from app.main.main_functions import search_cache_stats
+from app.snapshot import SNAPSHOT_ARTIFACTS, snapshot_path
+from app.suggest import suggest_index
+import config
 
-from flask import Blueprint, jsonify, request, make_response
-from flask_httpauth import HTTPBasicAuth
+from flask import Blueprint, Response, abort, current_app, g, jsonify, request, make_response, send_file, \
+    stream_with_context, url_for
+from flask_httpauth import HTTPTokenAuth
+import math
+import os
 
 bp_api = Blueprint('api', __name__, url_prefix='/api')
-http_auth = HTTPBasicAuth()
+http_auth = HTTPTokenAuth(scheme='Bearer')
+
+
+@http_auth.verify_token
+def verify_token(token):
+    g.api_key_id = verify_api_key(token)
+    return g.api_key_id is not None
+
+
+@http_auth.error_handler
+def unauthorized():
+    error = {
+        'status': 401,
+        'message': 'Unauthorized: send a valid API key as "Authorization: Bearer <key>"',
+    }
+    response = jsonify(error)
+    return make_response(response, 401)
+
+
+# API calls made by the site's own pages, which have no API key, and so are rate limited per client address instead
+PUBLIC_ENDPOINTS = {'api.suggest_recipes', 'api.read_facets'}
+
+
+@bp_api.before_request
+def check_api_key():
+    if request.endpoint in PUBLIC_ENDPOINTS:
+        return rate_limit(('address', request.remote_addr))
+    return check_rate_limit()
+
+
+@http_auth.login_required
+def check_rate_limit():
+    # Every other API call needs an API key (checked by http_auth.login_required), and is rate limited per key
+    return rate_limit(g.api_key_id)
+
+
+def rate_limit(key):
+    retry_after = rate_limiter.consume(key, current_app.config['API_RATE_LIMIT'], current_app.config['API_RATE_BURST'])
+    if retry_after:
+        error = {
+            'status': 429,
+            'message': 'Too Many Requests: retry after {} seconds'.format(math.ceil(retry_after)),
+        }
+        response = make_response(jsonify(error), 429)
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response
 
 
 @bp_api.after_request
 def add_header(response):
-    # Apply same header to every response using @bp_api.after_request, as they all respond json
-    # json response then we could apply the same header to every response using @bp_api.after_request
-    response.headers['Content-Type'] = 'application/json'
+    # Every response's format is negotiated on the Accept header (JSON, MessagePack, CBOR or a NDJSON stream, see
+    # app/api/encoders.py), so caches must keep one copy per Accept header
+    response.vary.add('Accept')
     return response
 
 
+@bp_api.errorhandler(400)
+def bad_request(error):
+    error = {
+        'status': 400,
+        'message': 'Bad Request: ' + error.description,
+    }
+    response = jsonify(error)
+    return make_response(response, 400)
+
+
 @bp_api.errorhandler(404)
 def not_found(error):
     error = {
@@ -38,25 +106,248 @@ def not_found(error):
     return make_response(response, 404)
 
 
+@bp_api.errorhandler(503)
+def service_unavailable(error):
+    error = {
+        'status': 503,
+        'message': 'Service Unavailable: ' + error.description,
+    }
+    response = make_response(jsonify(error), 503)
+    response.headers['Retry-After'] = '60'
+    return response
+
+
 @bp_api.route('/recipes', methods=['GET'])
+@conditional(recipes_etag, config.API_CACHE_CONTROL)
 def read_recipes():
     """
     API call for ALL recipes in Mealtime database
 
-    :return: a JSON object
+    Clients can request a streaming export (one recipe per line) with 'Accept: application/x-ndjson' or ?stream=1. The
+    catalog is then read and flushed in chunks, so memory use and time-to-first-byte do not grow with the catalog.
+
+    Results can be paginated with ?limit=<n>&after=<cursor>. The response then includes a 'next' cursor to pass as
+    ?after= for the following page ('next' is null on the last page).
+
+    Responses can be narrowed with ?fields=recipe_id,recipe_name,nutrition_values.calories and relationships expanded
+    with ?include=ingredients (see RECIPE_FIELDS and RECIPE_INCLUDES in api_functions.py).
+
+    Server-to-server clients can ask for MessagePack or CBOR instead of JSON with 'Accept: application/msgpack' or
+    'Accept: application/cbor'. Streams are always NDJSON.
+
+    :return: a JSON (MessagePack, CBOR) object, or a stream of JSON lines
     """
-    recipes = Recipes.query.all()
-    json = jsonify(recipes=[r.serialize for r in recipes])
-    return make_response(json, 200)
+    response_format = JSON if wants_ndjson() else negotiate_format()
+    source = recipe_source(response_format)
+    limit = parse_limit()
+    query, limit = paginate_recipes(source.query, source.recipe_id, after=request.args.get('after'), limit=limit)
+
+    if wants_ndjson():
+        if limit is not None:
+            query = query.limit(limit)  # Streams do not return a cursor, so the look-ahead row is not needed
+        return Response(stream_with_context(generate_ndjson(query, source.encode)), mimetype=NDJSON_MIMETYPE)
+
+    if limit is None:
+        return format_response(response_format, recipes=source.encode(query.all()))
+
+    recipes, cursor = next_cursor(query.all(), limit)
+    return format_response(response_format, recipes=source.encode(recipes), next=cursor)
 
 
 @bp_api.route('/recipes/<int:recipe_id>', methods=['GET'])
+@conditional(recipe_etag, config.API_CACHE_CONTROL)
 def read_recipe(recipe_id):
     """
     API call for a given recipe in Mealtime database, given by recipe id
 
-    :return: a JSON object
+    Accepts the same ?fields= and ?include= parameters, and the same response formats, as read_recipes. Full recipes
+    are served straight from the pre-encoded CatalogRecipes store, with a single primary key lookup.
+
+    :return: a JSON (MessagePack, CBOR) object
+    """
+    response_format = negotiate_format()
+    source = recipe_source(response_format)
+    recipe = source.query.filter(source.recipe_id == recipe_id).first()
+    if recipe is None:
+        abort(404)
+    return format_response(response_format, recipe=source.encode([recipe])[0])
+
+
+@bp_api.route('/recipes/<int:recipe_id>/similar', methods=['GET'])
+@conditional(similar_etag, config.API_CACHE_CONTROL)
+def read_similar_recipes(recipe_id):
+    """
+    API call for the recipes most similar to a given recipe, by the ingredients they use. The similar recipes are
+    worked out when the catalog is rebuilt (see app/similar.py), so this is a single indexed lookup. Up to ?limit=
+    recipes are returned (config.SIMILAR_RECIPES by default, and at most).
+
+    :return: an object with a list of compact results, each with its similarity from 0 to 1, most similar first
+    """
+    rows = similar_results(recipe_id, min(parse_limit(config.SIMILAR_RECIPES), config.SIMILAR_RECIPES))
+    catalog = current_catalog()
+    if not rows and (catalog is None or recipe_id not in catalog.recipe_digests):
+        abort(404)
+    response_format = negotiate_format()
+    return format_response(response_format, results=serialize_similar_results(rows, response_format))
+
+
+@bp_api.route('/recipes/batch', methods=['GET', 'POST'])
+@conditional(batch_etag, config.API_CACHE_CONTROL)
+def read_recipes_batch():
+    """
+    API call for several recipes at once, given by ?ids=1,5,9 (GET) or a JSON body {"ids": [1, 5, 9]} (POST).
+
+    All recipes are read with one IN query (plus one per relationship asked for with ?include=). Accepts the same
+    ?fields= and ?include= parameters, and the same response formats, as read_recipes.
+
+    :return: an object with the recipes keyed by recipe id, and a list of requested ids that do not exist
     """
-    recipe = Recipes.query.filter_by(recipe_id=recipe_id).first_or_404()
-    json = jsonify(recipe=recipe.serialize)
-    return make_response(json, 200)
+    recipe_ids = parse_batch_ids()
+    response_format = negotiate_format()
+    source = recipe_source(response_format)
+    rows = source.query.filter(source.recipe_id.in_(recipe_ids)).all()
+    found = dict(zip((row.recipe_id for row in rows), source.encode(rows)))
+
+    recipes = {recipe_id: found[recipe_id] for recipe_id in recipe_ids if recipe_id in found}
+    missing = [recipe_id for recipe_id in recipe_ids if recipe_id not in found]
+    return format_response(response_format, recipes=recipes, missing=missing)
+
+
+@bp_api.route('/search', methods=['GET'])
+@conditional(results_etag, config.API_CACHE_CONTROL)
+def search_recipes():
+    """
+    API call to search recipes, taking the same parameters as the recipes (search results) page: ?search_term=,
+    ?diet_type=, ?allergy_list=1,4,10, ?min_cal=, ?max_cal=, ?time=, nutrient bounds such as ?min_proteins=30 and
+    ?max_salts=1 (for any of config.NUTRIENT_FILTERS), and ?sort= (e.g. -proteins_per_kcal).
+
+    Results are compact (see SEARCH_RESULT_FIELDS in api_functions.py), in the same order as on the site, and paginated
+    with ?limit=<n>&after=<cursor>, as in read_recipes. The page size defaults to config.RECIPES_PER_PAGE. Results can
+    be returned in the same formats as read_recipes.
+
+    :return: an object with the page of results, the total number of matching recipes and the 'next' cursor
+    """
+    results, total, limit = search_results_page(after=request.args.get('after'),
+                                                limit=parse_limit(config.RECIPES_PER_PAGE))
+    results, cursor = next_cursor(results, limit)
+    response_format = negotiate_format()
+    return format_response(response_format, results=serialize_search_results(results, response_format),
+                           total=total, next=cursor)
+
+
+@bp_api.route('/pantry', methods=['GET'])
+@conditional(results_etag, config.API_CACHE_CONTROL)
+def search_pantry():
+    """
+    API call to find recipes to cook from a pantry: ?ingredients= is the ingredients the user has, separated by commas
+    (e.g. chicken,rice,red pepper). Recipes using at least one of them are ranked by how few more ingredients they need
+    (staples such as salt are taken to be in every pantry, see config.PANTRY_STAPLES), and can be narrowed with
+    ?diet_type= and ?allergy_list=. Ranking uses an in-memory inverted index of the recipes' ingredients (see
+    app/pantry.py).
+
+    Results are compact, with the number of ingredients used and missing, and paginated as in search_recipes.
+
+    :return: an object with the page of results, the total number of recipes found and the 'next' cursor
+    """
+    results, scores, total, limit = pantry_results_page(
+        after=request.args.get('after'), limit=parse_limit(config.RECIPES_PER_PAGE))
+    results, cursor = next_cursor(results, limit)
+    response_format = negotiate_format()
+    return format_response(response_format, results=serialize_pantry_results(results, scores, response_format),
+                           total=total, next=cursor)
+
+
+@bp_api.route('/facets', methods=['GET'])
+def read_facets():
+    """
+    API call for facet counts, taking the same parameters as search_recipes: the number of recipes the search finds,
+    and how many it would find with each diet type, with each allergy also excluded, in each calorie range
+    (config.FACET_CALORIE_BUCKETS) and under each maximum time (config.FACET_TIME_BUCKETS). The counts for each filter
+    apply every other filter. They are worked out in memory (see FilterIndex.facets), so the advanced search page calls
+    this without an API key as its sliders move.
+
+    :return: an object with the total and the counts of each facet
+    """
+    response = format_response(negotiate_format(), **search_facets())
+    response.headers['Cache-Control'] = config.API_CACHE_CONTROL
+    return response
+
+
+@bp_api.route('/suggest', methods=['GET'])
+def suggest_recipes():
+    """
+    API call for search-as-you-type suggestions: the most popular recipes with a word in their name starting with ?q=
+    (e.g. "fried ri" suggests "Egg fried rice"). Suggestions come from an in-memory index (see app/suggest.py), so the
+    database is not queried. This call does not need an API key, as it is made by the search bar of the site's pages.
+
+    :return: an object with a list of suggested recipes, each with its recipe_id and recipe_name
+    """
+    limit = parse_limit(config.SUGGEST_LIMIT)
+    suggestions = suggest_index().suggest(request.args.get('q', ''), min(limit, config.SUGGEST_MAX_LIMIT))
+    response = format_response(negotiate_format(), suggestions=[{'recipe_id': recipe_id, 'recipe_name': recipe_name}
+                                                                for recipe_id, recipe_name in suggestions])
+    response.headers['Cache-Control'] = config.API_CACHE_CONTROL
+    return response
+
+
+@bp_api.route('/catalog/snapshot', methods=['GET'])
+@conditional(snapshot_etag, config.API_CACHE_CONTROL)
+def read_catalog_snapshot():
+    """
+    API call describing the downloadable snapshots of the current catalog generation, for clients who want the whole
+    dataset:
+    - catalog.db, a read-only SQLite database of the recipe catalog tables, and
+    - nutrition.npz, every recipe's nutrition values as columns (NumPy arrays).
+
+    The download URLs include the catalog generation, so a client can keep a snapshot until the generation changes.
+    Snapshots are built with the catalog (see app/snapshot.py), never here.
+
+    :return: an object with the catalog generation, and the URL and size of each snapshot, or 503 if the snapshots of
+        the current generation have not been built yet
+    """
+    catalog = current_catalog()
+    if catalog is None:
+        abort(404)
+    paths = {artifact: snapshot_path(catalog, artifact) for artifact in SNAPSHOT_ARTIFACTS}
+    if None in paths.values():
+        abort(503, 'The snapshots of this catalog generation have not been built yet')
+    files = {artifact: {'url': url_for('api.download_catalog_snapshot', generation=catalog.generation,
+                                       artifact=artifact, _external=True),
+                        'size': os.path.getsize(path)}
+             for artifact, path in paths.items()}
+    return format_response(negotiate_format(), generation=catalog.generation, built_at=catalog.built_at.isoformat(),
+                           files=files)
+
+
+@bp_api.route('/catalog/snapshot/<int:generation>/<artifact>', methods=['GET'])
+def download_catalog_snapshot(generation, artifact):
+    """
+    Downloads a snapshot of the current catalog generation (see read_catalog_snapshot). Snapshots are prebuilt files,
+    sent as they are (with sendfile, where the server supports it), with support for conditional and range requests so
+    interrupted downloads can be resumed.
+
+    :return: the snapshot file, or 404 if the generation is not the current one (or its snapshot is not built)
+    """
+    catalog = current_catalog()
+    if catalog is None or catalog.generation != generation or artifact not in SNAPSHOT_ARTIFACTS:
+        abort(404)
+    path = snapshot_path(catalog, artifact)
+    if path is None:
+        abort(404)
+    response = send_file(path, mimetype=SNAPSHOT_ARTIFACTS[artifact][0], as_attachment=True,
+                         attachment_filename=os.path.basename(path), conditional=True)
+    response.headers['Cache-Control'] = config.SNAPSHOT_CACHE_CONTROL
+    return response
+
+
+@bp_api.route('/stats', methods=['GET'])
+def read_stats():
+    """
+    API call for monitoring the in-process caches of the worker process which answers it: how many entries each cache
+    holds, and its hits and misses since the worker started.
+
+    :return: an object with the stats of each cache
+    """
+    response = format_response(negotiate_format(), search_results=search_cache_stats())
+    response.headers['Cache-Control'] = 'no-store'
+    return response
@@ -0,0 +1,76 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/cache.py:
+
+This document includes TTLCache, a small in-process cache with least-recently-used eviction and a time-to-live for each
+entry. It is thread-safe, so one cache can be shared by all the threads of a worker process, and counts its hits and
+misses.
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+MISSING = object()  # Returned by TTLCache.get for keys which are not cached, as None can be a cached value
+
+
+class TTLCache(object):
+    """
+    Least-recently-used cache of at most max_size entries, each of which expires ttl seconds after it was set.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key: (value, expiry time), least recently used first
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        """
+        :param key: the key to look up
+        :param default: returned if the key is not cached, or has expired
+        :return: the cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Caches value under key, evicting the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: a dictionary of the number of entries cached, and the number of hits and misses so far
+        """
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._entries)
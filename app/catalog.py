@@ -0,0 +1,242 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/catalog.py:
+
+This document manages the derived catalog tables, which are rebuilt whenever the recipe catalog is re-created with
+db/create_db.py (through the `flask catalog rebuild` command). It includes:
+- rebuild_catalog (which also rebuilds the search index and builds the catalog snapshots) and the `flask catalog`
+  commands
+- rebuild_recipe_nutrition, which precomputes the nutrient to calorie ratios searches are sorted by
+- rebuild_recipe_summary, which denormalizes what list views show and searches filter on into one row per recipe
+- current_catalog, a per-process cache of the current catalog generation and per-recipe content digests
+- conditional decorator, which adds ETag/ Last-Modified/ Cache-Control headers to catalog views and answers
+  conditional GETs with 304 Not Modified
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.models import CatalogVersions, CatalogRecipes, Recipes, RecipeAllergies, RecipeDietTypes, NutritionValues, \
+    RecipeNutrition, RecipeSimilarities, RecipeSummary
+from app.search import rebuild_search_index
+from app.snapshot import build_snapshots
+import config
+
+import click
+from collections import namedtuple
+from datetime import datetime
+from flask import make_response, request
+from flask.cli import AppGroup
+from functools import wraps
+from sqlalchemy import distinct, inspect, literal, select
+from hashlib import sha1
+import time
+
+catalog_cli = AppGroup('catalog', help='Manage the derived recipe catalog tables.')
+
+# A generation of the catalog. recipe_digests maps recipe_id to a content hash of that recipe.
+Catalog = namedtuple('Catalog', ['generation', 'catalog_digest', 'built_at', 'recipe_digests'])
+
+_cache = {'catalog': None, 'checked_at': None}
+
+
+def reset_table(table, connection):
+    """
+    Empties a derived table before it is rebuilt. The table is created if it does not exist yet, or dropped and
+    re-created if its columns have changed since it was last built.
+
+    :param table: an SQLAlchemy Table
+    :param connection: connection to run the statements on
+    """
+    existing_columns = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    if existing_columns == set(table.columns.keys()):
+        connection.execute(table.delete())
+    else:
+        table.drop(connection, checkfirst=True)
+        table.create(connection)
+
+
+def rebuild_catalog():
+    """
+    Rebuilds the derived catalog tables from the recipe tables, and stamps a new catalog generation. Worker processes
+    pick up the new generation within config.CATALOG_CHECK_INTERVAL seconds.
+
+    Every recipe is serialized and JSON-encoded once here, and stored in CatalogRecipes with a digest of its encoding,
+    so the API can serve full recipes without building them on each request. The full-text search index (see
+    app/search.py), RecipeNutrition, RecipeSummary and the similar recipes of each recipe (see app/similar.py) are
+    rebuilt, and the downloadable snapshots of the new generation are built too (see app/snapshot.py).
+
+    The catalog digest covers the recipes' encodings and config.CATALOG_FORMAT_VERSION, so a rebuild from unchanged
+    recipe tables keeps the ETags of responses made only from the recipes, but one after the way recipes are encoded
+    has changed does not. Responses made from the other derived tables (searches, similar recipes) are tagged with the
+    generation instead (see app/api/api_functions.py).
+
+    :return: the new Catalog
+    """
+    from app.api.api_functions import recipe_catalog_query, generate_chunks
+    from app.api.encoders import encode_json
+    from app.similar import rebuild_similar_recipes
+
+    connection = db.session.connection()
+    CatalogVersions.__table__.create(connection, checkfirst=True)
+    reset_table(CatalogRecipes.__table__, connection)
+    rebuild_search_index(connection)
+    rebuild_recipe_nutrition(connection)
+    rebuild_recipe_summary(connection)
+    reset_table(RecipeSimilarities.__table__, connection)
+    rebuild_similar_recipes(connection)
+
+    catalog_hash = sha1(f'format {config.CATALOG_FORMAT_VERSION}|'.encode())
+    for recipes in generate_chunks(recipe_catalog_query()):
+        rows = []
+        for recipe in recipes:
+            payload = encode_json(recipe.serialize)
+            rows.append({'recipe_id': recipe.recipe_id, 'digest': sha1(payload).hexdigest(), 'payload': payload})
+        db.session.bulk_insert_mappings(CatalogRecipes, rows)
+        for row in rows:
+            catalog_hash.update(row['digest'].encode())
+
+    last_generation = db.session.query(db.func.max(CatalogVersions.generation)).scalar() or 0
+    db.session.add(CatalogVersions(generation=last_generation + 1,
+                                   catalog_digest=catalog_hash.hexdigest(),
+                                   built_at=datetime.utcnow().replace(microsecond=0)))
+    db.session.commit()
+
+    catalog = current_catalog(refresh=True)
+    build_snapshots(catalog)
+    return catalog
+
+
+def rebuild_recipe_nutrition(connection):
+    """
+    Rebuilds RecipeNutrition from NutritionValues in one INSERT ... SELECT, working out the ratio of each nutrient to
+    calories (left NULL for recipes without calories).
+
+    :param connection: connection to run the statements on
+    """
+    reset_table(RecipeNutrition.__table__, connection)
+    nutrients = [nutrient for nutrient, label in config.NUTRIENT_CHOICES]
+    calories = db.func.nullif(NutritionValues.calories, 0)
+    columns = [NutritionValues.recipe_id, NutritionValues.calories] + \
+              [getattr(NutritionValues, nutrient) for nutrient in nutrients] + \
+              [getattr(NutritionValues, nutrient) * 1.0 / calories for nutrient in nutrients]
+    connection.execute(RecipeNutrition.__table__.insert().from_select(
+        ['recipe_id', 'calories'] + nutrients + [nutrient + '_per_kcal' for nutrient in nutrients], select(columns)))
+
+
+def rebuild_recipe_summary(connection):
+    """
+    Rebuilds RecipeSummary from Recipes, RecipeDietTypes, NutritionValues and RecipeAllergies in one INSERT ... SELECT.
+    The allergies of each recipe are summed into a bitmask, with the bit of each allergy added once.
+
+    :param connection: connection to run the statements on
+    """
+    reset_table(RecipeSummary.__table__, connection)
+    diet_type_id = select([db.func.max(RecipeDietTypes.diet_type_id)]) \
+        .where(RecipeDietTypes.recipe_id == Recipes.recipe_id) \
+        .as_scalar()
+    allergy_bit = literal(1).op('<<')(RecipeAllergies.allergy_id)
+    allergen_mask = select([db.func.coalesce(db.func.sum(distinct(allergy_bit)), 0)]) \
+        .where(RecipeAllergies.recipe_id == Recipes.recipe_id) \
+        .as_scalar()
+    summaries = select([Recipes.recipe_id, Recipes.recipe_name, Recipes.photo, Recipes.serves, Recipes.total_time,
+                        NutritionValues.calories, diet_type_id, allergen_mask]) \
+        .select_from(Recipes.__table__.outerjoin(NutritionValues, NutritionValues.recipe_id == Recipes.recipe_id))
+    connection.execute(RecipeSummary.__table__.insert().from_select(
+        ['recipe_id', 'recipe_name', 'photo', 'serves', 'total_time', 'calories', 'diet_type_id', 'allergen_mask'],
+        summaries))
+
+
+def current_catalog(refresh=False):
+    """
+    Returns the current catalog generation. The generation is cached in the process, and only re-checked against the
+    database every config.CATALOG_CHECK_INTERVAL seconds, so most requests do not touch the database at all. Recipe
+    digests are only re-read when the generation changes.
+
+    :param refresh: re-check the database now, regardless of when it was last checked
+    :return: the current Catalog, or None if the catalog has not been built
+    """
+    now = time.monotonic()
+    checked_at = _cache['checked_at']
+    if not refresh and checked_at is not None and now - checked_at < config.CATALOG_CHECK_INTERVAL:
+        return _cache['catalog']
+
+    version = db.session.query(CatalogVersions.generation, CatalogVersions.catalog_digest, CatalogVersions.built_at) \
+        .order_by(CatalogVersions.generation.desc()) \
+        .first()
+    catalog = _cache['catalog']
+    if version is None:
+        catalog = None
+    elif catalog is None or catalog.generation != version.generation:
+        recipe_digests = dict(db.session.query(CatalogRecipes.recipe_id, CatalogRecipes.digest))
+        catalog = Catalog(version.generation, version.catalog_digest, version.built_at, recipe_digests)
+
+    _cache['catalog'] = catalog
+    _cache['checked_at'] = now
+    return catalog
+
+
+def make_etag(*parts):
+    """
+    :return: an entity tag made from the given parts (e.g. a content digest and the request's query string)
+    """
+    return sha1('|'.join(map(str, parts)).encode()).hexdigest()[:32]
+
+
+def conditional(etag_function, cache_control):
+    """
+    If you decorate a view with this, responses carry a (weak) ETag, Last-Modified and Cache-Control header, and
+    conditional GETs whose If-None-Match/ If-Modified-Since still match the current catalog get an empty 304 response
+    without the view (and the database) being touched.
+
+    :param etag_function: called with the current Catalog and the view's keyword arguments, returns the entity tag for
+        the response, or None if the response should not be cached (e.g. an unknown recipe)
+    :param cache_control: value of the Cache-Control header
+    """
+
+    def decorator(func):
+
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            catalog = current_catalog()
+            etag = etag_function(catalog, **kwargs) if catalog is not None else None
+            if etag is None:
+                return func(*args, **kwargs)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = request.if_modified_since is not None and \
+                               request.if_modified_since >= catalog.built_at
+            response = make_response('', 304) if not_modified else make_response(func(*args, **kwargs))
+
+            if response.status_code in (200, 304):
+                response.set_etag(etag, weak=True)
+                response.last_modified = catalog.built_at
+                response.headers['Cache-Control'] = cache_control
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+@catalog_cli.command('snapshots')
+def snapshots_command():
+    """Build the downloadable snapshots of the current catalog generation, if they are not built yet."""
+    catalog = current_catalog(refresh=True)
+    if catalog is None:
+        raise click.ClickException('The catalog has not been built: run `flask catalog rebuild` first')
+    for artifact, path in build_snapshots(catalog).items():
+        click.echo(f"{artifact}: {path}")
+
+
+@catalog_cli.command('rebuild')
+def rebuild_command():
+    """Rebuild the derived catalog tables (run after db/create_db.py)."""
+    catalog = rebuild_catalog()
+    click.echo(f"Catalog rebuilt: generation {catalog.generation}, {len(catalog.recipe_digests)} recipes "
+               f"(digest {catalog.catalog_digest})")
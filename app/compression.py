@@ -0,0 +1,179 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/compression.py:
+
+This document includes response compression for the Mealtime application, including:
+- compress_response, which gzip/ brotli compresses dynamic API responses (JSON, MessagePack, CBOR) according to
+  Accept-Encoding
+- send_static_file, which serves static CSS/JS from precompressed .br/ .gz files when the client accepts them
+- the `flask static compress` command, which creates those precompressed files once, at build time
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+import brotli
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+import gzip
+import mimetypes
+import os
+import zlib
+
+static_cli = AppGroup('static', help='Manage static assets.')
+
+# File extension used for the precompressed copy of a static file, for each content coding
+ENCODING_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+
+def negotiate_encoding():
+    """
+    :return: the content coding to respond with, 'br' or 'gzip' (in that order of preference), or None if the client
+        accepts neither
+    """
+    for encoding in ENCODING_EXTENSIONS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level):
+    """
+    :param data: bytes to compress
+    :param encoding: 'br' or 'gzip'
+    :param level: compression level, from 1 (fastest) to 9 (smallest). Brotli qualities go up to 11, and level 9 is
+        mapped to 11.
+    :return: the compressed bytes
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if level >= 9 else level)
+    return gzip.compress(data, compresslevel=level)
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Generator which compresses a streamed response. Each chunk is flushed through the compressor as soon as it has
+    been compressed, so the client still receives data as it is produced.
+
+    :param chunks: iterable of bytes (the streamed response body)
+    :param encoding: 'br' or 'gzip'
+    :param level: compression level (see compress)
+    :return: a generator of compressed bytes
+    """
+    try:
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=level)
+            for chunk in chunks:
+                yield compressor.process(chunk) + compressor.flush()
+            yield compressor.finish()
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16 + : gzip header and trailer
+            for chunk in chunks:
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    """
+    after_request hook which compresses responses of the COMPRESS_MIMETYPES (JSON and other API formats) for clients
+    that accept it. HTML is left alone, because compressing pages which hold a CSRF token next to reflected user input
+    lets an attacker recover the token from the compressed sizes (BREACH). Responses smaller than COMPRESS_MIN_SIZE are
+    left alone too, as are files sent with send_file (static files are served precompressed by send_static_file
+    instead).
+
+    :param response: the response to compress
+    :return: the (possibly compressed) response
+    """
+    config = current_app.config
+    if response.mimetype not in config['COMPRESS_MIMETYPES'] or response.status_code != 200 \
+            or 'Content-Encoding' in response.headers or response.direct_passthrough:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, config['COMPRESS_LEVEL'])
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress(data, encoding, config['COMPRESS_LEVEL']))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def send_static_file(filename):
+    """
+    Replacement for Flask's static view. If the client accepts brotli or gzip, and `flask static compress` has created
+    a precompressed copy of the file, that copy is sent instead, so static files are never compressed per request. A
+    copy older than the file itself is stale (the file was changed after `flask static compress` was run), and is
+    ignored.
+
+    :param filename: path of the file within the static folder
+    :return: the static file response
+    """
+    static_folder = current_app.static_folder
+    encoding = negotiate_encoding()
+    if encoding is not None:
+        compressed_filename = filename + ENCODING_EXTENSIONS[encoding]
+        if is_fresh_copy(os.path.join(static_folder, compressed_filename), os.path.join(static_folder, filename)):
+            response = send_from_directory(static_folder, compressed_filename,
+                                           mimetype=mimetypes.guess_type(filename)[0],
+                                           cache_timeout=current_app.get_send_file_max_age(filename))
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return current_app.send_static_file(filename)
+
+
+def is_fresh_copy(compressed_path, path):
+    """
+    :param compressed_path: path of the precompressed copy of a static file
+    :param path: path of the static file
+    :return: True if both exist, and the copy was written no earlier than the file was last changed
+    """
+    try:
+        return os.path.getmtime(compressed_path) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def compress_static_files(static_folder, extensions):
+    """
+    Writes a .br and a .gz copy, compressed at the highest level, of every static file with one of the given extensions.
+
+    :param static_folder: the folder to compress files in (recursively)
+    :param extensions: file extensions to compress, e.g. ('.css', '.js')
+    :return: number of files compressed
+    """
+    compressed = 0
+    for folder, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            if not filename.endswith(tuple(extensions)):
+                continue
+            path = os.path.join(folder, filename)
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding, extension in ENCODING_EXTENSIONS.items():
+                with open(path + extension, 'wb') as f:
+                    f.write(compress(data, encoding, 9))
+            compressed += 1
+    return compressed
+
+
+@static_cli.command('compress')
+def compress_command():
+    """Precompress static CSS and JS files (run at build time)."""
+    compressed = compress_static_files(current_app.static_folder, current_app.config['COMPRESS_STATIC_EXTENSIONS'])
+    click.echo(f"Precompressed {compressed} static files")
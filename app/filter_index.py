@@ -0,0 +1,291 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/filter_index.py:
+
+This document includes the in-memory filter index, which answers the diet type, allergy, calorie, time and nutrient
+filters of recipe searches without querying the database, and counts the recipes each filter would leave (facets).
+Each worker process keeps one index, built from the RecipeSummary and RecipeNutrition tables, which is rebuilt when the
+catalog generation changes (see app/catalog.py). It includes:
+- FilterIndex, bitsets of the recipes of each diet level, every recipe's allergen bitmask, sorted calorie, time and
+  nutrient columns, and columns of every recipe's diet type, calories and time for facet counts
+- SortedColumn, a column of recipe values sorted for range lookups
+- allergen_mask, the bitmask of a user's allergies
+- filter_index, which returns the index for the current catalog generation
+- in_recipe_ids, an SQL filter restricting a query to a list of recipe ids, and recipe_ids_param
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.catalog import current_catalog
+from app.models import RecipeNutrition, RecipeSummary
+import config
+
+import json
+import numpy as np
+from sqlalchemy import Integer
+from sqlalchemy.sql import column, text
+
+_cache = {'index': None, 'generation': None}
+
+
+class SortedColumn(object):
+    """
+    Values of a recipe column (e.g. calories), sorted with the ids of their recipes, so that the recipes with values in
+    a range are found by binary search (searchsorted) and a slice, rather than by testing every recipe. Recipes without
+    a value are left out, so they are never in range, as in SQL.
+    """
+
+    def __init__(self, recipe_values):
+        """
+        :param recipe_values: (recipe_id, value) pairs
+        """
+        recipe_values = [(recipe_id, value) for recipe_id, value in recipe_values if value is not None]
+        recipe_ids = np.array([recipe_id for recipe_id, value in recipe_values], dtype=np.int64)
+        values = np.array([value for recipe_id, value in recipe_values], dtype=np.float64)
+        order = np.argsort(values, kind='stable')
+        self.values = values[order]
+        self.recipe_ids = recipe_ids[order]
+
+    def between(self, low=None, high=None):
+        """
+        :param low: smallest value in range, or None for no lower bound
+        :param high: largest value in range, or None for no upper bound
+        :return: ids of the recipes with values from low to high (inclusive), as a NumPy array
+        """
+        start = 0 if low is None else np.searchsorted(self.values, low, side='left')
+        end = len(self.values) if high is None else np.searchsorted(self.values, high, side='right')
+        return self.recipe_ids[start:end]
+
+
+class FilterIndex(object):
+    """
+    Bitsets of recipe ids, held as Python integers in which bit n is set if recipe n is in the set. Filtering a search
+    by diet type is then an AND of integers, whatever the size of the catalog. Each recipe's allergies are a bitmask
+    (as in RecipeSummary), held in a NumPy array indexed by recipe_id, so the recipes suiting a user's allergies are
+    those where (allergen_mask & user_mask) == 0, in one vectorized pass. Calorie, time and nutrient ranges are looked
+    up in sorted columns, and turned into bitsets to be combined with the others. For facet counts, each recipe's diet
+    type, calories and time are also held in NumPy arrays indexed by recipe_id.
+    """
+
+    def __init__(self, recipe_summaries, recipe_nutrients=None):
+        """
+        :param recipe_summaries: (recipe_id, diet_type_id, allergen_mask, calories, total_time) rows of every recipe,
+            as in RecipeSummary
+        :param recipe_nutrients: dictionary of (recipe_id, value) pairs for each of config.NUTRIENT_FILTERS
+        """
+        recipe_ids = [row[0] for row in recipe_summaries]
+        self.size = max(recipe_ids, default=-1) + 1
+        self.recipes = self.to_bitset(recipe_ids)
+        self.present = self.to_mask(recipe_ids)
+
+        self.recipe_diet_types = np.zeros(self.size, dtype=np.int64)  # 0 for recipes without a diet type
+        self.allergy_masks = np.zeros(self.size, dtype=np.int64)  # Bit n is set if the recipe has allergy n
+        self.recipe_calories = np.full(self.size, np.nan)  # NaN for recipes without calories (never in range)
+        self.recipe_total_times = np.full(self.size, np.nan)
+        for recipe_id, diet_type_id, mask, calories, total_time in recipe_summaries:
+            self.recipe_diet_types[recipe_id] = diet_type_id or 0
+            self.allergy_masks[recipe_id] = mask
+            if calories is not None:
+                self.recipe_calories[recipe_id] = calories
+            if total_time is not None:
+                self.recipe_total_times[recipe_id] = total_time
+
+        # Diet types are levels (classic, pescatarian, vegetarian, vegan), and a search for one level finds recipes of
+        # that level or above. So the bitset of each level holds the recipes of that level and all the levels above.
+        self.diet_levels = {int(diet_type_id): self.to_bitset(np.flatnonzero(self.recipe_diet_types >= diet_type_id))
+                            for diet_type_id in np.unique(self.recipe_diet_types) if diet_type_id > 0}
+
+        self.calories = SortedColumn((row[0], row[3]) for row in recipe_summaries)
+        self.total_times = SortedColumn((row[0], row[4]) for row in recipe_summaries)
+        self.nutrients = {nutrient: SortedColumn(values) for nutrient, values in (recipe_nutrients or {}).items()}
+
+    @classmethod
+    def build(cls):
+        """
+        :return: a FilterIndex of the RecipeSummary table (read from its covering search index), with the nutrients
+            and nutrient to calorie ratios of RecipeNutrition
+        """
+        recipe_summaries = db.session.query(RecipeSummary.recipe_id, RecipeSummary.diet_type_id,
+                                            RecipeSummary.allergen_mask, RecipeSummary.calories,
+                                            RecipeSummary.total_time).all()
+        nutrient_columns = [getattr(RecipeNutrition, nutrient) for nutrient in config.NUTRIENT_FILTERS]
+        nutrition = db.session.query(RecipeNutrition.recipe_id, *nutrient_columns).all()
+        recipe_nutrients = {nutrient: [(row.recipe_id, getattr(row, nutrient)) for row in nutrition]
+                            for nutrient in config.NUTRIENT_FILTERS}
+        return cls(recipe_summaries, recipe_nutrients)
+
+    def to_bitset(self, recipe_ids):
+        """
+        :param recipe_ids: a list (or NumPy array) of recipe ids
+        :return: the bitset of the recipe ids
+        """
+        return int.from_bytes(np.packbits(self.to_mask(recipe_ids), bitorder='little').tobytes(), 'little')
+
+    def recipe_ids(self, bitset):
+        """
+        :param bitset: a bitset of recipe ids
+        :return: the recipe ids in the bitset, in ascending order (as a NumPy array)
+        """
+        bits = np.frombuffer(bitset.to_bytes((self.size + 7) // 8, 'little'), dtype=np.uint8)
+        return np.flatnonzero(np.unpackbits(bits, bitorder='little'))
+
+    def eligible(self, diet_type=1, allergy_list=()):
+        """
+        Works out which recipes suit a diet type and a list of allergies, as search_function would.
+
+        :param diet_type: specified diet type
+        :param allergy_list: list of allergies
+        :return: bitset of the recipes of the diet type (or above) which have none of the allergies
+        """
+        levels = [level for level in sorted(self.diet_levels) if level >= diet_type]
+        recipes = self.diet_levels[levels[0]] if levels else 0
+        user_mask = allergen_mask(allergy_list)
+        if recipes and user_mask:
+            recipes &= ~self.to_bitset(np.flatnonzero(self.allergy_masks & user_mask))
+        return recipes
+
+    def matching(self, diet_type=1, allergy_list=(), min_cal=0, max_cal=1000, time=99999, nutrient_ranges=None):
+        """
+        Works out which recipes pass all the filters of search_function (that is, everything but the search term).
+
+        :param diet_type: specified diet type
+        :param allergy_list: list of allergies
+        :param min_cal: minimum calorie
+        :param max_cal: maximum calorie
+        :param time: maximum time that user wants to prep+cook for
+        :param nutrient_ranges: dictionary of (low, high) ranges of any of config.NUTRIENT_FILTERS, where None is no
+            bound (e.g. {'proteins': (30, None), 'salts': (None, 1)})
+        :return: bitset of the recipes passing the filters
+        """
+        recipes = self.eligible(diet_type, allergy_list)
+        if recipes:
+            recipes &= self.to_bitset(self.calories.between(min_cal, max_cal))
+        if recipes:
+            recipes &= self.to_bitset(self.total_times.between(high=time))
+        for nutrient, (low, high) in (nutrient_ranges or {}).items():
+            if recipes:
+                recipes &= self.to_bitset(self.nutrients[nutrient].between(low, high))
+        return recipes
+
+    def to_mask(self, recipe_ids):
+        """
+        :param recipe_ids: a list (or NumPy array) of recipe ids
+        :return: boolean NumPy array indexed by recipe_id, True for the recipe ids
+        """
+        mask = np.zeros(self.size, dtype=bool)
+        mask[np.asarray(recipe_ids, dtype=np.int64)] = True
+        return mask
+
+    def facets(self, diet_type=1, allergy_list=(), min_cal=0, max_cal=1000, time=99999, nutrient_ranges=None,
+               recipe_ids=None):
+        """
+        Counts the recipes a search would find, and how many it would find if each filter were changed: with each diet
+        type, with each allergy also excluded, with its calories in each of config.FACET_CALORIE_BUCKETS (both ends of
+        each range included, as the calorie filter does) and with each of config.FACET_TIME_BUCKETS as the maximum
+        time. As usual for facets, the counts for a filter apply all the other filters but that one. Each filter is one
+        vectorized comparison over the recipe columns, and the counts are a few sums over the results, so no query is
+        made.
+
+        :param diet_type: specified diet type
+        :param allergy_list: list of allergies
+        :param min_cal: minimum calorie
+        :param max_cal: maximum calorie
+        :param time: maximum time that user wants to prep+cook for
+        :param nutrient_ranges: dictionary of (low, high) ranges of nutrients, as for matching
+        :param recipe_ids: ids of the recipes matching the search term, or None if there is no search term
+        :return: a dictionary of the number of recipes found ('total'), and of 'diet_types' and 'allergies' (mapping
+            ids to counts), 'calories' (a count for each calorie bucket) and 'time' (a count for each maximum time)
+        """
+        base = self.present.copy()
+        if recipe_ids is not None:
+            base &= self.to_mask(recipe_ids)
+        for nutrient, (low, high) in (nutrient_ranges or {}).items():
+            base &= self.to_mask(self.nutrients[nutrient].between(low, high))
+
+        user_mask = allergen_mask(allergy_list)
+        with np.errstate(invalid='ignore'):  # Comparisons with NaN (no calories or time) are False, as wanted
+            diet_ok = self.recipe_diet_types >= diet_type
+            allergy_ok = (self.allergy_masks & user_mask) == 0
+            calories_ok = (self.recipe_calories >= min_cal) & (self.recipe_calories <= max_cal)
+            time_ok = self.recipe_total_times <= time
+
+        not_diet = base & allergy_ok & calories_ok & time_ok
+        found = not_diet & diet_ok
+        not_calories = base & diet_ok & allergy_ok & time_ok
+        not_time = base & diet_ok & allergy_ok & calories_ok
+
+        # A diet type finds the recipes of that level or above (see __init__)
+        level_counts = np.bincount(self.recipe_diet_types[not_diet], minlength=len(config.DIET_CHOICES) + 1)
+        diet_counts = np.cumsum(level_counts[::-1])[::-1]
+        allergy_ids = np.array([allergy_id for allergy_id, label in config.ALLERGY_CHOICES], dtype=np.int64)
+        with_allergy = ((self.allergy_masks[found][:, np.newaxis] >> allergy_ids) & 1).sum(axis=0)
+        # Each calorie range is counted with both ends included, as the min_cal and max_cal filters do, so a recipe on
+        # an edge is counted in both ranges it would be found by (NaNs sort last, so are in no range)
+        calories = np.sort(self.recipe_calories[not_calories])
+        edges = config.FACET_CALORIE_BUCKETS
+        calorie_counts = np.searchsorted(calories, edges[1:], side='right') - \
+            np.searchsorted(calories, edges[:-1], side='left')
+        times = np.sort(self.recipe_total_times[not_time])
+
+        total = int(found.sum())
+        return {'total': total,
+                'diet_types': {diet_type_id: int(diet_counts[diet_type_id])
+                               for diet_type_id, label in config.DIET_CHOICES},
+                'allergies': {int(allergy_id): total - int(count)
+                              for allergy_id, count in zip(allergy_ids, with_allergy)},
+                'calories': [int(count) for count in calorie_counts],
+                'time': [int(count) for count in np.searchsorted(times, config.FACET_TIME_BUCKETS, side='right')]}
+
+
+def allergen_mask(allergy_ids):
+    """
+    :param allergy_ids: a list of allergy ids
+    :return: the bitmask of the allergies, as in RecipeSummary.allergen_mask. Allergy ids which do not fit in the 63
+        bits of the mask are left out, as no recipe can have them.
+    """
+    return sum(1 << allergy_id for allergy_id in set(allergy_ids) if 0 <= allergy_id < 63)
+
+
+def filter_index():
+    """
+    Returns the filter index of this worker process, first building it if the catalog generation has changed since it
+    was last built. How often the generation is checked is set by config.CATALOG_CHECK_INTERVAL (see current_catalog).
+
+    :return: the FilterIndex for the current catalog generation
+    """
+    catalog = current_catalog()
+    generation = catalog.generation if catalog is not None else None
+    index = _cache['index']
+    if index is None or _cache['generation'] != generation:
+        index = FilterIndex.build()
+        _cache['index'], _cache['generation'] = index, generation
+    return index
+
+
+def in_recipe_ids(recipe_id, recipe_ids=None):
+    """
+    Restricts a query to a list of recipe ids. The ids are bound as a single JSON array parameter, read back with
+    SQLite's json_each, so the statement is the same whatever the number of ids (rather than one parameter per id, which
+    would run into SQLite's limit on the number of parameters).
+
+    :param recipe_id: the recipe_id column to filter on
+    :param recipe_ids: a list of recipe ids, or None to bind them when the query is run, as the recipe_ids parameter
+        (see recipe_ids_param)
+    :return: an SQL filter expression
+    """
+    ids = text('SELECT value FROM json_each(:recipe_ids)')
+    if recipe_ids is not None:
+        ids = ids.bindparams(recipe_ids=recipe_ids_param(recipe_ids))
+    return recipe_id.in_(ids.columns(column('value', Integer)))
+
+
+def recipe_ids_param(recipe_ids):
+    """
+    :param recipe_ids: a list (or NumPy array) of recipe ids
+    :return: the value of the recipe_ids parameter of in_recipe_ids
+    """
+    return json.dumps(list(map(int, recipe_ids)))
@@ -0,0 +1,160 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/fuzzy.py:
+
+This document includes the typo-tolerant fallback of recipe searches. When a search term finds too few recipes, its
+words are matched against the words used in recipe names and ingredients with a trigram index, and the search is
+retried with the closest words (e.g. "lasagna" is also searched as "lasagne", and "chick pea" as "chickpea"). Each
+worker process keeps one index, which is rebuilt when the catalog generation changes (see app/catalog.py). It includes:
+- trigrams
+- FuzzyIndex, a trigram index of the catalog's vocabulary
+- fuzzy_index, which returns the index for the current catalog generation
+- fuzzy_query, which turns a search term into a typo-tolerant FTS5 query
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.catalog import current_catalog
+from app.models import Recipes, RecipeIngredients
+import config
+
+from collections import Counter, defaultdict
+import re
+
+_cache = {'index': None, 'generation': None}
+
+WORD = re.compile(r'[^\W\d_]{2,}')  # Words of two or more letters (leaving out quantities, such as "200g")
+
+
+def trigrams(word):
+    """
+    :return: the set of three letter sequences in a word, padded so that its first and last letters count most (as in
+        PostgreSQL's pg_trgm)
+    """
+    padded = '  ' + word + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FuzzyIndex(object):
+    """
+    Trigram index of the vocabulary of the recipe catalog: the distinct words of recipe names and ingredients. Each
+    trigram has a posting list of the words containing it, so the words similar to a misspelt word are found by
+    counting trigrams shared through the misspelt word's posting lists, without comparing it to every word.
+    """
+
+    def __init__(self, texts):
+        """
+        :param texts: recipe names and ingredients
+        """
+        self.words = sorted({word for text in texts for word in WORD.findall(text.lower())})
+        self.vocabulary = set(self.words)
+        self.word_trigrams = [len(trigrams(word)) for word in self.words]
+        postings = defaultdict(list)
+        for i, word in enumerate(self.words):
+            for trigram in trigrams(word):
+                postings[trigram].append(i)
+        self.postings = dict(postings)
+
+    @classmethod
+    def build(cls):
+        """
+        :return: a FuzzyIndex of the recipe names and ingredients
+        """
+        texts = [text for text, in db.session.query(Recipes.recipe_name)]
+        texts += [text for text, in db.session.query(RecipeIngredients.ingredient)]
+        return cls(texts)
+
+    def similar_words(self, word, limit=config.FUZZY_MAX_WORDS):
+        """
+        :param word: a word of a search term
+        :param limit: the most similar words to return
+        :return: the words of the vocabulary most similar to word, most similar first. Similarity is the Jaccard index
+            of the words' trigrams, and must be at least config.FUZZY_MIN_SIMILARITY.
+        """
+        word_trigrams = trigrams(word)
+        shared = Counter()
+        for trigram in word_trigrams:
+            shared.update(self.postings.get(trigram, ()))
+        scores = []
+        for i, count in shared.items():
+            similarity = count / (len(word_trigrams) + self.word_trigrams[i] - count)
+            if similarity >= config.FUZZY_MIN_SIMILARITY and self.words[i] != word:
+                scores.append((-similarity, self.words[i]))
+        return [similar_word for score, similar_word in sorted(scores)[:limit]]
+
+    def alternatives(self, words):
+        """
+        Works out the alternatives of each word of a search term: the word itself and, if the word is not in the
+        vocabulary, similar words and the words of the vocabulary that it splits into. A word which makes a word of the
+        vocabulary when joined with the next word of the term can also be searched as that word.
+
+        :param words: the words of a search term
+        :return: list of alternatives for each group of words, where an alternative is a tuple of words
+        """
+        groups = []
+        i = 0
+        while i < len(words):
+            word = words[i]
+            joined = word + words[i + 1] if i + 1 < len(words) else None
+            if joined in self.vocabulary:
+                # e.g. "chick pea" is also searched as "chickpea"
+                groups.append([(word, words[i + 1]), (joined,)])
+                i += 2
+                continue
+
+            group = [(word,)]
+            if word not in self.vocabulary:
+                # e.g. "lasagna" is also searched as "lasagne", and "chickpeas" as "chick peas"
+                group += [(similar_word,) for similar_word in self.similar_words(word)]
+                group += [(word[:n], word[n:]) for n in range(2, len(word) - 1)
+                          if word[:n] in self.vocabulary and word[n:] in self.vocabulary][:config.FUZZY_MAX_WORDS]
+            groups.append(group)
+            i += 1
+        return groups
+
+
+def fuzzy_index():
+    """
+    Returns the fuzzy search index of this worker process, first building it if the catalog generation has changed
+    since it was last built. How often the generation is checked is set by config.CATALOG_CHECK_INTERVAL (see
+    current_catalog).
+
+    :return: the FuzzyIndex for the current catalog generation
+    """
+    catalog = current_catalog()
+    generation = catalog.generation if catalog is not None else None
+    index = _cache['index']
+    if index is None or _cache['generation'] != generation:
+        index = FuzzyIndex.build()
+        _cache['index'], _cache['generation'] = index, generation
+    return index
+
+
+def fuzzy_query(search_term):
+    """
+    Turns a search term into a typo-tolerant FTS5 query, which matches recipes containing, for every word of the term,
+    either the word or one of its alternatives (see FuzzyIndex.alternatives). As in fts_query, the last word of the
+    term is also matched as a prefix.
+
+    :param search_term: search term typed by the user
+    :return: an FTS5 query, or None if none of the words of the term have alternatives
+    """
+    groups = fuzzy_index().alternatives(re.findall(r'\w+', search_term.lower()))
+    if all(len(group) == 1 for group in groups):
+        return None
+    words = [word for group in groups for word in group[0]]
+
+    clauses = []
+    for group_number, group in enumerate(groups):
+        options = []
+        for alternative in group:
+            phrase = ' AND '.join(f'"{word}"' for word in alternative)
+            options.append(f'({phrase})' if len(alternative) > 1 else phrase)
+        if group_number == len(groups) - 1 and group[0] == (words[-1],):
+            options[0] += '*'
+        clauses.append('(' + ' OR '.join(options) + ')')
+    return ' AND '.join(clauses)
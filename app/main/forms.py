@@ -14,10 +14,12 @@ __status__ = "Development"
 import config
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, SelectMultipleField, HiddenField
+from wtforms import StringField, SelectField, SelectMultipleField, HiddenField, FloatField
+from wtforms.validators import Optional
 
 DIET_CHOICES = config.DIET_CHOICES
 ALLERGY_CHOICES = config.ALLERGY_CHOICES
+SORT_CHOICES = config.SORT_CHOICES
 
 
 class AdvSearchRecipes(FlaskForm):
@@ -31,3 +33,10 @@ class AdvSearchRecipes(FlaskForm):
     max_time = HiddenField()  # Field for max cooking time
 
     allergies = SelectMultipleField('Allergies (cmd/ctrl + click to select multiple)', choices=ALLERGY_CHOICES)
+    sort = SelectField('Sort by', choices=SORT_CHOICES, default='')
+
+
+# Optional minimum and maximum of each nutrient, named as search_args reads them (e.g. min_proteins, max_salts)
+for nutrient, label in config.NUTRIENT_CHOICES:
+    setattr(AdvSearchRecipes, 'min_' + nutrient, FloatField(f'Min {label.lower()} (g)', validators=[Optional()]))
+    setattr(AdvSearchRecipes, 'max_' + nutrient, FloatField(f'Max {label.lower()} (g)', validators=[Optional()]))
@@ -4,9 +4,12 @@
 app/auth/main_functions.py:
 
 This document includes functions that assists the main routes, including:
-- search_function
+- search_function, search_query (its baked query), nutrient_ranges and search_args
+- search_result_ids, a per-process cache of search results, and paginate_ids
+- paginate_query, pagination without counting every row
 - get_most_recent_mealplan_id
 - check_user_owns_mealplan decorator
+- view_recipe_etag
 """
 __authors__ = "Danny Wallis, Justin Wong"
 __email__ = "justin.wong.17@ucl.ac.uk"
@@ -14,46 +17,249 @@ __credits__ = ["Ethan Low", "Danny Wallis", "Justin Wong"]
 __status__ = "Development"
 
 from app import db
-from app.models import Recipes, RecipeAllergies, RecipeDietTypes, NutritionValues, MealPlans
+from app.cache import MISSING, TTLCache
+from app.catalog import current_catalog, make_etag
+from app.filter_index import filter_index, in_recipe_ids, recipe_ids_param
+from app.fuzzy import fuzzy_query
+from app.models import Recipes, MealPlans, RecipeNutrition, RecipeSummary
+from app.search import fts_query, search_matches
+import config
 
-from flask import flash, redirect, url_for
+from flask import flash, redirect, request, session, url_for
 from flask_login import current_user
+from flask_sqlalchemy import Pagination
 from functools import wraps
-from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
 from sqlalchemy.sql import func
 
+# The named parameters of search_function, besides which it only takes nutrient bounds
+SEARCH_PARAMETERS = ('search_term', 'diet_type', 'allergy_list', 'min_cal', 'max_cal', 'time', 'sort')
 
-def search_function(search_term="", diet_type=1, allergy_list=[], min_cal=0, max_cal=1000, time=99999):
+
+def search_function(search_term="", diet_type=1, allergy_list=[], min_cal=0, max_cal=1000, time=99999, sort="",
+                    **nutrient_bounds):
     """
-    This function accepts 5 parameters to find appropriate recipes according to user input (or default values)
+    This function accepts 5 parameters to find appropriate recipes according to user input (or default values), as
+    well as bounds on any nutrient and a sort order
 
-    The search function is used by view_all_recipes, a simple search, and advanced_search.
+    The search function is used by view_all_recipes, a simple search, and advanced_search. The search term is matched
+    against recipe names, ingredients and instructions with the full-text search index (see app/search.py), and
+    matching recipes are ordered by relevance, unless a sort order is given. Searches which find fewer than
+    config.FUZZY_MIN_RESULTS recipes are retried allowing for typos.
 
-    :param search_term: search term for recipe name
+    :param search_term: search term for recipe name, ingredients and instructions
     :param diet_type: specified diet type
     :param allergy_list: list of allergies
     :param min_cal: minimum calorie
     :param max_cal: maximum calorie
     :param time: maximum time that user wants to prep+cook for
-    :return: an SQLAlchemy query of recipes matching the above parameters
+    :param sort: one of config.NUTRIENT_SORTS to sort by (e.g. 'calories'), with '-' in front to sort in descending
+        order (e.g. '-proteins_per_kcal'), or "" to sort by relevance
+    :param nutrient_bounds: min_<nutrient> and max_<nutrient> bounds of any of config.NUTRIENT_FILTERS (e.g.
+        min_proteins=30, max_salts=1)
+    :return: the results of a baked query of recipes matching the above parameters (see search_query), which can be
+        iterated over or counted
+    :raises ValueError: if sort is not one of config.NUTRIENT_SORTS
+    """
+    return search_query(Recipes, search_term, diet_type, allergy_list, min_cal, max_cal, time, sort, **nutrient_bounds)
+
+
+# Baked search queries, one for each shape of search (see search_query)
+_search_bakery = baked.bakery(config.SEARCH_QUERY_CACHE_SIZE)
+
+
+def search_query(entity, search_term="", diet_type=1, allergy_list=(), min_cal=0, max_cal=1000, time=99999, sort="",
+                 **nutrient_bounds):
+    """
+    Runs search_function for any entity (e.g. Recipes.recipe_id, for the ids alone). The query is baked: it is only
+    built and compiled to SQL the first time a search of its shape is made, where the shape is the entity, whether the
+    recipes are restricted by the filter index, the sort order and whether there is a search term. Later searches of
+    that shape look up the compiled statement, and only bind their own parameters: the recipe ids passing the filters
+    and the FTS5 query.
+
+    :param entity: what to query (e.g. Recipes)
+    :return: the results of the baked query, which can be iterated over or counted
+    :raises ValueError: if sort is not one of config.NUTRIENT_SORTS
+    """
+    params = {}
+    results = _search_bakery(lambda session: session.query(entity), entity)
+
+    # Diet type, allergies, calories, time and nutrients: the recipes which pass these filters are looked up in the
+    # in-memory filter index (see app/filter_index.py), and only those recipes are queried, unless every recipe passes
+    index = filter_index()
+    candidates = index.matching(diet_type, allergy_list, min_cal, max_cal, time, nutrient_ranges(nutrient_bounds))
+    if candidates != index.recipes:
+        results += lambda q: q.filter(in_recipe_ids(Recipes.recipe_id))
+        params['recipe_ids'] = recipe_ids_param(index.recipe_ids(candidates))
+
+    # Sorting by a nutrient (or nutrient to calorie ratio) reads the indexed column of RecipeNutrition
+    if sort:
+        descending = sort.startswith('-')
+        if sort[descending:] not in config.NUTRIENT_SORTS:
+            raise ValueError('Cannot sort by ' + sort)
+        sort_column = getattr(RecipeNutrition, sort[descending:])
+        order = sort_column.desc().nullslast() if descending else sort_column.asc().nullslast()
+        results.add_criteria(lambda q: q.join(RecipeNutrition, RecipeNutrition.recipe_id == Recipes.recipe_id)
+                             .order_by(order), sort)
+
+    # Full-text search: keep only the recipes matching the search term, best matches first. If too few recipes match,
+    # the search is made again allowing for typos (see app/fuzzy.py), which only changes the FTS5 query bound.
+    query = fts_query(search_term)
+    if query is not None:
+        def ranked(q):
+            matches = search_matches(bindparam('search_query'))
+            return q.join(matches, Recipes.recipe_id == matches.c.recipe_id).order_by(matches.c.rank)
+
+        results += ranked
+        params['search_query'] = query
+    results += lambda q: q.order_by(Recipes.recipe_id)
+
+    if query is not None:
+        few_results = results.with_criteria(lambda q: q.limit(config.FUZZY_MIN_RESULTS))
+        if few_results(db.session()).params(params).count() < config.FUZZY_MIN_RESULTS:
+            query = fuzzy_query(search_term)
+            if query is not None:
+                params['search_query'] = query
+    return results(db.session()).params(params)
+
+
+def nutrient_ranges(args_dict):
+    """
+    Collects the nutrient bounds of search_function keyword arguments (e.g. min_proteins=30, max_salts=1) into ranges.
+
+    :param args_dict: keyword arguments for search_function
+    :return: dictionary of (low, high) ranges of nutrients, where None is no bound (e.g. {'proteins': (30, None)})
+    :raises TypeError: if an argument is neither a search_function parameter nor a bound of config.NUTRIENT_FILTERS
+    """
+    ranges = {}
+    for key, value in args_dict.items():
+        if key in SEARCH_PARAMETERS:
+            continue
+        bound, _, nutrient = key.partition('_')
+        if bound not in ('min', 'max') or nutrient not in config.NUTRIENT_FILTERS:
+            raise TypeError(f"search_function() got an unexpected keyword argument '{key}'")
+        low, high = ranges.get(nutrient, (None, None))
+        ranges[nutrient] = (value, high) if bound == 'min' else (low, value)
+    return ranges
+
+
+def search_args():
+    """
+    Reads the search_function parameters from the query string, as passed on by the search and advanced_search routes
+    (or by API clients). Missing parameters take the same defaults as search_function, and nutrient bounds (e.g.
+    ?min_proteins=30&max_salts=1) are only included when given.
+
+    :return: a dictionary of keyword arguments for search_function
+    :raises ValueError: if allergy_list is not a comma-separated list of integers, or sort is not a sort order that
+        search_function accepts
+    """
+    args_dict = {'search_term': request.args.get('search_term', ""),
+                 # Parse string allergies into an integer list, because you can't pass entire lists as parameters.
+                 # request.args.get therefore is taking in a string (i.e. not [1, 4, 10], but "1,4,10")
+                 # Split this string by ",", then map the values into integers and turn this into a list
+                 'allergy_list': [] if (
+                         (request.args.get('allergy_list') is None) or
+                         (request.args.get('allergy_list') == ''))
+                 else list(map(int, request.args.get('allergy_list').split(","))),
+                 'diet_type': request.args.get('diet_type', 1, type=int),
+                 'min_cal': request.args.get('min_cal', 0, type=int),
+                 'max_cal': request.args.get('max_cal', 1000, type=int),
+                 'time': request.args.get('time', 99999, type=int),  # Default time to 99999
+                 'sort': request.args.get('sort', "")}
+    if args_dict['sort'] and args_dict['sort'][args_dict['sort'].startswith('-'):] not in config.NUTRIENT_SORTS:
+        raise ValueError('Cannot sort by ' + args_dict['sort'])
+    for nutrient in config.NUTRIENT_FILTERS:
+        for bound in ('min', 'max'):
+            value = request.args.get(f'{bound}_{nutrient}', type=float)
+            if value is not None:
+                args_dict[f'{bound}_{nutrient}'] = value
+    return args_dict
+
+
+_search_results = TTLCache(config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL)
+
+
+def search_cache_key(args_dict):
+    """
+    Normalizes search_function parameters, so that searches which find the same recipes share a cache entry (e.g.
+    "Fried  Rice" and "fried rice", or allergies given in a different order). The catalog generation is part of the key,
+    so results cached before the catalog was rebuilt are never used again.
+
+    :param args_dict: keyword arguments for search_function
+    :return: a hashable cache key
+    """
+    catalog = current_catalog()
+    return (catalog.generation if catalog is not None else None,
+            fts_query(args_dict.get('search_term', "")),
+            args_dict.get('diet_type', 1),
+            tuple(sorted(set(args_dict.get('allergy_list', [])))),
+            args_dict.get('min_cal', 0),
+            args_dict.get('max_cal', 1000),
+            args_dict.get('time', 99999),
+            args_dict.get('sort', ""),
+            tuple(sorted(nutrient_ranges(args_dict).items())))
+
+
+def search_result_ids(args_dict):
+    """
+    Runs search_function for the ids of all the recipes it finds, in order. The ids are cached for
+    config.SEARCH_CACHE_TTL seconds, so that paging through results, or other users making the same search (e.g.
+    view_all_recipes with the same diet type and allergies), do not run the search again.
+
+    :param args_dict: keyword arguments for search_function
+    :return: a tuple of the recipe ids found
+    """
+    key = search_cache_key(args_dict)
+    recipe_ids = _search_results.get(key)
+    if recipe_ids is MISSING:
+        recipe_ids = tuple(recipe_id for recipe_id, in search_query(Recipes.recipe_id, **args_dict))
+        _search_results.set(key, recipe_ids)
+    return recipe_ids
+
+
+def search_cache_stats():
+    """
+    :return: the number of search results cached in this process, and the cache's hits and misses
     """
-    # Subquery: blacklist recipes if user has certain allergies
-    blacklist = db.session.query(RecipeAllergies.recipe_id) \
-        .filter(RecipeAllergies.allergy_id.in_(allergy_list)).distinct().subquery()
+    return _search_results.stats()
 
-    # Filter allergies with a left outer join on blacklist, so that blacklisted recipes are not matched
-    results = db.session.query(Recipes) \
-        .outerjoin(blacklist, Recipes.recipe_id == blacklist.c.recipe_id) \
-        .filter(blacklist.c.recipe_id == None) \
-        .join(RecipeDietTypes, Recipes.recipe_id == RecipeDietTypes.recipe_id) \
-        .join(NutritionValues, Recipes.recipe_id == NutritionValues.recipe_id) \
-        .filter(RecipeDietTypes.diet_type_id >= diet_type) \
-        .filter(Recipes.recipe_name.contains(search_term)) \
-        .filter(and_(NutritionValues.calories >= min_cal,
-                     NutritionValues.calories <= max_cal)) \
-        .filter(Recipes.total_time <= time)
 
-    return results
+def paginate_ids(recipe_ids, page, per_page):
+    """
+    Paginates a list of recipe ids, as Query.paginate would paginate a query of recipes (with error_out=False). Only the
+    recipes on the page are loaded, from RecipeSummary, which holds everything the recipe cards show.
+
+    :param recipe_ids: list of all the recipe ids, in order
+    :param page: page number, starting from 1
+    :param per_page: number of recipes per page
+    :return: a Flask-SQLAlchemy Pagination of the RecipeSummary rows of the recipes on the page
+    """
+    page = max(page, 1)
+    page_ids = recipe_ids[(page - 1) * per_page:page * per_page]
+    recipes = {recipe.recipe_id: recipe for recipe in db.session.query(RecipeSummary)
+               .filter(RecipeSummary.recipe_id.in_(page_ids))} if page_ids else {}
+    items = [recipes[recipe_id] for recipe_id in page_ids if recipe_id in recipes]
+    return Pagination(None, page, per_page, len(recipe_ids), items)
+
+
+def paginate_query(query, page, per_page):
+    """
+    Paginates a query as Query.paginate would (with error_out=False), but without its COUNT(*) over the whole query.
+    One extra row is fetched to find out whether there is a next page, and the total is estimated from that: it is only
+    exact on the last page, so it should not be displayed.
+
+    :param query: an SQLAlchemy query
+    :param page: page number, starting from 1
+    :param per_page: number of rows per page
+    :return: a Flask-SQLAlchemy Pagination of the rows on the page
+    """
+    page = max(page, 1)
+    items = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    if len(items) > per_page:
+        # At least one more row, so one more page (the Pagination works out has_next and next_num from the total)
+        return Pagination(None, page, per_page, page * per_page + 1, items[:per_page])
+    return Pagination(None, page, per_page, (page - 1) * per_page + len(items), items)
 
 
 def get_most_recent_mealplan_id():
@@ -94,3 +300,21 @@ def check_user_owns_mealplan(func):
             return redirect(url_for('main.mealplans_history'))
 
     return decorated_function
+
+
+def view_recipe_etag(catalog, recipe_id):
+    """
+    Entity tag for the view_recipe page. The page shows the logged-in user's details, so the tag depends on the user
+    as well as the recipe's content digest, and it shows similar recipes, which may change with any rebuild of the
+    catalog, so it depends on the catalog generation too.
+
+    :param catalog: the current Catalog (see app/catalog.py)
+    :param recipe_id: recipe_id from the route
+    :return: an entity tag, or None if the page should not be cached
+    """
+    if '_flashes' in session:  # Flashed messages are waiting to be shown, so the page has to be rendered
+        return None
+    digest = catalog.recipe_digests.get(int(recipe_id)) if recipe_id.isdigit() else None
+    if digest is None:
+        return None
+    return make_etag(digest, catalog.generation, current_user.get_id())
@@ -12,14 +12,19 @@ __credits__ = ["Ethan Low", "Danny Wallis", "Justin Wong"]
 __status__ = "Development"
 
 from app import db
+from app.catalog import conditional
 from app.main.forms import AdvSearchRecipes
-from app.models import Recipes, RecipeIngredients, UserFavouriteRecipes, MealPlanRecipes, MealPlans
-from app.main.main_functions import search_function, check_user_owns_mealplan, get_most_recent_mealplan_id
+from app.models import Recipes, RecipeIngredients, RecipeSummary, UserFavouriteRecipes, MealPlanRecipes, MealPlans
+from app.main.main_functions import check_user_owns_mealplan, get_most_recent_mealplan_id, view_recipe_etag, \
+    search_args, search_result_ids, paginate_ids, paginate_query
 from app.main.email import send_grocery_list_email
+from app.filter_index import filter_index
+from app.pantry import parse_pantry, pantry_index
+from app.similar import similar_recipes
 import config
 
 from datetime import datetime
-from flask import render_template, Blueprint, request, flash, redirect, url_for, session, make_response
+from flask import render_template, Blueprint, request, flash, redirect, url_for, session, make_response, abort
 from flask_login import current_user, login_required
 from flask_wtf.csrf import CSRFError
 from markupsafe import escape
@@ -52,6 +57,7 @@ def index(name=""):
 
 
 @bp_main.route('/recipe/<recipe_id>', methods=['GET'])
+@conditional(view_recipe_etag, config.PAGE_CACHE_CONTROL)
 def view_recipe(recipe_id):
     """
     Page which shows details for specific recipes
@@ -65,9 +71,10 @@ def view_recipe(recipe_id):
     allergies = recipe.allergies
     ingredients = recipe.ingredients
     steps = recipe.instructions
+    similar = similar_recipes(recipe.recipe_id)  # "More like this", precomputed when the catalog is rebuilt
 
     return render_template("main/view_recipe.html", recipe=recipe, nutrition=nutrition, allergies=allergies,
-                           ingredients=ingredients, steps=steps)
+                           ingredients=ingredients, steps=steps, similar=similar)
 
 
 @bp_main.route('/recipes', methods=['GET'])
@@ -81,18 +88,10 @@ def recipes():
     """
     # This dictionary allows search parameters to be kept in the page, so that they are saved even when navigating to
     # next/ prev urls
-    args_dict = {'search_term': request.args.get('search_term', ""),
-                 # Parse string allergies into an integer list, because you can't pass entire lists as parameters.
-                 # request.args.get therefore is taking in a string (i.e. not [1, 4, 10], but "1,4,10")
-                 # Split this string by ",", then map the values into integers and turn this into a list
-                 'allergy_list': [] if (
-                         (request.args.get('allergy_list') is None) or
-                         (request.args.get('allergy_list') == ''))
-                 else list(map(int, request.args.get('allergy_list').split(","))),
-                 'diet_type': request.args.get('diet_type', 1, type=int),
-                 'min_cal': request.args.get('min_cal', 0, type=int),
-                 'max_cal': request.args.get('max_cal', 1000, type=int),
-                 'time': request.args.get('time', 99999, type=int)}  # Default time to 99999
+    try:
+        args_dict = search_args()
+    except ValueError:
+        abort(400)  # A malformed allergy_list, or an unknown sort order
 
     # The following code related to pagination is adapted from:
     #
@@ -101,9 +100,10 @@ def recipes():
     # Date: 2018
     # Availability: https://blog.miguelgrinberg.com/post/the-flask-mega-tutorial-part-ix-pagination
     # Accessed: 25 March 2020
-    query = search_function(**args_dict)
+    # The ids of all the recipes found are cached, so each page only loads its own recipes
+    recipe_ids = search_result_ids(args_dict)
     page = request.args.get('page', 1, type=int)  # Get current page of results
-    recipes = query.paginate(page, config.RECIPES_PER_PAGE, False)
+    recipes = paginate_ids(recipe_ids, page, config.RECIPES_PER_PAGE)
 
     next_url = url_for('main.recipes', **args_dict, page=recipes.next_num) if recipes.has_next else None
     prev_url = url_for('main.recipes', **args_dict, page=recipes.prev_num) if recipes.has_prev else None
@@ -112,6 +112,39 @@ def recipes():
                            prev_url=prev_url)
 
 
+@bp_main.route('/pantry', methods=['GET'])
+def pantry():
+    """
+    Route for the "cook from my pantry" page. Users enter the ingredients they have (?ingredients=, separated by
+    commas), and are shown the recipes which need the fewest more ingredients, with what they would need to buy. Logged
+    in users only see recipes suiting their saved diet type and allergies.
+
+    :return: the pantry page, with the recipes found (if any ingredients were entered)
+    """
+    ingredients = request.args.get('ingredients', '')
+    pantry_ingredients = parse_pantry(ingredients)
+    if not pantry_ingredients:
+        return render_template('main/pantry.html', ingredients=ingredients, results=[], scores={}, missing={})
+
+    eligible_ids = None
+    if current_user.is_authenticated:
+        index = filter_index()
+        eligible_ids = index.recipe_ids(index.eligible(current_user.diet_preferences[0].diet_type_id,
+                                                       [allergy.allergy_id for allergy in current_user.allergies]))
+    found = pantry_index().search(pantry_ingredients, eligible_ids)
+
+    page = request.args.get('page', 1, type=int)
+    recipes = paginate_ids([recipe_id for recipe_id, used, missing in found], page, config.RECIPES_PER_PAGE)
+    scores = {recipe_id: (used, missing) for recipe_id, used, missing in found}
+    missing = {recipe.recipe_id: pantry_index().missing_ingredients(recipe.recipe_id, pantry_ingredients)
+               for recipe in recipes.items}
+
+    next_url = url_for('main.pantry', ingredients=ingredients, page=recipes.next_num) if recipes.has_next else None
+    prev_url = url_for('main.pantry', ingredients=ingredients, page=recipes.prev_num) if recipes.has_prev else None
+    return render_template('main/pantry.html', ingredients=ingredients, results=recipes.items, scores=scores,
+                           missing=missing, next_url=next_url, prev_url=prev_url)
+
+
 @bp_main.route('/view_all_recipes', methods=['GET'])
 def view_all_recipes():
     """
@@ -205,7 +238,13 @@ def advanced_search():
                      'diet_type': int(form.diet_type.data),
                      'min_cal': int(range[0]),
                      'max_cal': int(range[1]),
-                     'time': int(form.max_time.data)}
+                     'time': int(form.max_time.data),
+                     'sort': form.sort.data}
+        for nutrient, label in config.NUTRIENT_CHOICES:
+            for bound in ('min', 'max'):
+                value = form[f'{bound}_{nutrient}'].data
+                if value is not None:
+                    args_dict[f'{bound}_{nutrient}'] = value
 
         diet_name = (config.DIET_CHOICES[int(form.diet_type.data) - 1])[1]
         allergy_list = list(map(int, form.allergies.data))
@@ -219,7 +258,7 @@ def advanced_search():
         flash(flash_message, "success")
 
         return redirect(url_for('main.recipes', **args_dict))
-    return render_template('main/advanced_search.html', form=form)
+    return render_template('main/advanced_search.html', form=form, nutrient_choices=config.NUTRIENT_CHOICES)
 
 
 @bp_main.route('/add_to_favourites/<recipe_id>', methods=['GET', 'POST'])
@@ -276,12 +315,12 @@ def favourites():
     """
     # Query user favourite recipes. Command is in traditional query form so that we can paginate it (we cannot paginate
     # an InstrumentedList object, which is what current_user.favourite_recipes returns.
-    query = db.session.query(Recipes) \
-        .join(UserFavouriteRecipes, Recipes.recipe_id == UserFavouriteRecipes.recipe_id) \
+    query = db.session.query(RecipeSummary) \
+        .join(UserFavouriteRecipes, RecipeSummary.recipe_id == UserFavouriteRecipes.recipe_id) \
         .filter(UserFavouriteRecipes.user_id == current_user.id)
 
     page = request.args.get('page', 1, type=int)  # Get current page of results
-    recipes = query.paginate(page, config.RECIPES_PER_PAGE, False)
+    recipes = paginate_query(query, page, config.RECIPES_PER_PAGE)
 
     next_url = url_for('main.favourites', page=recipes.next_num) if recipes.has_next else None
     prev_url = url_for('main.favourites', page=recipes.prev_num) if recipes.has_prev else None
@@ -469,8 +508,8 @@ def view_mealplan(mealplan_id):
         .filter(MealPlanRecipes.mealplan_id == mealplan_id) \
         .distinct().subquery()  # Get recipes ids from specified mealplan as subquery
 
-    recipes = db.session.query(Recipes) \
-        .join(mealplan_recipes, Recipes.recipe_id == mealplan_recipes.c.recipe_id) \
+    recipes = db.session.query(RecipeSummary) \
+        .join(mealplan_recipes, RecipeSummary.recipe_id == mealplan_recipes.c.recipe_id) \
         .all()  # Join on recipe ids from subquery (recipes present in meal plan)
 
     return render_template('main/view_mealplan.html', results=recipes, mealplan=mealplan, user=current_user)
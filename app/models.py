@@ -143,3 +143,87 @@ class MealPlans(db.Model):
 class MealPlanRecipes(db.Model):
     __table__ = db.Model.metadata.tables['MealPlanRecipes']
     recipe = relationship("Recipes", backref=backref("mealplanrecipes", lazy="joined"))
+
+
+class ApiKeys(db.Model):
+    __table__ = db.Model.metadata.tables['ApiKeys']
+
+    def set_key(self, key):
+        self.key_hash = generate_password_hash(key)
+
+    def check_key(self, key):
+        return check_password_hash(self.key_hash, key)
+
+
+# The following tables are derived from the recipe catalog above. They do not exist in a freshly scraped database, and
+# are (re)built by `flask catalog rebuild` (see app/catalog.py), so they are declared here rather than reflected.
+class CatalogVersions(db.Model):
+    __tablename__ = 'CatalogVersions'
+    __table_args__ = {'extend_existing': True}
+    generation = db.Column(db.Integer, primary_key=True)
+    catalog_digest = db.Column(db.String(40), nullable=False)
+    built_at = db.Column(db.DateTime, nullable=False)
+
+
+class CatalogRecipes(db.Model):
+    __tablename__ = 'CatalogRecipes'
+    __table_args__ = {'extend_existing': True}
+    recipe_id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(40), nullable=False)  # SHA-1 of payload
+    payload = db.Column(db.LargeBinary, nullable=False)  # The recipe as served by the API, already encoded as JSON
+
+
+class RecipeNutrition(db.Model):
+    """
+    Nutrition values of each recipe with the ratio of each nutrient to calories precomputed, so that searches can be
+    sorted by them (e.g. by protein per kcal). Every sort column is indexed, and as recipe_id is the rowid, each index
+    covers its column and the recipe_id: a sorted search reads the index in order rather than sorting every recipe.
+    """
+    __tablename__ = 'RecipeNutrition'
+    __table_args__ = {'extend_existing': True}
+    recipe_id = db.Column(db.Integer, primary_key=True)
+    calories = db.Column(db.Float, index=True)
+    fats = db.Column(db.Float, index=True)
+    saturates = db.Column(db.Float, index=True)
+    carbs = db.Column(db.Float, index=True)
+    sugars = db.Column(db.Float, index=True)
+    fibres = db.Column(db.Float, index=True)
+    proteins = db.Column(db.Float, index=True)
+    salts = db.Column(db.Float, index=True)
+    fats_per_kcal = db.Column(db.Float, index=True)  # Grams per kcal; NULL for recipes without calories
+    saturates_per_kcal = db.Column(db.Float, index=True)
+    carbs_per_kcal = db.Column(db.Float, index=True)
+    sugars_per_kcal = db.Column(db.Float, index=True)
+    fibres_per_kcal = db.Column(db.Float, index=True)
+    proteins_per_kcal = db.Column(db.Float, index=True)
+    salts_per_kcal = db.Column(db.Float, index=True)
+
+
+class RecipeSummary(db.Model):
+    """
+    One row per recipe with what the recipe cards of list views show (search results, favourites and meal plans), and
+    what searches filter on, so neither needs a join. The allergies of a recipe are a bitmask, in which bit n is set if
+    the recipe has allergy n: a recipe suits a user's allergies if (allergen_mask & user_mask) = 0. The search index
+    covers every filter column (and the recipe_id, which is the rowid), so the filter index is built by scanning the
+    index alone.
+    """
+    __tablename__ = 'RecipeSummary'
+    __table_args__ = (db.Index('ix_RecipeSummary_search', 'diet_type_id', 'calories', 'total_time', 'allergen_mask'),
+                      {'extend_existing': True})
+    recipe_id = db.Column(db.Integer, primary_key=True)
+    recipe_name = db.Column(db.String(40), nullable=False)
+    photo = db.Column(db.String(40))
+    serves = db.Column(db.Integer)
+    total_time = db.Column(db.Integer)
+    calories = db.Column(db.Float)
+    diet_type_id = db.Column(db.Integer)  # The highest diet level of the recipe (see FilterIndex)
+    allergen_mask = db.Column(db.Integer, nullable=False)
+
+
+class RecipeSimilarities(db.Model):
+    __tablename__ = 'RecipeSimilarities'
+    __table_args__ = {'extend_existing': True}
+    recipe_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)  # 1 for the most similar recipe
+    similar_recipe_id = db.Column(db.Integer, nullable=False)
+    similarity = db.Column(db.Float, nullable=False)  # Cosine similarity of the ingredients (see app/similar.py)
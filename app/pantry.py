@@ -0,0 +1,164 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/pantry.py:
+
+This document includes the "cook from my pantry" search, which ranks recipes by how few of their ingredients users would
+need to buy, given the ingredients they already have. Each worker process keeps an inverted index of the words of every
+recipe's ingredient lines, which is rebuilt when the catalog generation changes (see app/catalog.py). It includes:
+- ingredient_words, which normalizes an ingredient line (or something in a user's pantry) into words
+- parse_pantry, which splits what the user typed into pantry ingredients
+- PantryIndex, posting lists of the ingredient lines containing each word
+- pantry_index, which returns the index for the current catalog generation
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.catalog import current_catalog
+from app.models import RecipeIngredients
+import config
+
+from collections import defaultdict
+from html import unescape
+import numpy as np
+import re
+
+_cache = {'index': None, 'generation': None}
+
+# Quantities, units and preparation, which say nothing about what the ingredient is
+IGNORED_WORDS = {'g', 'kg', 'mg', 'ml', 'l', 'oz', 'lb', 'tsp', 'tbsp', 'cup', 'x', 'pack', 'can', 'tin', 'bag', 'jar',
+                 'sachet', 'pinch', 'handful', 'squeeze', 'bunch', 'sprig', 'few', 'small', 'medium', 'large', 'ripe',
+                 'fresh', 'frozen', 'chopped', 'sliced', 'diced', 'finely', 'roughly', 'thinly', 'thickly', 'deseeded',
+                 'halved', 'quartered', 'peeled', 'grated', 'crushed', 'minced', 'cooked', 'ready', 'and', 'or', 'of',
+                 'a', 'the', 'to', 'for', 'from', 'with', 'plus', 'about', 'optional'}
+
+
+def ingredient_words(text):
+    """
+    Normalizes an ingredient into the words which say what it is, in the singular (so "2 large tomatoes, chopped" and
+    "tomato" are both "tomato"). Anything after a comma or bracket (e.g. how to prepare it) is left out.
+
+    :param text: an ingredient line of a recipe, or an ingredient typed by the user
+    :return: tuple of words
+    """
+    text = re.split(r'[,(]', unescape(text).lower(), 1)[0]
+    words = []
+    for word in re.findall(r'[^\W\d_]+', text):
+        if not word.isalpha() or word in IGNORED_WORDS:  # e.g. "½", which is not a digit
+            continue
+        if word.endswith('ies') and len(word) > 4:
+            word = word[:-3] + 'y'
+        elif word.endswith('oes') and len(word) > 4:
+            word = word[:-2]
+        elif word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+            word = word[:-1]
+        if word not in IGNORED_WORDS:
+            words.append(word)
+    return tuple(words)
+
+
+def parse_pantry(text):
+    """
+    :param text: the ingredients a user has, separated by commas or new lines (e.g. "chicken, rice, red pepper")
+    :return: list of the (at most config.PANTRY_MAX_INGREDIENTS) ingredients, each as a tuple of words
+    """
+    pantry = [ingredient_words(ingredient) for ingredient in re.split(r'[,\n]', text)]
+    return list(dict.fromkeys(ingredient for ingredient in pantry if ingredient))[:config.PANTRY_MAX_INGREDIENTS]
+
+
+class PantryIndex(object):
+    """
+    Inverted index of the recipes' ingredient lines: each word has a posting list of the (sorted) numbers of the lines
+    containing it. An ingredient in the user's pantry covers the lines containing all of its words, which is the
+    intersection of their posting lists, and the lines covered by the whole pantry are the union of those. The lines
+    covered are then counted per recipe, so no recipe's ingredients are read at query time.
+    """
+
+    def __init__(self, recipe_ingredients):
+        """
+        :param recipe_ingredients: (recipe_id, ingredient) pairs, ordered by recipe_id (and then in the order the
+            ingredients are listed)
+        """
+        self.lines = [ingredient for recipe_id, ingredient in recipe_ingredients]
+        self.line_recipes = np.array([recipe_id for recipe_id, ingredient in recipe_ingredients], dtype=np.int64)
+        self.line_counts = np.bincount(self.line_recipes)  # Number of ingredient lines of each recipe_id
+
+        postings = defaultdict(list)
+        for line_number, ingredient in enumerate(self.lines):
+            for word in set(ingredient_words(ingredient)):
+                postings[word].append(line_number)
+        self.postings = {word: np.array(lines, dtype=np.int64) for word, lines in postings.items()}
+        self.staple_lines = self.covered_lines([ingredient_words(staple) for staple in config.PANTRY_STAPLES])
+
+    @classmethod
+    def build(cls):
+        """
+        :return: a PantryIndex of the ingredients of every recipe
+        """
+        return cls(db.session.query(RecipeIngredients.recipe_id, RecipeIngredients.ingredient)
+                   .order_by(RecipeIngredients.recipe_id, RecipeIngredients.recipe_ingredient_id).all())
+
+    def covered_lines(self, pantry):
+        """
+        :param pantry: list of ingredients, each as a tuple of words (see parse_pantry)
+        :return: sorted NumPy array of the numbers of the ingredient lines covered by the pantry
+        """
+        no_lines = np.array([], dtype=np.int64)
+        covered = no_lines
+        for ingredient in pantry:
+            lines = self.postings.get(ingredient[0], no_lines)
+            for word in ingredient[1:]:
+                lines = np.intersect1d(lines, self.postings.get(word, no_lines), assume_unique=True)
+            covered = np.union1d(covered, lines)
+        return covered
+
+    def search(self, pantry, eligible_ids=None):
+        """
+        Ranks the recipes using at least one ingredient of the pantry by how many more ingredients they need, fewest
+        first (then by the most ingredients used, then by recipe_id). Staples (config.PANTRY_STAPLES) are taken to be
+        in every pantry, but recipes are only found by the user's own ingredients.
+
+        :param pantry: list of ingredients, each as a tuple of words (see parse_pantry)
+        :param eligible_ids: NumPy array of the recipe ids to choose from (e.g. those suiting the user's diet), or None
+            for all recipes
+        :return: list of (recipe_id, number of ingredients used, number of ingredients missing), best first
+        """
+        pantry_lines = self.covered_lines(pantry)
+        size = len(self.line_counts)
+        recipe_ids = np.unique(self.line_recipes[np.setdiff1d(pantry_lines, self.staple_lines, assume_unique=True)])
+        if eligible_ids is not None:
+            recipe_ids = np.intersect1d(recipe_ids, eligible_ids, assume_unique=True)
+
+        used = np.bincount(self.line_recipes[np.union1d(pantry_lines, self.staple_lines)], minlength=size)
+        missing = self.line_counts - used
+        order = np.lexsort((recipe_ids, -used[recipe_ids], missing[recipe_ids]))
+        return [(int(recipe_id), int(used[recipe_id]), int(missing[recipe_id])) for recipe_id in recipe_ids[order]]
+
+    def missing_ingredients(self, recipe_id, pantry):
+        """
+        :param recipe_id: id of a recipe
+        :param pantry: list of ingredients, each as a tuple of words (see parse_pantry)
+        :return: the ingredient lines of the recipe which neither the pantry nor the staples cover
+        """
+        start, end = np.searchsorted(self.line_recipes, [recipe_id, recipe_id + 1])
+        covered = np.union1d(self.covered_lines(pantry), self.staple_lines)
+        return [self.lines[line] for line in np.setdiff1d(np.arange(start, end), covered, assume_unique=True)]
+
+
+def pantry_index():
+    """
+    Returns the pantry index of this worker process, first building it if the catalog generation has changed since it
+    was last built. How often the generation is checked is set by config.CATALOG_CHECK_INTERVAL (see current_catalog).
+
+    :return: the PantryIndex for the current catalog generation
+    """
+    catalog = current_catalog()
+    generation = catalog.generation if catalog is not None else None
+    index = _cache['index']
+    if index is None or _cache['generation'] != generation:
+        index = PantryIndex.build()
+        _cache['index'], _cache['generation'] = index, generation
+    return index
@@ -0,0 +1,93 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/search.py:
+
+This document manages the full-text search index over the recipe catalog, an SQLite FTS5 table (RecipeSearch) of each
+recipe's name, ingredients and instructions. The index is rebuilt with the other derived catalog tables (see
+app/catalog.py). It includes:
+- rebuild_search_index
+- fts_query, which turns a user's search term into an FTS5 query
+- search_matches, a subquery of recipe ids matching an FTS5 query, ranked by BM25
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.models import Recipes, RecipeIngredients, RecipeInstructions
+
+import re
+from sqlalchemy import select
+from sqlalchemy.sql import column, func, table, text
+
+SEARCH_TABLE = 'RecipeSearch'  # Also named in app/__init__.py, which keeps it out of the reflected tables
+
+SEARCH_TOKENIZER = 'porter unicode61 remove_diacritics 2'  # FTS5 tokenizer: words are lower cased and stemmed
+
+# The index only stores the tokens (content=''), since the text itself is kept in the recipe tables. Words are stemmed
+# (so "potatoes" finds "potato"), and two and three letter prefixes are indexed so that partly typed words are cheap.
+CREATE_SEARCH_TABLE = f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        recipe_name, ingredients, instructions,
+        content='', tokenize='{SEARCH_TOKENIZER}', prefix='2 3')
+"""
+
+# BM25 weights of the recipe_name, ingredients and instructions columns: a match in the name counts the most
+SEARCH_RANK = 'bm25(10.0, 2.0, 1.0)'
+
+search_index = table(SEARCH_TABLE, column('rowid'), column('rank'), column(SEARCH_TABLE),
+                     column('recipe_name'), column('ingredients'), column('instructions'))
+
+
+def rebuild_search_index(connection):
+    """
+    Rebuilds the full-text search index from the recipe tables, in one INSERT ... SELECT. The rowid of each row is the
+    recipe_id, and the ingredients and instructions of a recipe are each indexed as one column.
+
+    :param connection: connection to run the statements on
+    """
+    connection.execute(text(CREATE_SEARCH_TABLE))
+    connection.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('delete-all')"))
+    connection.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rank) VALUES ('rank', :rank)"),
+                       rank=SEARCH_RANK)
+
+    ingredients = select([func.group_concat(RecipeIngredients.ingredient, '\n')]) \
+        .where(RecipeIngredients.recipe_id == Recipes.recipe_id) \
+        .as_scalar()
+    instructions = select([func.group_concat(RecipeInstructions.step_description, '\n')]) \
+        .where(RecipeInstructions.recipe_id == Recipes.recipe_id) \
+        .as_scalar()
+    recipes = select([Recipes.recipe_id, Recipes.recipe_name, ingredients, instructions])
+    connection.execute(search_index.insert().from_select(
+        ['rowid', 'recipe_name', 'ingredients', 'instructions'], recipes))
+
+
+def fts_query(search_term):
+    """
+    Turns a search term into an FTS5 query which matches recipes containing every word of the term, in any order. The
+    last word is matched as a prefix, as the user may not have finished typing it. Each word is quoted, so characters
+    in the term are never read as FTS5 query syntax.
+
+    :param search_term: search term typed by the user
+    :return: an FTS5 query, or None if the term has no words to search for
+    """
+    words = re.findall(r'\w+', search_term.lower())
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def search_matches(query):
+    """
+    Full-text search of the recipe catalog. Matching is done in the FTS5 index, so its cost depends on how many recipes
+    contain the words, not on the size of the catalog.
+
+    :param query: an FTS5 query (see fts_query), or a bind parameter for one
+    :return: a subquery of (recipe_id, rank) of the matching recipes, where a lower rank is a better match
+    """
+    return db.session.query(search_index.c.rowid.label('recipe_id'), search_index.c.rank.label('rank')) \
+        .filter(search_index.c[SEARCH_TABLE].match(query)) \
+        .subquery()
+
@@ -0,0 +1,157 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/similar.py:
+
+This document includes the "more like this" recipe recommendations. Each recipe is a sparse TF-IDF vector of the words
+of its ingredients, and its nearest neighbours by cosine similarity are worked out for the whole catalog in one batch,
+when the derived catalog tables are rebuilt (see app/catalog.py). They are stored in RecipeSimilarities, so showing the
+similar recipes of a recipe is a primary key lookup. It includes:
+- TfidfMatrix, the sparse TF-IDF vectors of the recipes' ingredients
+- rebuild_similar_recipes, run by rebuild_catalog
+- similar_recipes, which returns the recipes most similar to a recipe
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.models import Recipes, RecipeIngredients, RecipeSimilarities
+from app.pantry import ingredient_words
+import config
+
+from collections import Counter
+import numpy as np
+from sqlalchemy import select
+
+
+class TfidfMatrix(object):
+    """
+    Sparse matrix of the TF-IDF weights of the words of each recipe's ingredients, one L2-normalized row per recipe. It
+    is held both by row (CSR: the words of each recipe) and by column (CSC: the recipes using each word), as NumPy
+    arrays of offsets, indices and weights. Multiplying the rows by the columns only visits pairs of recipes sharing a
+    word, so cosine similarities are found without a dense recipe-by-word matrix.
+    """
+
+    def __init__(self, recipe_ingredients):
+        """
+        :param recipe_ingredients: (recipe_id, ingredient) pairs
+        """
+        recipe_words = {}
+        for recipe_id, ingredient in recipe_ingredients:
+            recipe_words.setdefault(recipe_id, Counter()).update(ingredient_words(ingredient))
+        self.recipe_ids = np.array(sorted(recipe_words), dtype=np.int64)
+        vocabulary = {word: i for i, word in enumerate(sorted({word for words in recipe_words.values()
+                                                                 for word in words}))}
+
+        rows, columns, counts = [], [], []
+        for row, recipe_id in enumerate(self.recipe_ids):
+            for word, count in recipe_words[int(recipe_id)].items():
+                rows.append(row)
+                columns.append(vocabulary[word])
+                counts.append(count)
+        rows = np.array(rows, dtype=np.int64)
+        columns = np.array(columns, dtype=np.int64)
+
+        # Sublinear term frequency and smoothed inverse document frequency, so that a word listed many times in one
+        # recipe does not dominate it, and words used by most recipes (e.g. "onion") count for little
+        document_frequency = np.bincount(columns, minlength=len(vocabulary))
+        idf = np.log((1 + len(self.recipe_ids)) / (1 + document_frequency)) + 1
+        weights = (1 + np.log(np.array(counts, dtype=np.float64))) * idf[columns]
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=len(self.recipe_ids)))
+        weights /= norms[rows]
+
+        self.shape = (len(self.recipe_ids), len(vocabulary))
+        order = np.lexsort((columns, rows))
+        self.row_offsets = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=self.shape[0]))))
+        self.row_columns, self.row_weights = columns[order], weights[order]
+        order = np.lexsort((rows, columns))
+        self.column_offsets = np.concatenate(([0], np.cumsum(document_frequency)))
+        self.column_rows, self.column_weights = rows[order], weights[order]
+
+    def similarities(self, start, end):
+        """
+        Cosine similarities of rows start to end with every row, as a sparse-by-sparse matrix product: each weight of
+        the rows is multiplied with the weights of the other recipes using the same word (from the CSC arrays), and the
+        products are summed per pair of recipes.
+
+        :param start: first row
+        :param end: row after the last row
+        :return: dense NumPy array of shape (end - start, number of recipes)
+        """
+        entries = slice(self.row_offsets[start], self.row_offsets[end])
+        rows = np.repeat(np.arange(end - start), np.diff(self.row_offsets[start:end + 1]))
+        columns, weights = self.row_columns[entries], self.row_weights[entries]
+
+        # For each entry, the positions of its word's column in the CSC arrays (a concatenation of ranges)
+        lengths = self.column_offsets[columns + 1] - self.column_offsets[columns]
+        ends = np.cumsum(lengths)
+        positions = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths - self.column_offsets[columns],
+                                                                         lengths)
+
+        products = np.repeat(weights, lengths) * self.column_weights[positions]
+        pairs = np.repeat(rows, lengths) * self.shape[0] + self.column_rows[positions]
+        return np.bincount(pairs, weights=products, minlength=(end - start) * self.shape[0]) \
+            .reshape(end - start, self.shape[0])
+
+    def nearest_neighbours(self, k, chunk_size=config.SIMILAR_RECIPES_CHUNK):
+        """
+        Finds the k most similar recipes of every recipe, chunk_size rows at a time (to bound the memory used by the
+        dense block of similarities).
+
+        :param k: number of neighbours of each recipe
+        :param chunk_size: number of rows whose similarities are worked out at once
+        :return: list of (recipe_id, rank, similar_recipe_id, similarity), where rank starts from 1 for the most similar
+            recipe. Recipes sharing no words are not neighbours.
+        """
+        neighbours = []
+        k = min(k, self.shape[0] - 1)
+        if k < 1:
+            return neighbours
+        for start in range(0, self.shape[0], chunk_size):
+            end = min(start + chunk_size, self.shape[0])
+            similarities = self.similarities(start, end)
+            similarities[np.arange(end - start), np.arange(start, end)] = 0  # A recipe is not similar to itself
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            top_similarities = np.take_along_axis(similarities, top, axis=1)
+            # Most similar first, and recipes as similar as each other by recipe_id
+            order = np.lexsort((self.recipe_ids[top], -top_similarities), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_similarities = np.take_along_axis(top_similarities, order, axis=1)
+            for row in range(end - start):
+                for rank in range(k):
+                    if top_similarities[row, rank] > 0:
+                        neighbours.append((int(self.recipe_ids[start + row]), rank + 1,
+                                           int(self.recipe_ids[top[row, rank]]), float(top_similarities[row, rank])))
+        return neighbours
+
+
+def rebuild_similar_recipes(connection):
+    """
+    Fills RecipeSimilarities (emptied by rebuild_catalog) with the config.SIMILAR_RECIPES most similar recipes of every
+    recipe.
+
+    :param connection: connection to run the statements on
+    """
+    ingredients = connection.execute(select([RecipeIngredients.recipe_id, RecipeIngredients.ingredient])).fetchall()
+    neighbours = TfidfMatrix(ingredients).nearest_neighbours(config.SIMILAR_RECIPES)
+    if neighbours:
+        connection.execute(RecipeSimilarities.__table__.insert(),
+                           [{'recipe_id': recipe_id, 'rank': rank, 'similar_recipe_id': similar_recipe_id,
+                             'similarity': similarity}
+                            for recipe_id, rank, similar_recipe_id, similarity in neighbours])
+
+
+def similar_recipes(recipe_id, limit=config.SIMILAR_RECIPES):
+    """
+    :param recipe_id: id of a recipe
+    :param limit: the most similar recipes to return
+    :return: list of (Recipes, similarity) of the recipes most similar to the recipe, most similar first
+    """
+    return db.session.query(Recipes, RecipeSimilarities.similarity) \
+        .join(RecipeSimilarities, RecipeSimilarities.similar_recipe_id == Recipes.recipe_id) \
+        .filter(RecipeSimilarities.recipe_id == recipe_id) \
+        .order_by(RecipeSimilarities.rank) \
+        .limit(limit) \
+        .all()
@@ -0,0 +1,139 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/snapshot.py:
+
+This document builds the downloadable catalog snapshots, for partners who want the whole dataset. Snapshots are built
+once per catalog generation, when the catalog is rebuilt (see app/catalog.py) or by `flask catalog snapshots`, and kept
+in the SNAPSHOT_DIR folder, so that serving them costs no more than sending a file. It includes:
+- build_sqlite_snapshot, a read-only SQLite copy of the recipe catalog tables
+- build_nutrition_snapshot, a columnar (NumPy .npz) file of every recipe's nutrition values
+- snapshot_path, which returns the path of a built snapshot for a catalog generation
+- build_snapshots, which builds the snapshots of a catalog generation and deletes those of older generations
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.models import CatalogVersions, NutritionValues
+
+from flask import current_app
+import numpy as np
+import os
+import re
+import sqlite3
+import tempfile
+
+# Tables copied into the SQLite snapshot: the recipe catalog, without any user data
+SNAPSHOT_TABLES = ['Recipes', 'RecipeIngredients', 'RecipeInstructions', 'NutritionValues', 'DietTypes', 'Allergies',
+                   'RecipeDietTypes', 'RecipeAllergies']
+NUTRITION_COLUMNS = ['calories', 'fats', 'saturates', 'carbs', 'sugars', 'fibres', 'proteins', 'salts']
+
+SNAPSHOT_FILENAME = re.compile(r'mealtime-[a-z]+-(\d+)-[0-9a-f]{8}\.\w+$')  # See snapshot_filename
+
+
+def build_sqlite_snapshot(catalog, path):
+    """
+    Copies the catalog tables (with their original schema) into a new SQLite database, stamped with the catalog
+    generation as its user_version. The rows are read through the session's own connection, so the snapshot matches
+    what the application sees.
+
+    :param catalog: the Catalog the snapshot is built for
+    :param path: file to build the snapshot in
+    """
+    snapshot = sqlite3.connect(path)
+    try:
+        for table in SNAPSHOT_TABLES:
+            create_table = db.session.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name",
+                                              {'name': table}).scalar()
+            snapshot.execute(create_table)
+            rows = db.session.execute(f'SELECT * FROM "{table}"')
+            placeholders = ', '.join('?' * len(rows.keys()))
+            snapshot.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', rows)
+        snapshot.execute(f'PRAGMA user_version = {int(catalog.generation)}')
+        snapshot.commit()
+        snapshot.execute('VACUUM')
+    finally:
+        snapshot.close()
+
+
+def build_nutrition_snapshot(catalog, path):
+    """
+    Writes every recipe's nutrition values as columns: one array per nutrition value (float64, NaN where missing),
+    aligned with a recipe_id array (int32), sorted by recipe_id. The .npz is uncompressed, so it can be read with
+    numpy.load(..., mmap_mode='r') and fetched in ranges.
+
+    :param catalog: the Catalog the snapshot is built for
+    :param path: file to build the snapshot in
+    """
+    columns = [getattr(NutritionValues, column) for column in NUTRITION_COLUMNS]
+    rows = db.session.query(NutritionValues.recipe_id, *columns).order_by(NutritionValues.recipe_id).all()
+
+    arrays = {'recipe_id': np.array([row[0] for row in rows], dtype=np.int32)}
+    for i, column in enumerate(NUTRITION_COLUMNS, start=1):
+        arrays[column] = np.array([np.nan if row[i] is None else row[i] for row in rows], dtype=np.float64)
+    with open(path, 'wb') as f:  # A file object, as np.savez would otherwise add its own extension to the path
+        np.savez(f, **arrays)
+
+
+# Snapshots which can be downloaded, by file name: their mimetype and the function which builds them
+SNAPSHOT_ARTIFACTS = {'catalog.db': ('application/vnd.sqlite3', build_sqlite_snapshot),
+                      'nutrition.npz': ('application/octet-stream', build_nutrition_snapshot)}
+
+
+def snapshot_filename(catalog, artifact):
+    """
+    :return: the versioned file name of a snapshot, e.g. mealtime-catalog-3-1a2b3c4d.db for catalog.db
+    """
+    name, extension = os.path.splitext(artifact)
+    return f'mealtime-{name}-{catalog.generation}-{catalog.catalog_digest[:8]}{extension}'
+
+
+def snapshot_path(catalog, artifact):
+    """
+    :param catalog: the current Catalog
+    :param artifact: key of SNAPSHOT_ARTIFACTS
+    :return: path of the snapshot file, or None if it has not been built for this catalog generation (see
+        build_snapshots)
+    """
+    path = os.path.join(current_app.config['SNAPSHOT_DIR'], snapshot_filename(catalog, artifact))
+    return path if os.path.isfile(path) else None
+
+
+def build_snapshots(catalog):
+    """
+    Builds every snapshot of the catalog which has not been built yet. Snapshots are built in a temporary file and then
+    renamed, so a partly built snapshot is never served. Snapshots of generations older than the newest one in
+    CatalogVersions are then deleted; those of the newest generation are always kept, even if this catalog is older.
+
+    This reads the catalog tables as they are now, so it must only be given the newest catalog: it is run by
+    rebuild_catalog, and by `flask catalog snapshots` (e.g. when deploying to a fresh snapshot folder), never by
+    requests, whose worker may not have seen a rebuild yet.
+
+    :param catalog: the newest Catalog
+    :return: dictionary of snapshot paths, keyed by artifact
+    """
+    folder = current_app.config['SNAPSHOT_DIR']
+    os.makedirs(folder, exist_ok=True)
+    paths = {}
+    for artifact, (mimetype, build) in SNAPSHOT_ARTIFACTS.items():
+        path = os.path.join(folder, snapshot_filename(catalog, artifact))
+        if not os.path.isfile(path):
+            fd, temporary_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            os.close(fd)
+            try:
+                build(catalog, temporary_path)
+                os.replace(temporary_path, path)
+            except Exception:
+                os.remove(temporary_path)
+                raise
+        paths[artifact] = path
+
+    newest_generation = db.session.query(db.func.max(CatalogVersions.generation)).scalar() or catalog.generation
+    for filename in os.listdir(folder):
+        match = SNAPSHOT_FILENAME.match(filename)
+        if match and int(match.group(1)) < newest_generation:
+            os.remove(os.path.join(folder, filename))
+    return paths
@@ -0,0 +1,164 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+app/suggest.py:
+
+This document includes the in-memory prefix index behind search-as-you-type suggestions (/api/suggest). Each worker
+process keeps one index, which is rebuilt when the catalog generation changes (see app/catalog.py). Replacement
+indexes are built on a background thread and swapped in when they are ready, so suggestions are answered without
+querying the database, or waiting for a rebuild. It includes:
+- SuggestIndex, a sorted array of recipe names (from each of their words), with the recipes ranked by popularity
+- suggest_index, which returns the index of this worker process
+- refresh_index and refresh_in_background, which rebuild the index if the catalog generation has changed, or it is
+  out of date
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import db
+from app.catalog import current_catalog
+from app.models import Recipes, UserFavouriteRecipes, MealPlanRecipes
+import config
+
+from bisect import bisect_left
+from collections import Counter
+from flask import current_app
+import heapq
+import re
+from threading import Lock, Thread
+import time
+
+_cache = {'index': None, 'generation': None, 'built_at': None, 'checked_at': None}
+
+# Held while the index is being checked or rebuilt in the background, so at most one thread does it at a time. It is
+# released by the background thread, which a Lock (unlike an RLock) allows.
+_refresh_lock = Lock()
+
+
+def normalize(text):
+    """
+    :return: text in lower case, with runs of anything but letters and digits made into single spaces
+    """
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+class SuggestIndex(object):
+    """
+    A prefix index of recipe names. Every recipe name is indexed from each of its words, so "egg fried rice" is found by
+    typing "egg", "fried ri" or "rice". The keys are kept in one sorted list, so the keys starting with a prefix are a
+    slice found by binary search. Suggestions are the most popular recipes of that slice; for prefixes of up to
+    config.SUGGEST_PRECOMPUTED_PREFIX characters (whose slices are the longest), they are worked out in advance.
+    """
+
+    def __init__(self, recipe_names, popularity):
+        """
+        :param recipe_names: (recipe_id, recipe_name) pairs
+        :param popularity: Counter of how popular each recipe_id is
+        """
+        # Recipes in order of popularity (most popular first, then by name), so a recipe is ranked by its position
+        self.recipes = sorted(recipe_names, key=lambda recipe: (-popularity[recipe[0]], recipe[1].lower(), recipe[0]))
+
+        keys = []
+        for rank, (recipe_id, recipe_name) in enumerate(self.recipes):
+            words = normalize(recipe_name).split(' ')
+            for i in range(len(words)):
+                keys.append((' '.join(words[i:]), rank))
+        keys.sort()
+        self.keys = [key for key, rank in keys]
+        self.ranks = [rank for key, rank in keys]
+
+        self.precomputed = {}
+        for prefix in {key[:length] for key in self.keys
+                       for length in range(1, config.SUGGEST_PRECOMPUTED_PREFIX + 1)}:
+            self.precomputed[prefix] = self.top_ranks(prefix, config.SUGGEST_MAX_LIMIT)
+
+    @classmethod
+    def build(cls):
+        """
+        :return: a SuggestIndex of the recipe names, ranked by how many times each recipe has been added to favourites
+            and meal plans
+        """
+        popularity = Counter(recipe_id for recipe_id, in db.session.query(UserFavouriteRecipes.recipe_id))
+        popularity.update(recipe_id for recipe_id, in db.session.query(MealPlanRecipes.recipe_id))
+        return cls(db.session.query(Recipes.recipe_id, Recipes.recipe_name).all(), popularity)
+
+    def top_ranks(self, prefix, limit):
+        """
+        :return: the ranks of the (at most limit) most popular recipes with a word starting with prefix, best first
+        """
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + '\uffff', start)
+        return heapq.nsmallest(limit, set(self.ranks[start:end]))
+
+    def suggest(self, prefix, limit=config.SUGGEST_LIMIT):
+        """
+        :param prefix: what the user has typed so far
+        :param limit: the most suggestions to return
+        :return: list of (recipe_id, recipe_name) of the most popular recipes matching the prefix
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        ranks = self.precomputed.get(prefix)
+        if ranks is None:
+            ranks = self.top_ranks(prefix, limit) if len(prefix) > config.SUGGEST_PRECOMPUTED_PREFIX else []
+        return [self.recipes[rank] for rank in ranks[:limit]]
+
+
+def suggest_index():
+    """
+    Returns the suggestion index of this worker process. The index is built here only the first time (when the worker
+    starts serving). After that, every config.CATALOG_CHECK_INTERVAL seconds, a background thread is started to check
+    the catalog generation and rebuild the index if needed (see refresh_index), and the current index is returned
+    meanwhile, so a request never queries the database.
+
+    :return: the SuggestIndex
+    """
+    index = _cache['index']
+    if index is None:
+        return refresh_index()
+    if time.monotonic() - _cache['checked_at'] > config.CATALOG_CHECK_INTERVAL and \
+            _refresh_lock.acquire(blocking=False):
+        Thread(target=refresh_in_background, args=(current_app._get_current_object(),), daemon=True).start()
+    return index
+
+
+def refresh_index():
+    """
+    Rebuilds the suggestion index if the catalog generation has changed since it was built, or if it is more than
+    config.SUGGEST_REBUILD_INTERVAL seconds old, so that the ranking follows the recipes' popularity. The new index
+    replaces the old one in a single assignment, so requests see one or the other, never a partly built index.
+
+    :return: the SuggestIndex for the current catalog generation
+    """
+    catalog = current_catalog(refresh=True)
+    generation = catalog.generation if catalog is not None else None
+    now = time.monotonic()
+    index = _cache['index']
+    if index is None or _cache['generation'] != generation or \
+            now - _cache['built_at'] > config.SUGGEST_REBUILD_INTERVAL:
+        index = SuggestIndex.build()
+        _cache.update(generation=generation, built_at=now, checked_at=now)
+        _cache['index'] = index
+    else:
+        _cache['checked_at'] = now
+    return index
+
+
+def refresh_in_background(app):
+    """
+    Runs refresh_index on a background thread, with its own application context and database session, then releases
+    the refresh lock taken by suggest_index.
+
+    :param app: the Flask application
+    """
+    try:
+        with app.app_context():
+            try:
+                refresh_index()
+            finally:
+                db.session.remove()
+    finally:
+        _refresh_lock.release()
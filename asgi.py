@@ -0,0 +1,4 @@
+from app.api.asgi import create_asgi_app
+
+# Asynchronous (ASGI) serving mode, see app/api/asgi.py. Run with: uvicorn asgi:app
+app = create_asgi_app('config.ProdConfig')
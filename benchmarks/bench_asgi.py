@@ -0,0 +1,199 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/bench_asgi.py:
+
+Compares the API served by a gunicorn sync worker (as in the Procfile) with the ASGI serving mode (uvicorn, see
+app/api/asgi.py), each in one worker process, under concurrent requests. Two workloads are measured:
+- clients reading single recipes (read_recipe) as fast as they can, and
+- the same clients, while other (slow) clients download the whole catalog (read_recipes as a stream).
+
+Both servers use a copy of db/mealtime.db in a temporary folder (removed when the benchmark ends), so the benchmark's
+API key is not added to the real database. Run from the project root with:
+
+    python -m benchmarks.bench_asgi
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import create_app
+from config import DevConfig
+
+from gunicorn.app.base import BaseApplication
+from http.client import HTTPConnection
+from multiprocessing import Process
+from os.path import join
+import random
+import shutil
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import uvicorn
+
+DURATION = 10  # Seconds each workload runs for
+FAST_CLIENTS = 8  # Clients reading single recipes
+SLOW_CLIENTS = 4  # Clients downloading the whole catalog, in the second workload
+SLOW_READ_SIZE = 16 * 1024  # A slow client reads this many bytes...
+SLOW_READ_INTERVAL = 0.01  # ... every this many seconds (about 1.6 MB/s)
+SEND_BUFFER_SIZE = 64 * 1024  # Server socket send buffer, in bytes (see listen)
+HOST = '127.0.0.1'
+
+
+class BenchConfig(DevConfig):
+    DEBUG = False
+    API_RATE_LIMIT = 10 ** 6  # The benchmark's clients share one API key
+    API_RATE_BURST = 10 ** 6
+    SQLALCHEMY_DATABASE_URI = None  # A copy of db/mealtime.db in a temporary folder, set by main()
+
+
+class GunicornServer(BaseApplication):
+    """Runs the Flask app in gunicorn, with one sync worker."""
+
+    def __init__(self, app, listener):
+        self.application = app
+        self.listener = listener
+        super().__init__()
+
+    def load_config(self):
+        self.cfg.set('bind', f'fd://{self.listener.fileno()}')
+        self.cfg.set('workers', 1)
+        self.cfg.set('worker_class', 'sync')
+        self.cfg.set('loglevel', 'warning')
+
+    def load(self):
+        return self.application
+
+
+def run_gunicorn(listener):
+    GunicornServer(create_app(BenchConfig), listener).run()
+
+
+def run_uvicorn(listener):
+    from app.api.asgi import AsgiApp
+    uvicorn.run(AsgiApp(create_app(BenchConfig).wsgi_app), fd=listener.fileno(), log_level='warning')
+
+
+def listen():
+    """
+    Opens the socket the server under test listens on. Its send buffer is fixed at SEND_BUFFER_SIZE (connections
+    accepted from it inherit this), as a server's would be limited by the network path to a real client. Otherwise, on
+    loopback, the kernel grows the buffer until it holds the whole catalog, and no client is ever slow.
+
+    :return: the listening socket
+    """
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((HOST, 0))
+    listener.listen(128)
+    listener.set_inheritable(True)
+    return listener
+
+
+class SlowConnection(HTTPConnection):
+    """
+    HTTP connection with a small receive buffer, so that a slow client really does hold back the server, rather than
+    the kernel buffering the whole response.
+    """
+
+    def connect(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+        self.sock.connect((self.host, self.port))
+
+
+def get(port, path, key, read_size=None, read_interval=0):
+    """
+    Makes a GET request over a new connection, and reads the whole response (slowly, if read_interval is given).
+
+    :return: number of bytes received
+    """
+    connection = SlowConnection(HOST, port)
+    try:
+        connection.request('GET', path, headers={'Authorization': 'Bearer ' + key})
+        response = connection.getresponse()
+        received = 0
+        while True:
+            data = response.read(read_size)
+            if not data:
+                return received
+            received += len(data)
+            if read_interval:
+                time.sleep(read_interval)
+    finally:
+        connection.close()
+
+
+def run_workload(port, key, recipe_ids, slow_clients):
+    """
+    :return: a tuple of (single recipe latencies in seconds, number of catalog downloads completed)
+    """
+    stop_at = time.monotonic() + DURATION
+    latencies = []
+    downloads = []
+
+    def fast_client():
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            get(port, f'/api/recipes/{random.choice(recipe_ids)}', key)
+            latencies.append(time.monotonic() - started)
+
+    def slow_client():
+        while time.monotonic() < stop_at:
+            get(port, '/api/recipes?stream=1', key, SLOW_READ_SIZE, SLOW_READ_INTERVAL)
+            downloads.append(1)
+
+    threads = [threading.Thread(target=fast_client) for _ in range(FAST_CLIENTS)] + \
+              [threading.Thread(target=slow_client) for _ in range(slow_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, len(downloads)
+
+
+def main():
+    bench_dir = tempfile.mkdtemp()
+    try:
+        shutil.copy(join(DevConfig.CWD, 'db/mealtime.db'), join(bench_dir, 'mealtime.db'))
+        BenchConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + join(bench_dir, 'mealtime.db')  # Inherited by the servers
+        run_benchmark()
+    finally:
+        shutil.rmtree(bench_dir)
+
+
+def run_benchmark():
+    app = create_app(BenchConfig)
+    with app.app_context():
+        from app.api.api_keys import create_api_key
+        from app.models import Recipes  # Models can only be imported once create_app has reflected the tables
+        api_key, key = create_api_key('Benchmark')
+        recipe_ids = [recipe_id for recipe_id, in Recipes.query.with_entities(Recipes.recipe_id)]
+
+    print(f"{DURATION}s per workload, {FAST_CLIENTS} clients reading single recipes\n")
+    print(f"{'server':<18}{'slow clients':>13}{'recipes/s':>11}{'p50 (ms)':>10}{'p99 (ms)':>10}{'catalogs':>10}")
+    for name, target in [('gunicorn (sync)', run_gunicorn), ('uvicorn (ASGI)', run_uvicorn)]:
+        listener = listen()
+        port = listener.getsockname()[1]
+        server = Process(target=target, args=(listener,), daemon=True)
+        server.start()
+        try:
+            get(port, '/api/recipes/5', key)  # Waits for the server to start, and caches the API key
+            for slow_clients in [0, SLOW_CLIENTS]:
+                latencies, downloads = run_workload(port, key, recipe_ids, slow_clients)
+                latencies.sort()
+                print(f"{name:<18}{slow_clients:>13}{len(latencies) / DURATION:>11.0f}"
+                      f"{statistics.median(latencies) * 1000:>10.1f}"
+                      f"{latencies[int(len(latencies) * 0.99)] * 1000:>10.1f}{downloads:>10}")
+        finally:
+            server.terminate()
+            server.join()
+            listener.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/bench_encoders.py:
+
+Compares the API response formats (JSON, MessagePack and CBOR, see app/api/encoders.py) by encode time and payload
+size, over every recipe in the catalog. Two workloads are measured:
+- encoding each full recipe on its own (what `flask catalog rebuild` and the sparse/ ORM sources do), and
+- assembling the /api/recipes response from the per-recipe payloads with encode_object.
+
+Run from the project root with:
+
+    python -m benchmarks.bench_encoders
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import create_app, db
+from app.api.encoders import RESPONSE_FORMATS
+
+from flask import json
+import gzip
+import timeit
+
+REPEAT = 5
+
+
+def best_time(function):
+    """
+    :return: the fastest of REPEAT runs of function, in milliseconds
+    """
+    return min(timeit.repeat(function, number=1, repeat=REPEAT)) * 1000
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        from app.models import CatalogRecipes  # Models can only be imported once create_app has reflected the tables
+        recipes = [json.loads(payload) for payload, in db.session.query(CatalogRecipes.payload)]
+
+    print(f"{len(recipes)} recipes, best of {REPEAT} runs\n")
+    print(f"{'format':<24}{'encode (ms)':>12}{'assemble (ms)':>15}{'size (KB)':>11}{'gzipped (KB)':>14}")
+    for mimetype in ['application/json', 'application/msgpack', 'application/cbor']:
+        response_format = RESPONSE_FORMATS[mimetype]
+        encoded = [response_format.encode(recipe) for recipe in recipes]
+        body = response_format.encode_object(recipes=encoded)
+
+        encode_time = best_time(lambda: [response_format.encode(recipe) for recipe in recipes])
+        assemble_time = best_time(lambda: response_format.encode_object(recipes=encoded))
+        print(f"{mimetype:<24}{encode_time:>12.1f}{assemble_time:>15.2f}{len(body) / 1024:>11.0f}"
+              f"{len(gzip.compress(body, 6)) / 1024:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
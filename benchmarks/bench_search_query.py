@@ -0,0 +1,83 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/bench_search_query.py:
+
+Measures how long search_function spends in Python building its query and compiling it to SQL, with the baked queries
+of search_query, and with the query built afresh on every search (as before they were baked, which is what SQLAlchemy
+does when a session's enable_baked_queries is False). Each search's time is split into the time spent executing its
+SQL statements in SQLite (timed by cursor execution events) and the rest, which is query construction and compilation,
+the filter index lookup and reading the rows.
+
+Run from the project root with:
+
+    python -m benchmarks.bench_search_query
+"""
+__authors__ = "Justin Wong"
+__email__ = "justin.wong.17@ucl.ac.uk"
+__credits__ = ["Justin Wong"]
+__status__ = "Development"
+
+from app import create_app, db
+
+from sqlalchemy import event
+import time
+
+REPEAT = 200  # Runs of each search
+
+# One search of each common shape
+SEARCHES = [('all recipes', {}),
+            ('diet and allergies', {'diet_type': 3, 'allergy_list': [1, 4]}),
+            ('search term', {'search_term': 'chicken'}),
+            ('search term and filters', {'search_term': 'rice', 'diet_type': 2, 'max_cal': 600, 'time': 45}),
+            ('sorted by nutrient', {'min_proteins': 20, 'sort': '-proteins_per_kcal'})]
+
+
+class StatementTimer(object):
+    """
+    Adds up the time spent executing SQL statements on an engine.
+    """
+
+    def __init__(self, engine):
+        self.total = 0
+        event.listen(engine, 'before_cursor_execute', self.before)
+        event.listen(engine, 'after_cursor_execute', self.after)
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        context.started_at = time.perf_counter()
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        self.total += time.perf_counter() - context.started_at
+
+
+def time_search(timer, args_dict):
+    """
+    :return: the mean time of a search, and the mean time of its SQL statements, in milliseconds
+    """
+    from app.main.main_functions import search_query
+    from app.models import Recipes
+
+    timer.total = 0
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        search_query(Recipes.recipe_id, **args_dict).all()
+    return (time.perf_counter() - start) * 1000 / REPEAT, timer.total * 1000 / REPEAT
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        timer = StatementTimer(db.engine)
+        print(f"mean of {REPEAT} runs, in ms\n")
+        print(f"{'search':<26}{'':>10}{'total':>8}{'SQLite':>8}{'Python':>8}")
+        for name, args_dict in SEARCHES:
+            for baked in (False, True):
+                db.session().enable_baked_queries = baked
+                time_search(timer, args_dict)  # Warm up the caches (and bake the query)
+                total, statements = time_search(timer, args_dict)
+                print(f"{name if not baked else '':<26}{'baked' if baked else 'unbaked':>10}{total:>8.2f}"
+                      f"{statements:>8.2f}{total - statements:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
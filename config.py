@@ -15,6 +15,35 @@ from os.path import dirname, abspath, join
 
 """Global project variables set up in config"""
 RECIPES_PER_PAGE = 12  # For pagination
+API_MAX_PAGE_SIZE = 100  # Largest ?limit= accepted by paginated API calls
+API_MAX_BATCH_SIZE = 100  # Most recipes that can be requested in one batch lookup
+API_STREAM_CHUNK_SIZE = 200  # Recipes fetched per database round trip when streaming the catalog through the API
+API_CACHE_CONTROL = 'public, max-age=300'  # Catalog responses may be reused for 5 minutes, then revalidated by ETag
+PAGE_CACHE_CONTROL = 'private, no-cache'  # HTML pages show user details, so browsers must revalidate them every time
+SNAPSHOT_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # Snapshot URLs are versioned, so never change
+CATALOG_CHECK_INTERVAL = 30  # Seconds between checks for a rebuilt catalog (see app/catalog.py)
+CATALOG_FORMAT_VERSION = 1  # Bump when the way recipes are encoded in responses changes, so the catalog digest changes
+API_KEY_CACHE_SIZE = 1024  # Verified API keys cached per worker process (see app/api/api_keys.py)
+API_KEY_CACHE_TTL = 60  # Seconds a verified (or rejected) API key is cached, i.e. how long a revoked key may still work
+API_RATE_LIMIT_BUCKETS = 10000  # Rate limit buckets (API keys or client addresses) kept per worker process
+SEARCH_CACHE_SIZE = 512  # Search result lists cached per worker process (see search_result_ids in main_functions.py)
+SEARCH_CACHE_TTL = 300  # Seconds a search result list is cached
+SEARCH_QUERY_CACHE_SIZE = 256  # Compiled search queries kept per worker process, one per shape of search
+SUGGEST_LIMIT = 8  # Suggestions returned by /api/suggest by default (see app/suggest.py)
+SUGGEST_MAX_LIMIT = 20  # Largest ?limit= accepted by /api/suggest
+SUGGEST_PRECOMPUTED_PREFIX = 2  # Suggestions for prefixes up to this many characters are worked out in advance
+SUGGEST_REBUILD_INTERVAL = 3600  # Seconds between rebuilds of the suggestion index, to follow recipes' popularity
+FUZZY_MIN_RESULTS = 3  # Searches finding fewer recipes than this are retried with typo-tolerant matching (app/fuzzy.py)
+FUZZY_MIN_SIMILARITY = 0.4  # Least trigram similarity of a misspelt word and a word it may be meant as
+FUZZY_MAX_WORDS = 3  # Most alternatives searched for each misspelt word
+PANTRY_MAX_INGREDIENTS = 50  # Most ingredients read from a user's pantry (see app/pantry.py)
+PANTRY_STAPLES = ['salt', 'black pepper', 'water', 'olive oil', 'vegetable oil', 'sunflower oil']  # Taken as in stock
+SIMILAR_RECIPES = 6  # Similar recipes stored for each recipe, and shown on its page (see app/similar.py)
+SIMILAR_RECIPES_CHUNK = 256  # Recipes whose similarities are worked out at once when the catalog is rebuilt
+FACET_CALORIE_BUCKETS = [0, 200, 400, 600, 800, 1000]  # Edges of the calorie ranges counted by /api/facets
+FACET_TIME_BUCKETS = [15, 30, 45, 60, 90, 120, 200]  # Maximum times (in minutes) counted by /api/facets
+ASGI_MAX_THREADS = 8  # Threads running views in the ASGI serving mode (see app/api/asgi.py)
+ASGI_MAX_BUFFERED_CHUNKS = 32  # Response chunks buffered per request in the ASGI serving mode, while the client reads
 MIN_PW_LEN = 6
 MAX_PW_LEN = 20
 DIET_CHOICES = [(1, 'Classic'),
@@ -34,6 +63,26 @@ ALLERGY_CHOICES = [(1, 'Dairy-free'),
                    (9, 'Sesame-free'),
                    (10, 'Soybeans-free'),
                    (11, 'Celery-free')]
+# Nutrients of NutritionValues (in grams per person) which searches can filter on and sort by. Each also has a ratio to
+# calories (e.g. proteins_per_kcal), precomputed in the RecipeNutrition table (see app/catalog.py).
+NUTRIENT_CHOICES = [('fats', 'Fat'),
+                    ('saturates', 'Saturates'),
+                    ('carbs', 'Carbs'),
+                    ('sugars', 'Sugars'),
+                    ('fibres', 'Fibre'),
+                    ('proteins', 'Protein'),
+                    ('salts', 'Salt')]
+NUTRIENT_FILTERS = [nutrient for nutrient, label in NUTRIENT_CHOICES] + \
+                   [nutrient + '_per_kcal' for nutrient, label in NUTRIENT_CHOICES]
+NUTRIENT_SORTS = ['calories'] + NUTRIENT_FILTERS  # Searches are sorted by one of these, '-' in front for descending
+SORT_CHOICES = [('', 'Best match'),
+                ('calories', 'Fewest calories'),
+                ('-proteins', 'Most protein'),
+                ('-proteins_per_kcal', 'Most protein per calorie'),
+                ('-fibres_per_kcal', 'Most fibre per calorie'),
+                ('sugars', 'Least sugar'),
+                ('saturates', 'Least saturated fat'),
+                ('salts', 'Least salt')]
 
 
 class Config(object):
@@ -51,6 +100,25 @@ class Config(object):
     CWD = dirname(abspath(__file__))
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + join(CWD, 'db/mealtime.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SNAPSHOT_DIR = join(CWD, 'db/snapshots')  # Downloadable catalog snapshots, built per generation (app/snapshot.py)
+
+    # Compression config (see app/compression.py)
+    # HTML is not compressed: its pages carry CSRF tokens alongside reflected search text, which would expose the tokens
+    # to a BREACH attack. API responses carry no secrets.
+    COMPRESS_MIMETYPES = ['text/css', 'text/plain', 'application/json', 'application/x-ndjson', 'application/msgpack',
+                          'application/x-msgpack', 'application/cbor', 'application/javascript']
+    COMPRESS_LEVEL = 6  # gzip level/ brotli quality used for dynamic responses; static files are compressed at maximum
+    COMPRESS_MIN_SIZE = 500  # Bytes; smaller responses are not worth compressing
+    COMPRESS_STATIC_EXTENSIONS = ['.css', '.js']  # Static files precompressed by `flask static compress`
+
+    # API rate limits, per API key and worker process (see app/api/api_keys.py)
+    API_RATE_LIMIT = 10  # Requests per second
+    API_RATE_BURST = 100  # Requests which can be made at once, after the key has been idle
+
+    # Proxies in front of the app whose X-Forwarded-For/ -Proto headers are trusted (see ProdConfig). None by default:
+    # without a proxy in front, any client could set X-Forwarded-For to get round the per-address rate limits
+    PROXY_FIX_X_FOR = 0
+    PROXY_FIX_X_PROTO = 0
 
 
 class ProdConfig(Config):
@@ -63,6 +131,11 @@ class ProdConfig(Config):
     DEBUG = False
     TESTING = False
 
+    # Deployed behind one proxy (Heroku's router), so request.remote_addr is the client's address, which the public API
+    # calls are rate limited by
+    PROXY_FIX_X_FOR = 1  # Proxies whose X-Forwarded-For is trusted
+    PROXY_FIX_X_PROTO = 1  # Proxies whose X-Forwarded-Proto is trusted
+
 
 class TestConfig(Config):
     DEBUG = True
@@ -79,10 +152,21 @@ class TestConfig(Config):
 
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + dst
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Each test runs in one connection which is rolled back afterwards (see test/conftest.py). The ASGI tests use that
+    # connection from the ASGI thread pool (one thread at a time), so SQLite must allow it to be shared across threads.
+    SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'check_same_thread': False}}
+
+    # Keep the test database's snapshots apart from the working database's: the app fixture (see test/conftest.py) sets
+    # a temporary folder
+    SNAPSHOT_DIR = None
 
     # To allow forms to be submitted from the tests without the CSRF token
     WTF_CSRF_ENABLED = False
 
+    # So that the tests, which share one API key, are not rate limited
+    API_RATE_LIMIT = 1000
+    API_RATE_BURST = 1000
+
 
 class DevConfig(Config):
     DEBUG = True
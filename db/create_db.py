@@ -684,6 +684,16 @@ c.execute("""CREATE TABLE IF NOT EXISTS UserFavouriteRecipes (
                                         PRIMARY KEY (user_id, recipe_id) 
                                         );""")
 
+c.execute("""CREATE TABLE IF NOT EXISTS ApiKeys (
+                                        key_id integer unique NOT NULL,
+                                        name varchar(40) NOT NULL,
+                                        key_prefix varchar(8) unique NOT NULL,
+                                        key_hash varchar(128) NOT NULL,
+                                        created_at varchar(40),
+                                        revoked integer NOT NULL default 0,
+                                        PRIMARY KEY (key_id)
+                                        );""")
+
 # c.execute("""CREATE TABLE IF NOT EXISTS Nutrition (
 #                                         nutrition_id integer NOT NULL PRIMARY KEY,
 #                                         nutrition_name varchar(40),
@@ -700,3 +710,12 @@ c.execute("""CREATE TABLE IF NOT EXISTS UserFavouriteRecipes (
 
 db.commit
 db.close()
+
+# Build the derived catalog tables (see app/catalog.py) for the freshly scraped recipes. This is the same as running
+# `flask catalog rebuild` from the project root.
+import os
+import subprocess
+import sys
+
+subprocess.run([sys.executable, '-m', 'flask', 'catalog', 'rebuild'], cwd=join(CWD, '..'),
+               env=dict(os.environ, FLASK_APP='run.py'), check=True)
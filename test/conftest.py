@@ -12,7 +12,7 @@ __email__ = "justin.wong.17@ucl.ac.uk"
 __credits__ = ["Danny Wallis", "Justin Wong"]
 __status__ = "Development"
 
-from app import create_app
+from app import create_app, is_reflected
 from app import db as _db
 import config
 
@@ -22,9 +22,10 @@ import random
 
 
 @pytest.yield_fixture(scope='session')
-def app(request):
+def app(request, tmp_path_factory):
     """Create a test client to send requests to"""
     _app = create_app('config.TestConfig')
+    _app.config['SNAPSHOT_DIR'] = str(tmp_path_factory.mktemp('snapshots'))
     ctx = _app.app_context()
     ctx.push()
 
@@ -34,16 +35,26 @@ def app(request):
 
 
 @pytest.fixture(scope='session')
-def test_client(app):
-    """ Exposes the Werkzeug test client for use in the tests. """
-    return app.test_client()
+def api_key(app):
+    """ Creates an API key for the test client. """
+    from app.api.api_keys import create_api_key
+    api_key, key = create_api_key('Test client')
+    return key
+
+
+@pytest.fixture(scope='session')
+def test_client(app, api_key):
+    """ Exposes the Werkzeug test client for use in the tests. API calls are made with the test API key. """
+    client = app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + api_key
+    return client
 
 
 @pytest.yield_fixture(scope='session')
 def db(app):
     _db.app = app
     _db.create_all()
-    _db.Model.metadata.reflect(_db.engine)
+    _db.Model.metadata.reflect(_db.engine, only=is_reflected)
 
     yield _db
     _db.drop_all()
@@ -83,7 +94,12 @@ def user(test_client, db):
 
 @pytest.fixture(scope='function', autouse=True)
 def session(db):
-    """ Rolls back database changes at the end of each test """
+    """
+    Rolls back database changes at the end of each test, and leaves a fresh session for the next test's fixtures. The
+    catalog generation is then re-read, in case the test rebuilt the catalog (so that in-process caches built from the
+    rolled back catalog are not used by later tests).
+    """
+    from app.catalog import current_catalog
     connection = db.engine.connect()
     transaction = connection.begin()
 
@@ -98,6 +114,10 @@ def session(db):
     connection.close()
     session_.remove()
 
+    db.session = db.create_scoped_session()
+    current_catalog(refresh=True)
+    db.session.remove()
+
 
 @pytest.fixture(scope='function')
 def logged_in_user(app, request, user):
@@ -234,13 +254,15 @@ def search_function(client, search_term):
     ), follow_redirects=True)
 
 
-def advanced_search_function(client, search_term="", allergy_list=[], diet_type=1, cal_range="0,1000", time=1000):
+def advanced_search_function(client, search_term="", allergy_list=[], diet_type=1, cal_range="0,1000", time=1000,
+                             **nutrients_and_sort):
     return client.post('/advanced_search', data=dict(
         search_term=search_term,
         allergy_list=allergy_list,
         diet_type=diet_type,
         cals=cal_range,
-        max_time=time
+        max_time=time,
+        **nutrients_and_sort
     ), follow_redirects=True)
 
 
@@ -321,6 +343,51 @@ def send_grocery_list(client, mealplan_id):
     ), follow_redirects=True)
 
 
+# Search helper functions
+def search_tokens(db, text):
+    """
+    Tokenizes text as the full-text search index does (see app/search.py): in lower case, without punctuation, and
+    with each word stemmed (e.g. 'Fried rice!' is 'fri', 'rice').
+
+    :return: list of the tokens of text, in order
+    """
+    from app.search import SEARCH_TOKENIZER
+    from sqlalchemy import text as sql
+
+    db.session.execute(sql(f"CREATE VIRTUAL TABLE IF NOT EXISTS temp.TokenizerTest USING fts5("
+                           f"text, tokenize='{SEARCH_TOKENIZER}')"))
+    db.session.execute(sql("CREATE VIRTUAL TABLE IF NOT EXISTS temp.TokenizerTestTerms USING fts5vocab("
+                           "TokenizerTest, instance)"))
+    db.session.execute(sql("DELETE FROM temp.TokenizerTest"))
+    db.session.execute(sql("INSERT INTO temp.TokenizerTest(text) VALUES (:text)"), {'text': text})
+    return [term for term, in db.session.execute(sql("SELECT term FROM temp.TokenizerTestTerms ORDER BY offset"))]
+
+
+# ASGI helper functions
+async def asgi_get(asgi_app, path, query_string='', headers=None, send=None):
+    """
+    Sends a GET request straight to an ASGI application, as an ASGI server would.
+
+    :param send: coroutine function receiving each ASGI message sent by the application (by default, messages are
+        collected into the returned list)
+    :return: list of ASGI messages sent by the application
+    """
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def collect(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'root_path': '',
+             'path': path, 'query_string': query_string.encode(), 'server': ('localhost', 80),
+             'client': ('127.0.0.1', 50000),
+             'headers': [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]}
+    await asgi_app(scope, receive, send or collect)
+    return messages
+
+
 # Browser helper functions
 def browser_signup(browser, browser_user_data):
     signup_url = url_for('auth.signup', _external=True)
@@ -16,6 +16,7 @@ __credits__ = ["Danny Wallis", "Justin Wong"]
 __status__ = "Development"
 
 
+import json
 import pytest
 import random
 from sqlalchemy.sql import func
@@ -69,3 +70,992 @@ def test_api_read_incorrect_recipe_route_invalid(test_client, db):
     response = test_client.get('/api/recipes/' + str(invalid_recipe), follow_redirects=True)
     assert b'Not Found' in response.data
     assert response.status_code == 404
+
+
+@pytest.mark.parametrize("headers, query_string", [({'Accept': 'application/x-ndjson'}, {}),
+                                                   ({}, {'stream': 1})])
+def test_api_read_recipes_streams_ndjson(test_client, db, headers, query_string):
+    """
+    GIVEN a flask app
+    WHEN a user makes API call to read all recipes as a stream (through Accept header or stream parameter)
+    THEN one JSON recipe is returned per line, for every recipe in the catalog
+    """
+    from app.models import Recipes
+
+    response = test_client.get('/api/recipes', headers=headers, query_string=query_string)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
+    lines = response.data.decode().splitlines()
+    number_of_recipes = db.session.query(func.count(Recipes.recipe_id)).scalar()
+    assert len(lines) == number_of_recipes
+
+    recipe_ids = [json.loads(line)['recipe_id'] for line in lines]
+    assert recipe_ids == sorted(recipe_ids)
+
+
+def test_api_read_recipes_cursor_pagination(test_client, db):
+    """
+    GIVEN a flask app
+    WHEN a user pages through recipes with ?limit= and the returned 'next' cursors
+    THEN every recipe is returned exactly once, in recipe_id order, and the last page has no next cursor
+    """
+    from app.models import Recipes
+
+    number_of_recipes = db.session.query(func.count(Recipes.recipe_id)).scalar()
+
+    recipe_ids = []
+    query_string = {'limit': 100}
+    while True:
+        response = test_client.get('/api/recipes', query_string=query_string)
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page['recipes']) <= 100
+        recipe_ids.extend(recipe['recipe_id'] for recipe in page['recipes'])
+        if page['next'] is None:
+            break
+        query_string = {'limit': 100, 'after': page['next']}
+
+    assert len(recipe_ids) == number_of_recipes
+    assert recipe_ids == sorted(set(recipe_ids))
+
+
+def test_api_read_recipes_after_recipe_id(test_client):
+    """
+    GIVEN a flask app
+    WHEN a user requests a page of recipes after a given recipe_id
+    THEN the page starts with the following recipe
+    """
+    response = test_client.get('/api/recipes', query_string={'limit': 5, 'after': 10})
+    assert response.status_code == 200
+    assert [recipe['recipe_id'] for recipe in response.get_json()['recipes']] == [11, 12, 13, 14, 15]
+
+
+@pytest.mark.parametrize("query_string", [{'limit': 0}, {'limit': 'abc'}, {'limit': -5}, {'limit': 2.5},
+                                          {'limit': 5, 'after': 'not-a-cursor'}, {'after': '\u00b2'},
+                                          {'after': '99999999999999999999'}, {'after': '-5'},
+                                          {'after': 'eyJhZnRlciI6IDk5OTk5OTk5OTk5OTk5OTk5OTk5fQ'},
+                                          {'after': 'eyJhZnRlciI6IHRydWV9'}])
+def test_api_read_recipes_invalid_pagination(test_client, query_string):
+    """
+    GIVEN a flask app
+    WHEN a user makes API call with an invalid limit or cursor (including one with a recipe id too big for SQLite)
+    THEN a 400 error JSON message is returned
+    """
+    response = test_client.get('/api/recipes', query_string=query_string)
+    assert response.status_code == 400
+    assert b'Bad Request' in response.data
+
+
+def test_api_read_recipes_sparse_fields(test_client):
+    """
+    GIVEN a flask app
+    WHEN a user requests recipes with ?fields=
+    THEN only the requested fields (and recipe_id) are returned, with nutrition values nested
+    """
+    response = test_client.get('/api/recipes', query_string={'fields': 'recipe_name,nutrition_values.calories',
+                                                             'limit': 10})
+    assert response.status_code == 200
+    for recipe in response.get_json()['recipes']:
+        assert set(recipe) == {'recipe_id', 'recipe_name', 'nutrition_values'}
+        assert set(recipe['nutrition_values']) == {'calories'}
+
+
+def test_api_read_recipe_sparse_fields_and_include(test_client, db):
+    """
+    GIVEN a flask app
+    WHEN a user requests a recipe with ?fields= and ?include=
+    THEN the requested relationships match the full recipe, and no other relationships are returned
+    """
+    full = test_client.get('/api/recipes/10').get_json()['recipe']
+
+    response = test_client.get('/api/recipes/10', query_string={'fields': 'recipe_id,recipe_name',
+                                                                'include': 'ingredients,allergies,diet_type'})
+    assert response.status_code == 200
+    recipe = response.get_json()['recipe']
+    assert set(recipe) == {'recipe_id', 'recipe_name', 'recipe_ingredients', 'recipe_allergies', 'diet_type'}
+    for key in recipe:
+        assert recipe[key] == full[key]
+
+
+@pytest.mark.parametrize("query_string", [{'fields': 'password'}, {'include': 'users'}])
+def test_api_read_recipes_unknown_field_invalid(test_client, query_string):
+    """
+    GIVEN a flask app
+    WHEN a user requests an unknown field or relationship
+    THEN a 400 error JSON message is returned
+    """
+    response = test_client.get('/api/recipes', query_string=query_string)
+    assert response.status_code == 400
+    assert b'Unknown' in response.data
+
+
+@pytest.mark.parametrize("url", ['/api/recipes/5', '/api/recipes?limit=10', '/recipe/5'])
+def test_conditional_get_returns_not_modified(test_client, url):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN a client requests a recipe (API or page) again with the ETag it was given
+    THEN a 304 Not Modified is returned with no body
+    """
+    response = test_client.get(url)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+    assert response.headers['Cache-Control']
+
+    response = test_client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.data == b''
+
+
+def test_conditional_get_if_modified_since(test_client):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN a client requests a recipe with If-Modified-Since set to the Last-Modified it was given
+    THEN a 304 Not Modified is returned
+    """
+    response = test_client.get('/api/recipes/5')
+    response = test_client.get('/api/recipes/5', headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert response.status_code == 304
+
+
+def test_etag_varies_with_recipe_and_fields(test_client):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN a client requests different recipes, or the same recipe with different fields
+    THEN each response has a different ETag, and a stale ETag gets a full response
+    """
+    etag = test_client.get('/api/recipes/5').headers['ETag']
+    assert test_client.get('/api/recipes/6').headers['ETag'] != etag
+
+    response = test_client.get('/api/recipes/5', query_string={'fields': 'recipe_name'},
+                               headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_rebuild_catalog_keeps_recipe_digests(app, db):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN the catalog is rebuilt from unchanged recipe tables
+    THEN a new generation is stamped, but recipe digests (and so ETags) are unchanged
+    """
+    from app.catalog import current_catalog
+
+    before = current_catalog(refresh=True)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['catalog', 'rebuild'])
+    assert 'Catalog rebuilt' in result.output
+
+    after = current_catalog()
+    assert after.generation == before.generation + 1
+    assert after.catalog_digest == before.catalog_digest
+    assert after.recipe_digests == before.recipe_digests
+
+
+def test_rebuild_catalog_changes_derived_data_etags(test_client, db):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN the catalog is rebuilt from unchanged recipe tables
+    THEN responses made from the derived tables (searches, similar recipes, the snapshot manifest) get new ETags, as
+        the derived tables may have changed, but recipes keep theirs
+    """
+    from app.catalog import current_catalog, rebuild_catalog
+    from app.snapshot import build_snapshots
+
+    build_snapshots(current_catalog(refresh=True))
+    urls = ['/api/search?search_term=chicken', '/api/pantry?ingredients=rice', '/api/recipes/5/similar',
+            '/api/catalog/snapshot', '/api/recipes/5']
+    etags = [test_client.get(url).headers.get('ETag') for url in urls]
+    assert all(etags)
+    rebuild_catalog()
+
+    responses = [test_client.get(url, headers={'If-None-Match': etag}) for url, etag in zip(urls, etags)]
+    assert [response.status_code for response in responses] == [200, 200, 200, 200, 304]
+
+
+def test_rebuild_catalog_new_format_changes_digest(app, db, monkeypatch):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN the catalog is rebuilt from unchanged recipe tables, after the derived catalog data's format version changes
+    THEN the catalog digest (and so the catalog's ETags) changes
+    """
+    from app.catalog import current_catalog, rebuild_catalog
+    import config
+
+    before = rebuild_catalog()
+    monkeypatch.setattr(config, 'CATALOG_FORMAT_VERSION', config.CATALOG_FORMAT_VERSION + 1)
+    after = rebuild_catalog()
+    assert after.generation == before.generation + 1
+    assert after.catalog_digest != before.catalog_digest
+    assert current_catalog().catalog_digest == after.catalog_digest
+
+
+def test_api_read_recipe_from_store_matches_recipe_tables(test_client, db):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN a user makes API call to read a single recipe (served from the pre-encoded CatalogRecipes store)
+    THEN the recipe is the same as one serialized from the recipe tables
+    """
+    from app.models import Recipes
+
+    recipe_id = random.randint(0, 1400)
+    response = test_client.get('/api/recipes/' + str(recipe_id))
+    assert response.status_code == 200
+    assert response.get_json()['recipe'] == Recipes.query.get(recipe_id).serialize
+
+
+def test_api_read_recipes_batch(test_client, db):
+    """
+    GIVEN a flask app
+    WHEN a user requests several recipes in one batch call, including ids that do not exist
+    THEN existing recipes are returned keyed by id, and the missing ids are reported instead of a 404
+    """
+    from app.models import Recipes
+
+    response = test_client.get('/api/recipes/batch', query_string={'ids': '1,5,9,999999'})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert set(data['recipes']) == {'1', '5', '9'}
+    assert data['missing'] == [999999]
+    assert data['recipes']['5'] == Recipes.query.get(5).serialize
+
+
+def test_api_read_recipes_batch_post_with_fields(test_client):
+    """
+    GIVEN a flask app
+    WHEN a user posts a batch of recipe ids with ?fields=
+    THEN only the requested fields of each recipe are returned
+    """
+    ids = list(range(50))
+    response = test_client.post('/api/recipes/batch?fields=recipe_name', json={'ids': ids})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert sorted(map(int, data['recipes'])) == ids
+    assert data['missing'] == []
+    for recipe in data['recipes'].values():
+        assert set(recipe) == {'recipe_id', 'recipe_name'}
+
+
+@pytest.mark.parametrize("query_string", [{}, {'ids': 'one,two'}, {'ids': ','.join(map(str, range(101)))},
+                                          {'ids': '99999999999999999999'}, {'ids': '5,-1'}])
+def test_api_read_recipes_batch_invalid(test_client, query_string):
+    """
+    GIVEN a flask app
+    WHEN a user makes a batch call with no ids, malformed ids or too many ids
+    THEN a 400 error JSON message is returned
+    """
+    response = test_client.get('/api/recipes/batch', query_string=query_string)
+    assert response.status_code == 400
+    assert b'Bad Request' in response.data
+
+
+@pytest.mark.parametrize("ids", [[1, True], [1.7], ['5'], [5, None], [[5]], [99999999999999999999], [-1]])
+def test_api_read_recipes_batch_post_invalid(test_client, ids):
+    """
+    GIVEN a flask app
+    WHEN a user posts a batch of ids which are not all integers (booleans, floats, strings, null or lists), or are
+        out of range
+    THEN a 400 error JSON message is returned
+    """
+    response = test_client.post('/api/recipes/batch', json={'ids': ids})
+    assert response.status_code == 400
+    assert b'Bad Request' in response.data
+
+
+@pytest.mark.parametrize("encoding", ['gzip', 'br'])
+def test_api_read_recipes_compressed(test_client, encoding):
+    """
+    GIVEN a flask app
+    WHEN a user who accepts gzip or brotli makes API calls for recipes (as JSON, and as a NDJSON stream)
+    THEN the responses are compressed with that encoding, and decompress to the uncompressed response
+    """
+    import brotli
+    import gzip
+    decompress = brotli.decompress if encoding == 'br' else gzip.decompress
+
+    for query_string in [{'limit': 50}, {'stream': 1}]:
+        plain = test_client.get('/api/recipes', query_string=query_string)
+        response = test_client.get('/api/recipes', query_string=query_string,
+                                   headers={'Accept-Encoding': encoding})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == encoding
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert decompress(response.data) == plain.data
+        assert len(response.data) < len(plain.data)
+
+
+def test_api_small_response_not_compressed(test_client):
+    """
+    GIVEN a flask app
+    WHEN a user who accepts gzip makes an API call with a response smaller than COMPRESS_MIN_SIZE
+    THEN the response is not compressed
+    """
+    response = test_client.get('/api/recipes/5', query_string={'fields': 'recipe_id'},
+                               headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.data) == {'recipe': {'recipe_id': 5}}
+
+
+def test_api_search_matches_search_function(test_client, db):
+    """
+    GIVEN a flask app
+    WHEN a user pages through API search results with the diet, allergy, calorie and time parameters
+    THEN the results are compact, the total is correct, and the pages together hold every recipe found by
+        search_function with the same parameters, in the same order
+    """
+    from app.main.main_functions import search_function
+
+    query_string = {'search_term': 'chicken', 'diet_type': 1, 'allergy_list': '1,4', 'min_cal': 100,
+                    'max_cal': 800, 'time': 60, 'limit': 10}
+    expected = [recipe.recipe_id for recipe in search_function('chicken', 1, [1, 4], 100, 800, 60)]
+    assert len(expected) > 10
+
+    recipe_ids = []
+    cursor = None
+    while True:
+        response = test_client.get('/api/search', query_string=dict(query_string, **({'after': cursor} if cursor
+                                                                                      else {})))
+        assert response.status_code == 200
+        page = json.loads(response.data)
+        assert page['total'] == len(expected)
+        assert len(page['results']) <= 10
+        for result in page['results']:
+            assert set(result) == {'recipe_id', 'recipe_name', 'photo', 'total_time', 'nutrition_values'}
+        recipe_ids += [result['recipe_id'] for result in page['results']]
+        cursor = page['next']
+        if cursor is None:
+            break
+    assert recipe_ids == expected
+
+
+def test_api_search_nutrient_ranges_and_sort(test_client, db):
+    """
+    GIVEN a flask app
+    WHEN a user makes an API search for recipes with at least 30g protein and at most 1g salt, sorted by protein per
+        kcal
+    THEN every recipe found is in those ranges, and they are in descending order of protein per kcal
+    """
+    from app.models import NutritionValues
+
+    response = test_client.get('/api/search', query_string={'min_proteins': 30, 'max_salts': 1,
+                                                             'sort': '-proteins_per_kcal', 'limit': 100})
+    assert response.status_code == 200
+    page = json.loads(response.data)
+    recipe_ids = [result['recipe_id'] for result in page['results']]
+    assert recipe_ids and page['total'] >= len(recipe_ids)
+
+    nutrition = {row.recipe_id: row for row in db.session.query(NutritionValues)
+                 .filter(NutritionValues.recipe_id.in_(recipe_ids))}
+    for recipe_id in recipe_ids:
+        assert nutrition[recipe_id].proteins >= 30
+        assert nutrition[recipe_id].salts <= 1
+    ratios = [nutrition[recipe_id].proteins / nutrition[recipe_id].calories for recipe_id in recipe_ids]
+    assert ratios == sorted(ratios, reverse=True)
+
+
+@pytest.mark.parametrize("query_string", [{'allergy_list': 'dairy'}, {'limit': 0}, {'limit': 'abc'},
+                                          {'after': 'not-a-cursor'},
+                                          {'sort': 'tastiness'}, {'sort': '-'}])
+def test_api_search_invalid(test_client, query_string):
+    """
+    GIVEN a flask app
+    WHEN a user makes an API search with a malformed allergy list, limit, cursor or sort order
+    THEN a 400 Bad Request is returned
+    """
+    response = test_client.get('/api/search', query_string=query_string)
+    assert response.status_code == 400
+    assert b'Bad Request' in response.data
+
+
+@pytest.mark.parametrize("mimetype", ['application/msgpack', 'application/x-msgpack', 'application/cbor'])
+@pytest.mark.parametrize("url, query_string", [('/api/recipes', {'limit': 20}),
+                                               ('/api/recipes', {'limit': 5, 'fields': 'recipe_name',
+                                                                 'include': 'ingredients'}),
+                                               ('/api/recipes/5', {}),
+                                               ('/api/recipes/batch', {'ids': '5,9,999999'}),
+                                               ('/api/search', {'search_term': 'chicken'})])
+def test_api_binary_formats_match_json(test_client, mimetype, url, query_string):
+    """
+    GIVEN a flask app
+    WHEN a server-to-server client asks for MessagePack or CBOR through the Accept header
+    THEN the response has that content type, and decodes to the same document as the JSON response
+    """
+    import cbor2
+    import msgpack
+    decode = cbor2.loads if mimetype == 'application/cbor' else msgpack.unpackb
+
+    json_response = test_client.get(url, query_string=query_string)
+    response = test_client.get(url, query_string=query_string, headers={'Accept': mimetype})
+    assert response.status_code == 200
+    assert response.mimetype == mimetype
+    assert 'Accept' in response.headers['Vary']
+    assert decode(response.data) == json.loads(json_response.data)
+    assert response.headers['ETag'] != json_response.headers['ETag']
+
+
+def test_api_unacceptable_format_falls_back_to_json(test_client):
+    """
+    GIVEN a flask app
+    WHEN a client accepts no format the API can respond in
+    THEN the response is JSON
+    """
+    response = test_client.get('/api/recipes/5', headers={'Accept': 'application/xml'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.data)['recipe']['recipe_id'] == 5
+
+
+@pytest.mark.parametrize("headers", [{}, {'Authorization': 'Bearer wrongkey.secret'}, {'Authorization': 'Basic abc'}])
+def test_api_requires_valid_api_key(app, headers):
+    """
+    GIVEN a flask app
+    WHEN a client makes an API call without an API key, with an unknown key or with another kind of credentials
+    THEN a 401 Unauthorized is returned
+    """
+    response = app.test_client().get('/api/recipes/5', headers=headers)
+    assert response.status_code == 401
+    assert response.headers['WWW-Authenticate'].startswith('Bearer')
+    assert json.loads(response.data)['status'] == 401
+
+
+def test_api_key_verification_cached_and_revoked(app, monkeypatch):
+    """
+    GIVEN a flask app and a new API key
+    WHEN the key is used several times, and then revoked with `flask apikeys revoke`
+    THEN the key's hash is only checked once while it is cached, and the revoked key is refused
+    """
+    from app.api.api_keys import create_api_key
+    from app.models import ApiKeys
+
+    api_key, key = create_api_key('Cache test')
+    checks = []
+    check_key = ApiKeys.check_key
+    monkeypatch.setattr(ApiKeys, 'check_key', lambda self, key: checks.append(key) or check_key(self, key))
+
+    client = app.test_client()
+    for _ in range(3):
+        response = client.get('/api/recipes/5', headers={'Authorization': 'Bearer ' + key})
+        assert response.status_code == 200
+    assert len(checks) == 1
+
+    result = app.test_cli_runner().invoke(args=['apikeys', 'revoke', api_key.key_prefix])
+    assert 'Revoked' in result.output
+    response = client.get('/api/recipes/5', headers={'Authorization': 'Bearer ' + key})
+    assert response.status_code == 401
+
+
+def test_api_rate_limited_per_key(app, monkeypatch):
+    """
+    GIVEN a flask app with a rate limit of 3 requests at once, then 1 request every 4 seconds
+    WHEN one API key makes 4 requests at once
+    THEN the 4th request is refused with 429 Too Many Requests and a Retry-After header, while other keys are not
+        limited
+    """
+    from app.api.api_keys import create_api_key
+    monkeypatch.setitem(app.config, 'API_RATE_LIMIT', 0.25)
+    monkeypatch.setitem(app.config, 'API_RATE_BURST', 3)
+
+    api_key, key = create_api_key('Rate limit test')
+    client = app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + key
+    for _ in range(3):
+        assert client.get('/api/recipes/5').status_code == 200
+
+    response = client.get('/api/recipes/5')
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= 4
+    assert b'Too Many Requests' in response.data
+
+
+def test_api_public_calls_rate_limited_per_client_behind_proxy(app, monkeypatch):
+    """
+    GIVEN a flask app behind a proxy (configured as in ProdConfig), with a rate limit of 3 requests at once, then 1
+        request every 4 seconds
+    WHEN one visitor asks for 4 suggestions at once (without an API key), through the proxy
+    THEN the visitor's 4th request is refused with 429 Too Many Requests, while another visitor, whose requests come
+        from the same proxy, is not limited
+    """
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    import config
+
+    monkeypatch.setitem(app.config, 'API_RATE_LIMIT', 0.25)
+    monkeypatch.setitem(app.config, 'API_RATE_BURST', 3)
+    monkeypatch.setattr(app, 'wsgi_app', ProxyFix(app.wsgi_app, x_for=config.ProdConfig.PROXY_FIX_X_FOR,
+                                                  x_proto=config.ProdConfig.PROXY_FIX_X_PROTO))
+
+    client = app.test_client()
+    proxy = {'REMOTE_ADDR': '10.1.2.3'}
+    for _ in range(3):
+        response = client.get('/api/suggest?q=rice', headers={'X-Forwarded-For': '203.0.113.7'}, environ_base=proxy)
+        assert response.status_code == 200
+    response = client.get('/api/suggest?q=rice', headers={'X-Forwarded-For': '203.0.113.7'}, environ_base=proxy)
+    assert response.status_code == 429
+
+    response = client.get('/api/suggest?q=rice', headers={'X-Forwarded-For': '198.51.100.20'}, environ_base=proxy)
+    assert response.status_code == 200
+
+
+def test_api_public_calls_ignore_forwarded_for_without_proxy(app, monkeypatch):
+    """
+    GIVEN a flask app which is not configured to be behind a proxy, with a rate limit of 3 requests at once, then 1
+        request every 4 seconds
+    WHEN a client asks for 4 suggestions at once (without an API key), setting a different X-Forwarded-For each time
+    THEN the client's 4th request is still refused with 429 Too Many Requests
+    """
+    monkeypatch.setitem(app.config, 'API_RATE_LIMIT', 0.25)
+    monkeypatch.setitem(app.config, 'API_RATE_BURST', 3)
+
+    client = app.test_client()
+    statuses = [client.get('/api/suggest?q=rice', headers={'X-Forwarded-For': f'203.0.113.{i}'},
+                           environ_base={'REMOTE_ADDR': '10.4.5.6'}).status_code for i in range(4)]
+    assert statuses == [200, 200, 200, 429]
+
+
+def test_token_bucket_limiter_refills():
+    """
+    GIVEN a token bucket limiter
+    WHEN a key spends its whole bucket, and time passes
+    THEN further requests are refused until the bucket has refilled at the given rate
+    """
+    from app.api.api_keys import TokenBucketLimiter
+    import time
+
+    limiter = TokenBucketLimiter()
+    assert [limiter.consume('key', rate=100, burst=2) for _ in range(2)] == [0, 0]
+    retry_after = limiter.consume('key', rate=100, burst=2)
+    assert 0 < retry_after <= 0.01
+    assert limiter.consume('other key', rate=100, burst=2) == 0
+
+    time.sleep(0.02)
+    assert limiter.consume('key', rate=100, burst=2) == 0
+
+
+def test_token_bucket_limiter_bounded():
+    """
+    GIVEN a token bucket limiter which keeps at most 2 buckets
+    WHEN 3 keys make requests
+    THEN only the 2 most recently used buckets are kept, and a dropped key starts again from a full bucket
+    """
+    from app.api.api_keys import TokenBucketLimiter
+
+    limiter = TokenBucketLimiter(max_buckets=2)
+    assert limiter.consume('a', rate=0.001, burst=1) == 0
+    assert limiter.consume('b', rate=0.001, burst=1) == 0
+    assert limiter.consume('a', rate=0.001, burst=1) > 0  # "a" is now the most recently used
+    assert limiter.consume('c', rate=0.001, burst=1) == 0
+    assert list(limiter._buckets) == ['a', 'c']
+    assert limiter.consume('b', rate=0.001, burst=1) == 0
+
+
+@pytest.mark.parametrize("url, query_string", [('/api/recipes/5', ''), ('/api/recipes', 'limit=10'),
+                                               ('/api/recipes', 'stream=1'), ('/api/recipes/999999', '')])
+def test_asgi_app_matches_wsgi_app(app, test_client, api_key, url, query_string):
+    """
+    GIVEN the Flask app, served as an ASGI application
+    WHEN an API call is made through the ASGI application
+    THEN the status, content type and body are the same as through the WSGI application
+    """
+    from app.api.asgi import AsgiApp
+    from test.conftest import asgi_get
+    import asyncio
+
+    messages = asyncio.get_event_loop().run_until_complete(
+        asgi_get(AsgiApp(app.wsgi_app), url, query_string, headers={'Authorization': 'Bearer ' + api_key}))
+    response = test_client.get(url + '?' + query_string)
+
+    assert messages[0]['type'] == 'http.response.start'
+    assert messages[0]['status'] == response.status_code
+    assert (b'content-type', response.headers['Content-Type'].encode()) in messages[0]['headers']
+    assert b''.join(message.get('body', b'') for message in messages[1:]) == response.data
+    assert messages[-1]['more_body'] is False
+
+
+def test_asgi_app_slow_client_does_not_hold_thread(app, api_key):
+    """
+    GIVEN the Flask app, served as an ASGI application with a single thread
+    WHEN a slow client streams the whole catalog, and another client then asks for one recipe
+    THEN the single recipe is served while the slow client is still downloading the catalog
+    """
+    from app.api.asgi import AsgiApp
+    from test.conftest import asgi_get
+    import asyncio
+
+    asgi_app = AsgiApp(app.wsgi_app, max_threads=1)
+    headers = {'Authorization': 'Bearer ' + api_key}
+    finished = []
+
+    async def slow_send(message):
+        await asyncio.sleep(0.05)
+
+    async def slow_client():
+        await asgi_get(asgi_app, '/api/recipes', 'stream=1', headers, send=slow_send)
+        finished.append('catalog')
+
+    async def fast_client():
+        await asyncio.sleep(0.1)  # Let the slow client's stream start first
+        messages = await asgi_get(asgi_app, '/api/recipes/5', headers=headers)
+        assert messages[0]['status'] == 200
+        finished.append('recipe')
+
+    asyncio.get_event_loop().run_until_complete(asyncio.gather(slow_client(), fast_client()))
+    assert finished == ['recipe', 'catalog']
+
+
+def test_asgi_app_client_disconnect_frees_thread(app, api_key):
+    """
+    GIVEN the Flask app, served as an ASGI application with a single thread, and a tiny response buffer
+    WHEN a client disconnects in the middle of streaming the catalog
+    THEN the thread stops producing the stream, and serves the next request
+    """
+    from app.api.asgi import AsgiApp
+    from test.conftest import asgi_get
+    import asyncio
+
+    asgi_app = AsgiApp(app.wsgi_app, max_threads=1, max_buffered_chunks=1)
+    headers = {'Authorization': 'Bearer ' + api_key}
+
+    async def disconnecting_send(message):
+        if message['type'] == 'http.response.body':
+            raise ConnectionResetError
+
+    loop = asyncio.get_event_loop()
+    with pytest.raises(ConnectionResetError):
+        loop.run_until_complete(asgi_get(asgi_app, '/api/recipes', 'stream=1', headers, send=disconnecting_send))
+
+    messages = loop.run_until_complete(asyncio.wait_for(asgi_get(asgi_app, '/api/recipes/5', headers=headers), 5))
+    assert messages[0]['status'] == 200
+
+
+def test_api_catalog_snapshot_downloads(test_client, db, tmp_path):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN a user reads the catalog snapshot manifest, and downloads the snapshots it lists
+    THEN the SQLite snapshot holds the catalog tables (and no user data) stamped with the catalog generation, and the
+        nutrition snapshot holds every recipe's nutrition values as columns
+    """
+    from app.catalog import current_catalog
+    from app.models import Recipes, NutritionValues
+    from app.snapshot import build_snapshots
+    import io
+    import numpy as np
+    import sqlite3
+
+    build_snapshots(current_catalog())
+    response = test_client.get('/api/catalog/snapshot')
+    assert response.status_code == 200
+    manifest = json.loads(response.data)
+    generation = current_catalog().generation
+    assert manifest['generation'] == generation
+    assert set(manifest['files']) == {'catalog.db', 'nutrition.npz'}
+
+    number_of_recipes = db.session.query(func.count(Recipes.recipe_id)).scalar()
+
+    response = test_client.get(manifest['files']['catalog.db']['url'])
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.sqlite3'
+    assert len(response.data) == manifest['files']['catalog.db']['size']
+    assert f'mealtime-catalog-{generation}-' in response.headers['Content-Disposition']
+    (tmp_path / 'catalog.db').write_bytes(response.data)
+    snapshot = sqlite3.connect(str(tmp_path / 'catalog.db'))
+    tables = {name for name, in snapshot.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert 'Recipes' in tables and 'RecipeIngredients' in tables
+    assert 'Users' not in tables and 'ApiKeys' not in tables
+    assert snapshot.execute('SELECT count(*) FROM Recipes').fetchone()[0] == number_of_recipes
+    assert snapshot.execute('PRAGMA user_version').fetchone()[0] == generation
+    snapshot.close()
+
+    response = test_client.get(manifest['files']['nutrition.npz']['url'])
+    assert response.status_code == 200
+    nutrition = np.load(io.BytesIO(response.data))
+    assert len(nutrition['recipe_id']) == number_of_recipes
+    assert (np.diff(nutrition['recipe_id']) > 0).all()
+    calories, = db.session.query(NutritionValues.calories).filter(NutritionValues.recipe_id == 5).first()
+    assert nutrition['calories'][np.searchsorted(nutrition['recipe_id'], 5)] == calories
+
+
+def test_api_catalog_snapshot_conditional_and_range(test_client):
+    """
+    GIVEN a flask app with a built catalog
+    WHEN a user resumes a snapshot download with a Range header, re-downloads it with If-None-Match, or asks for the
+        snapshot of an old catalog generation
+    THEN the requested range (206), Not Modified (304), or Not Found (404) is returned
+    """
+    from app.catalog import current_catalog
+    from app.snapshot import build_snapshots
+
+    build_snapshots(current_catalog())
+    manifest = json.loads(test_client.get('/api/catalog/snapshot').data)
+    url = manifest['files']['catalog.db']['url']
+    full = test_client.get(url)
+
+    response = test_client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == full.data[100:200]
+
+    response = test_client.get(url, headers={'If-None-Match': full.headers['ETag']})
+    assert response.status_code == 304
+
+    old_url = url.replace(f"/snapshot/{manifest['generation']}/", f"/snapshot/{manifest['generation'] - 1}/")
+    assert test_client.get(old_url).status_code == 404
+
+
+def test_api_catalog_snapshot_not_built_in_request(app, test_client, tmp_path, monkeypatch):
+    """
+    GIVEN a flask app whose snapshots have not been built
+    WHEN a user reads the catalog snapshot manifest, or downloads a snapshot
+    THEN 503 Service Unavailable (with Retry-After) or 404 is returned, and no snapshot is built by the request
+    """
+    from app.catalog import current_catalog
+
+    monkeypatch.setitem(app.config, 'SNAPSHOT_DIR', str(tmp_path))
+    response = test_client.get('/api/catalog/snapshot')
+    assert response.status_code == 503
+    assert 'Retry-After' in response.headers
+    generation = current_catalog().generation
+    assert test_client.get(f'/api/catalog/snapshot/{generation}/catalog.db').status_code == 404
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_build_snapshots_only_deletes_older_generations(app, db, tmp_path, monkeypatch):
+    """
+    GIVEN a snapshot folder holding snapshots of an older and a newer catalog generation than the worker's
+    WHEN the worker's (stale) catalog builds its snapshots
+    THEN the older generation's snapshots are deleted, and the newest generation's are kept
+    """
+    from app.catalog import current_catalog
+    from app.snapshot import build_snapshots
+
+    monkeypatch.setitem(app.config, 'SNAPSHOT_DIR', str(tmp_path))
+    catalog = current_catalog()
+    older = tmp_path / f'mealtime-catalog-{catalog.generation - 1}-0123abcd.db'
+    older.write_bytes(b'old')
+    newest = tmp_path / f'mealtime-catalog-{catalog.generation}-{catalog.catalog_digest[:8]}.db'
+    newer = tmp_path / f'mealtime-catalog-{catalog.generation + 1}-4567cdef.db'
+    newer.write_bytes(b'new')
+
+    build_snapshots(catalog)
+    assert not older.exists()
+    assert newest.exists() and newer.exists()
+
+
+def test_api_stats_counts_search_cache_hits(test_client):
+    """
+    GIVEN a flask app
+    WHEN the same search results page is viewed twice
+    THEN the API stats show one more search cache hit
+    """
+    before = json.loads(test_client.get('/api/stats').data)['search_results']
+    test_client.get('/recipes', query_string={'search_term': 'stats test'})
+    test_client.get('/recipes', query_string={'search_term': 'stats test'})
+
+    response = test_client.get('/api/stats')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-store'
+    after = json.loads(response.data)['search_results']
+    assert set(after) == {'size', 'hits', 'misses'}
+    assert after['hits'] == before['hits'] + 1
+
+
+def test_api_suggest_without_api_key(app, db):
+    """
+    GIVEN a flask app
+    WHEN the site's search bar asks for suggestions as the user types (without an API key)
+    THEN the suggested recipes have a word starting with what was typed, up to the limit, without querying the database
+    """
+    from sqlalchemy import event
+    from app.suggest import suggest_index, _refresh_lock
+    suggest_index()
+    with _refresh_lock:  # Wait for any refresh of the index started on a background thread
+        pass
+
+    statements = []
+
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    client = app.test_client()
+    event.listen(db.engine, 'before_cursor_execute', record_statement)
+    try:
+        responses = [client.get('/api/suggest', query_string=query_string)
+                     for query_string in [{'q': 'Fried ri'}, {'q': 'c', 'limit': 3}, {'q': ' '}]]
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    suggestions = [json.loads(response.data)['suggestions'] for response in responses]
+    assert suggestions[0]
+    for suggestion in suggestions[0]:
+        assert 'fried rice' in suggestion['recipe_name'].lower()
+    assert len(suggestions[1]) == 3
+    for suggestion in suggestions[1]:
+        assert any(word.startswith('c') for word in suggestion['recipe_name'].lower().split())
+    assert suggestions[2] == []
+    assert statements == []
+
+
+def test_suggest_index_rebuilt_in_background(app, db, monkeypatch):
+    """
+    GIVEN a flask app with a suggestion index which is out of date
+    WHEN suggestions are asked for
+    THEN the out of date index is returned without waiting, and replaced by a rebuilt index on a background thread
+    """
+    from app import suggest
+    from threading import Event
+    import config
+    import time
+
+    suggest.suggest_index()
+    with suggest._refresh_lock:
+        pass
+    old_index = suggest._cache['index']
+    suggest._cache['checked_at'] = suggest._cache['built_at'] = time.monotonic() - config.SUGGEST_REBUILD_INTERVAL - 1
+
+    rebuild_allowed = Event()
+    build = suggest.SuggestIndex.build.__func__
+
+    def slow_build(cls):
+        rebuild_allowed.wait(10)
+        return build(cls)
+
+    monkeypatch.setattr(suggest.SuggestIndex, 'build', classmethod(slow_build))
+    assert suggest.suggest_index() is old_index
+    assert suggest._refresh_lock.locked()
+    assert suggest.suggest_index() is old_index  # Only one background refresh runs at a time
+
+    rebuild_allowed.set()
+    with suggest._refresh_lock:
+        pass
+    assert suggest._cache['index'] is not old_index
+    assert suggest.suggest_index() is suggest._cache['index']
+
+
+def test_suggest_index_ranks_by_popularity():
+    """
+    GIVEN a suggestion index of a few recipes, one of which is popular
+    WHEN suggestions are made for prefixes of words anywhere in the recipe names
+    THEN the popular recipe is suggested first, then the others by name
+    """
+    from collections import Counter
+    from app.suggest import SuggestIndex
+
+    index = SuggestIndex([(1, 'Egg fried rice'), (2, 'Fried chicken'), (3, 'Rice pudding'), (4, "Chef's rice-cakes")],
+                         Counter({3: 5, 2: 1}))
+    assert index.suggest('ri') == [(3, 'Rice pudding'), (4, "Chef's rice-cakes"), (1, 'Egg fried rice')]
+    assert index.suggest('FRIED') == [(2, 'Fried chicken'), (1, 'Egg fried rice')]
+    assert index.suggest('fried ri') == [(1, 'Egg fried rice')]
+    assert index.suggest('rice cak') == [(4, "Chef's rice-cakes")]
+    assert index.suggest('ri', limit=1) == [(3, 'Rice pudding')]
+    assert index.suggest('x') == []
+
+
+def test_api_pantry_search(test_client, db):
+    """
+    GIVEN a flask app
+    WHEN a user makes an API pantry search with the ingredients they have, and pages through the results
+    THEN each result has the number of its ingredients used and missing, with the fewest missing first, and the pages
+        hold every recipe found
+    """
+    query_string = {'ingredients': 'chicken,rice,red pepper', 'diet_type': 1, 'limit': 50}
+    results = []
+    cursor = None
+    while True:
+        response = test_client.get('/api/pantry', query_string=dict(query_string, **({'after': cursor} if cursor
+                                                                                       else {})))
+        assert response.status_code == 200
+        page = json.loads(response.data)
+        results += page['results']
+        cursor = page['next']
+        if cursor is None:
+            break
+
+    assert results and len(results) == page['total']
+    assert len({result['recipe_id'] for result in results}) == len(results)
+    for result in results:
+        assert result['ingredients_used'] >= 1
+    missing = [result['ingredients_missing'] for result in results]
+    assert missing == sorted(missing)
+
+
+@pytest.mark.parametrize("query_string", [{}, {'ingredients': ' , '}, {'ingredients': 'rice', 'allergy_list': 'nuts'}])
+def test_api_pantry_search_invalid(test_client, query_string):
+    """
+    GIVEN a flask app
+    WHEN a user makes an API pantry search without ingredients, or with a malformed allergy list
+    THEN a 400 Bad Request is returned
+    """
+    response = test_client.get('/api/pantry', query_string=query_string)
+    assert response.status_code == 400
+
+
+def test_api_read_similar_recipes(test_client, db):
+    """
+    GIVEN a flask app
+    WHEN a user makes an API call for the recipes similar to a recipe, and for a recipe which does not exist
+    THEN up to the limit of compact results (and at most config.SIMILAR_RECIPES) are returned, most similar first,
+        and a 404 for the missing recipe
+    """
+    from app.models import Recipes
+    import config
+
+    response = test_client.get('/api/recipes/5/similar', query_string={'limit': 3})
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert len(results) == 3
+    similarities = [result['similarity'] for result in results]
+    assert similarities == sorted(similarities, reverse=True)
+    assert 5 not in [result['recipe_id'] for result in results]
+    for result in results:
+        assert set(result) == {'recipe_id', 'recipe_name', 'photo', 'total_time', 'nutrition_values', 'similarity'}
+
+    response = test_client.get('/api/recipes/5/similar', query_string={'limit': 99999999999999999999})
+    assert response.status_code == 200
+    assert 0 < len(json.loads(response.data)['results']) <= config.SIMILAR_RECIPES
+
+    missing_recipe_id = db.session.query(func.max(Recipes.recipe_id)).scalar() + 1
+    response = test_client.get(f'/api/recipes/{missing_recipe_id}/similar')
+    assert response.status_code == 404
+
+
+def test_api_facets_without_api_key(app, db):
+    """
+    GIVEN a flask app
+    WHEN the advanced search page asks how many recipes its search would find (without an API key)
+    THEN the total is the number of recipes the search finds, and there are counts for every diet type, allergy,
+        calorie range and maximum time
+    """
+    from app.main.main_functions import search_result_ids
+    import config
+
+    client = app.test_client()
+    query_string = {'search_term': 'chicken', 'diet_type': 1, 'allergy_list': '2', 'min_cal': 100, 'max_cal': 700,
+                    'time': 60}
+    response = client.get('/api/facets', query_string=query_string)
+    assert response.status_code == 200
+    facets = json.loads(response.data)
+
+    with app.test_request_context():
+        expected = search_result_ids({'search_term': 'chicken', 'diet_type': 1, 'allergy_list': [2], 'min_cal': 100,
+                                      'max_cal': 700, 'time': 60})
+    assert facets['total'] == len(expected)
+    assert [facet['diet_type_id'] for facet in facets['diet_types']] == [diet_type for diet_type, _ in
+                                                                          config.DIET_CHOICES]
+    assert facets['diet_types'][0]['count'] == facets['total']
+    assert [facet['allergy_id'] for facet in facets['allergies']] == [allergy for allergy, _ in config.ALLERGY_CHOICES]
+    assert facets['allergies'][1]['count'] == facets['total']  # Gluten-free is already excluded
+    assert len(facets['calories']) == len(config.FACET_CALORIE_BUCKETS) - 1
+    assert [facet['time'] for facet in facets['time']] == config.FACET_TIME_BUCKETS
+    assert facets['time'][-1]['count'] >= facets['time'][0]['count']
+
+
+def test_api_facets_invalid(app, db):
+    """
+    GIVEN a flask app
+    WHEN facets are asked for with a malformed allergy list
+    THEN the response is 400 Bad Request
+    """
+    client = app.test_client()
+    response = client.get('/api/facets', query_string={'allergy_list': 'dairy'})
+    assert response.status_code == 400
@@ -23,11 +23,12 @@ import config
 from test.conftest import search_function, add_to_favourites, view_recipe, view_favourites, view_about, \
     login_test_user, del_from_mealplan, view_grocery_list, view_mealplan, get_recipe_ids, view_advanced_search, \
     advanced_search_function, create_mealplan, view_all_recipes, add_to_mealplan, delete_mealplan, edit_preferences, \
-    remove_from_favourites, send_grocery_list
+    remove_from_favourites, send_grocery_list, search_tokens
 
 from flask import url_for
 import pytest
 import random
+import re
 from sqlalchemy.sql import func
 
 
@@ -104,6 +105,79 @@ class TestSimpleViews:
         assert b'Diet type' in response.data
         assert b'Allergies' in response.data
 
+    def test_html_page_not_compressed(self, test_client):
+        """
+        GIVEN a Flask application
+        WHEN a browser which accepts gzip requests the advanced search page (which holds a CSRF token)
+        THEN the HTML is not compressed, so the token cannot be recovered from compressed sizes (BREACH)
+        """
+        response = test_client.get('/advanced_search', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        assert response.status_code == 200
+        assert 'Content-Encoding' not in response.headers
+        assert b'</html>' in response.data
+
+    def test_static_files_served_precompressed(self, app, test_client, tmp_path):
+        """
+        GIVEN a Flask application, with static files precompressed by `flask static compress`
+        WHEN a browser requests a static CSS file, accepting brotli and gzip, only gzip, or neither
+        THEN the matching precompressed copy is served (or the original file, if no encoding is accepted)
+        """
+        import brotli
+        import gzip
+        import shutil
+        from app.compression import compress_static_files
+
+        static_folder = app.static_folder
+        shutil.copytree(static_folder, str(tmp_path / 'static'))
+        app.static_folder = str(tmp_path / 'static')
+        try:
+            assert compress_static_files(app.static_folder, config.Config.COMPRESS_STATIC_EXTENSIONS) > 0
+            with open(str(tmp_path / 'static' / 'css' / 'bootstrap.css'), 'rb') as f:
+                original = f.read()
+
+            for accept_encoding, encoding, decompress in [('gzip, deflate, br', 'br', brotli.decompress),
+                                                          ('gzip', 'gzip', gzip.decompress),
+                                                          ('identity', None, bytes)]:
+                response = test_client.get('/static/css/bootstrap.css', headers={'Accept-Encoding': accept_encoding})
+                assert response.status_code == 200
+                assert response.mimetype == 'text/css'
+                assert response.headers.get('Content-Encoding') == encoding
+                assert decompress(response.get_data()) == original
+                response.close()
+        finally:
+            app.static_folder = static_folder
+
+    def test_stale_precompressed_static_file_ignored(self, app, test_client, tmp_path):
+        """
+        GIVEN a Flask application, with a static file changed after it was precompressed by `flask static compress`
+        WHEN a browser which accepts brotli and gzip requests the file
+        THEN the changed file is served, rather than the stale precompressed copy
+        """
+        import os
+        import shutil
+        from app.compression import compress_static_files
+
+        static_folder = app.static_folder
+        shutil.copytree(static_folder, str(tmp_path / 'static'))
+        app.static_folder = str(tmp_path / 'static')
+        try:
+            compress_static_files(app.static_folder, config.Config.COMPRESS_STATIC_EXTENSIONS)
+            path = str(tmp_path / 'static' / 'css' / 'bootstrap.css')
+            with open(path, 'ab') as f:
+                f.write(b'\n/* changed */\n')
+            modified = os.path.getmtime(path + '.br') + 10
+            os.utime(path, (modified, modified))
+            with open(path, 'rb') as f:
+                changed = f.read()
+
+            response = test_client.get('/static/css/bootstrap.css', headers={'Accept-Encoding': 'gzip, deflate, br'})
+            assert response.status_code == 200
+            assert 'Content-Encoding' not in response.headers
+            assert response.get_data() == changed
+            response.close()
+        finally:
+            app.static_folder = static_folder
+
 
 class TestViewRecipes:
 
@@ -134,6 +208,50 @@ class TestViewRecipes:
         for allergy in allergy_list:
             assert allergy.encode() in response.data
 
+    def test_view_recipe_shows_similar_recipes(self, test_client, db):
+        """
+        GIVEN a Flask application, with the similar recipes of each recipe stored when the catalog was built
+        WHEN user requests page to view a recipe
+        THEN the page links to its most similar recipes (other recipes, sharing words of their ingredients with it)
+        """
+        from app.models import RecipeIngredients
+        from app.pantry import ingredient_words
+
+        def words(recipe_id):
+            return {word for ingredient, in db.session.query(RecipeIngredients.ingredient)
+                    .filter(RecipeIngredients.recipe_id == recipe_id) for word in ingredient_words(ingredient)}
+
+        response = view_recipe(test_client, 5)
+        assert b'More like this' in response.data
+        similar_recipe_ids = [int(recipe_id) for recipe_id
+                              in re.findall(rb'class="similar_recipe"\s+href="/recipe/(\d+)"', response.data)]
+        assert len(similar_recipe_ids) == config.SIMILAR_RECIPES
+        assert 5 not in similar_recipe_ids
+        for recipe_id in similar_recipe_ids:
+            assert words(recipe_id) & words(5)
+
+    def test_tfidf_nearest_neighbours(self):
+        """
+        GIVEN the TF-IDF matrix of the ingredients of a few recipes
+        WHEN the nearest neighbours of each recipe are worked out
+        THEN the recipes sharing the most (and the rarest) ingredients are the most similar, and recipes sharing no
+            ingredients are not neighbours
+        """
+        from app.similar import TfidfMatrix
+        matrix = TfidfMatrix([(1, '2 chicken breasts'), (1, '200g basmati rice'), (1, '1 tsp turmeric'),
+                              (2, '4 chicken thighs'), (2, 'basmati rice'), (2, 'turmeric'), (2, '1 onion'),
+                              (3, '1 onion'), (3, '200g rice'),
+                              (4, '100g dark chocolate'), (4, '2 eggs')])
+        neighbours = matrix.nearest_neighbours(2, chunk_size=3)
+        similar = {}
+        for recipe_id, rank, similar_recipe_id, similarity in neighbours:
+            similar.setdefault(recipe_id, []).append((rank, similar_recipe_id))
+            assert 0 < similarity <= 1
+        assert similar[1] == [(1, 2), (2, 3)]
+        assert similar[2] == [(1, 1), (2, 3)]
+        assert similar[3] == [(1, 2), (2, 1)]
+        assert 4 not in similar
+
 
 class TestFavourites:
 
@@ -251,6 +369,41 @@ class TestFavourites:
                 assert part.encode() in response.data
 
 
+    def test_favourites_paginated_without_count(self, test_client, logged_in_user, user, db):
+        """
+        GIVEN a Flask application and a logged in user with more favourites than fit on a page
+        WHEN user pages through their Favourites page
+        THEN every favourite is shown once, there is a next page link only before the last page, and the favourites are
+            never counted with COUNT(*)
+        """
+        from sqlalchemy import event
+        from app.models import UserFavouriteRecipes
+
+        favourites = random.sample(range(1, 1000), config.RECIPES_PER_PAGE + 3)
+        for recipe_id in favourites:
+            db.session.add(UserFavouriteRecipes(user_id=user.id, recipe_id=recipe_id))
+        db.session.commit()
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            first_page = test_client.get('/favourites')
+            second_page = test_client.get('/favourites', query_string={'page': 2})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+        assert b'page=2' in first_page.data
+        assert b'page=3' not in second_page.data
+        first_ids = get_recipe_ids(test_client, first_page)
+        second_ids = get_recipe_ids(test_client, second_page)
+        assert len(first_ids) == config.RECIPES_PER_PAGE
+        assert sorted(first_ids + second_ids) == sorted(favourites)
+        assert not [statement for statement in statements if 'count(' in statement.lower()]
+
 class TestMealplans:
 
     def test_view_mealplanner_without_login(self, test_client):
@@ -591,9 +744,16 @@ class TestSearchResults:
         from app.models import Recipes
         recipes = db.session.query(Recipes).filter(Recipes.recipe_id.in_(response_recipe_ids)).all()
 
+        *words, last_word = search_tokens(db, search_term)
         for recipe in recipes:
             assert recipe.diet_type[0].diet_type_id >= diet
-            assert search_term in recipe.recipe_name.lower()
+            # Every (stemmed) word of the search term is a word of the recipe's name, ingredients or instructions, as
+            # indexed for full-text search. The last word is matched as a prefix, as it may be partly typed.
+            recipe_tokens = set(search_tokens(db, '\n'.join(
+                [recipe.recipe_name] + [ingredient.ingredient for ingredient in recipe.ingredients] +
+                [step.step_description for step in recipe.instructions])))
+            assert set(words) <= recipe_tokens
+            assert any(token.startswith(last_word) for token in recipe_tokens)
             assert min_cal <= int(recipe.nutrition_values.calories) <= max_cal
             assert recipe.total_time <= time
 
@@ -733,7 +893,411 @@ class TestSearchResults:
         assert b'Allergies: ' in response.data
         for allergy_name in allergy_names:
             assert allergy_name.encode() in response.data
-        assert b'Sorry, no recipes found' in response.data
+
+        # Recipes found by their ingredients (e.g. 'coconut milk') may be shown, but never ones with the allergy
+        from app.models import RecipeAllergies
+        response_recipe_ids = get_recipe_ids(test_client, response)
+        assert db.session.query(RecipeAllergies) \
+                   .filter(RecipeAllergies.recipe_id.in_(response_recipe_ids)) \
+                   .filter(RecipeAllergies.allergy_id.in_(allergy)) \
+                   .first() is None
+
+    def test_search_ranks_recipe_name_matches_first(self, test_client, db):
+        """
+        GIVEN a flask application
+        WHEN a simple search is made for a term found in some recipe names, and other recipes' ingredients
+        THEN the recipes named after the term are listed first
+        """
+        from app.models import Recipes
+        response = search_function(test_client, 'fried rice')
+        response_recipe_ids = get_recipe_ids(test_client, response)
+        assert response_recipe_ids
+
+        first_recipe = db.session.query(Recipes).get(response_recipe_ids[0])
+        assert 'fried rice' in first_recipe.recipe_name.lower()
+
+    @pytest.mark.parametrize("search_term, expected_text", [('lasag', 'lasagn'),  # Prefix of the last word
+                                                            ('Tahini', 'tahini'),  # Found in ingredients
+                                                            ('"quinoa"!', 'quinoa')])  # Punctuation ignored
+    def test_search_finds_recipes_by_prefix_and_ingredients(self, test_client, db, search_term, expected_text):
+        """
+        GIVEN a flask application
+        WHEN a simple search is made for a partly typed word, or an ingredient
+        THEN every recipe whose name or ingredients contain it is found
+        """
+        from app.main.main_functions import search_function as search_recipes
+        from app.models import Recipes, RecipeIngredients
+
+        with_text = db.session.query(Recipes.recipe_id) \
+            .outerjoin(RecipeIngredients, Recipes.recipe_id == RecipeIngredients.recipe_id) \
+            .filter(func.lower(Recipes.recipe_name).contains(expected_text) |
+                    func.lower(RecipeIngredients.ingredient).contains(expected_text))
+        expected = {recipe_id for recipe_id, in with_text}
+        assert expected
+
+        found = {recipe.recipe_id for recipe in search_recipes(search_term=search_term)}
+        assert expected <= found
+
+    def test_search_index_rebuilt_with_catalog(self, app, db):
+        """
+        GIVEN a flask application
+        WHEN a recipe is added to the recipe tables and the catalog is rebuilt
+        THEN the new recipe can be found by searching for its name or ingredients, and by its diet type and allergies
+        """
+        from app.catalog import rebuild_catalog
+        from app.main.main_functions import search_function as search_recipes
+        from app.models import Recipes, RecipeDietTypes, RecipeIngredients, NutritionValues
+
+        recipe_id = db.session.query(func.max(Recipes.recipe_id)).scalar() + 1
+        db.session.add(Recipes(recipe_id=recipe_id, recipe_name='Zanzibar pilau', serves=2, cook_time=20,
+                               prep_time=10, total_time=30))
+        db.session.add(RecipeDietTypes(recipe_id=recipe_id, diet_type_id=4))
+        db.session.add(RecipeIngredients(recipe_id=recipe_id, ingredient='1 tbsp ras el hanout'))
+        db.session.add(NutritionValues(recipe_id=recipe_id, calories=400))
+        db.session.commit()
+        assert search_recipes(search_term='zanzibar').count() == 0
+
+        rebuild_catalog()
+        for search_term in ['zanzibar', 'Zanz', 'hanout pilau']:
+            assert [recipe.recipe_id for recipe in search_recipes(search_term=search_term)] == [recipe_id]
+        assert recipe_id in [recipe.recipe_id for recipe in search_recipes(diet_type=4, allergy_list=[1, 8])]
+
+
+    @pytest.mark.parametrize("diet_type, allergy_list", [(1, []), (2, [3]), (3, [1, 4, 10]), (4, [2, 7, 8, 9]),
+                                                         (0, [99]), (5, [])])
+    def test_filter_index_matches_recipe_tables(self, db, diet_type, allergy_list):
+        """
+        GIVEN the in-memory filter index
+        WHEN the recipes suiting a diet type and allergies are looked up in it
+        THEN they are the same recipes as a query of the recipe diet type and allergy tables finds
+        """
+        from app.filter_index import FilterIndex
+        from app.models import RecipeAllergies, RecipeDietTypes
+
+        blacklist = db.session.query(RecipeAllergies.recipe_id).filter(RecipeAllergies.allergy_id.in_(allergy_list))
+        expected = [recipe_id for recipe_id, in db.session.query(RecipeDietTypes.recipe_id)
+                    .filter(RecipeDietTypes.diet_type_id >= diet_type)
+                    .filter(~RecipeDietTypes.recipe_id.in_(blacklist))
+                    .order_by(RecipeDietTypes.recipe_id)]
+
+        index = FilterIndex.build()
+        assert index.recipe_ids(index.eligible(diet_type, allergy_list)).tolist() == expected
+
+    @pytest.mark.parametrize("min_cal, max_cal, time", [(0, 1000, 99999), (100, 500, 40), (250, 250, 1000),
+                                                        (0, 200, 15), (800, 100, 60), (0, 1000, 0)])
+    def test_filter_index_ranges_match_recipe_tables(self, db, min_cal, max_cal, time):
+        """
+        GIVEN the in-memory filter index
+        WHEN the recipes in a calorie range and under a time are looked up in it (including ranges whose bounds are
+            exactly the calories of some recipes, and empty ranges)
+        THEN they are the same recipes as a query of the nutrition values and recipe tables finds
+        """
+        from app.filter_index import FilterIndex
+        from app.models import Recipes, NutritionValues
+
+        expected = [recipe_id for recipe_id, in db.session.query(Recipes.recipe_id)
+                    .join(NutritionValues, Recipes.recipe_id == NutritionValues.recipe_id)
+                    .filter(NutritionValues.calories >= min_cal, NutritionValues.calories <= max_cal)
+                    .filter(Recipes.total_time <= time)
+                    .order_by(Recipes.recipe_id)]
+
+        index = FilterIndex.build()
+        assert index.recipe_ids(index.matching(1, [], min_cal, max_cal, time)).tolist() == expected
+
+    @pytest.mark.parametrize("nutrient_ranges", [{'proteins': (30, None)}, {'salts': (None, 1), 'fibres': (5, 10)},
+                                                 {'sugars_per_kcal': (None, 0.01)}, {'fats': (100, 50)}])
+    def test_filter_index_nutrient_ranges_match_recipe_nutrition(self, db, nutrient_ranges):
+        """
+        GIVEN the in-memory filter index
+        WHEN the recipes in ranges of nutrients, or of nutrient to calorie ratios, are looked up in it
+        THEN they are the same recipes as a query of the RecipeNutrition table finds
+        """
+        from app.filter_index import FilterIndex
+        from app.models import RecipeNutrition
+
+        query = db.session.query(RecipeNutrition.recipe_id) \
+            .filter(RecipeNutrition.calories >= 0, RecipeNutrition.calories <= 1000)
+        for nutrient, (low, high) in nutrient_ranges.items():
+            if low is not None:
+                query = query.filter(getattr(RecipeNutrition, nutrient) >= low)
+            if high is not None:
+                query = query.filter(getattr(RecipeNutrition, nutrient) <= high)
+        expected = [recipe_id for recipe_id, in query.order_by(RecipeNutrition.recipe_id)]
+
+        index = FilterIndex.build()
+        assert index.recipe_ids(index.matching(1, [], 0, 1000, 99999, nutrient_ranges)).tolist() == expected
+
+    @pytest.mark.parametrize("query_string", [{'sort': 'bogus'}, {'sort': '-password'}, {'allergy_list': 'dairy'}])
+    def test_recipes_invalid_search_parameters(self, test_client, query_string):
+        """
+        GIVEN a flask application
+        WHEN the recipes page is requested with an unknown sort order or a malformed allergy list
+        THEN the response is 400 Bad Request, rather than a server error
+        """
+        response = test_client.get('/recipes', query_string=query_string)
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize("allergy_list", [[1], [2, 3], [1, 4, 10], [5, 99]])
+    def test_recipe_summary_allergen_mask_matches_recipe_allergies(self, db, allergy_list):
+        """
+        GIVEN the RecipeSummary table built with the catalog
+        WHEN the recipes without a user's allergies are found with (allergen_mask & :user_mask) = 0
+        THEN they are the recipes with none of the allergies in RecipeAllergies, and the filter index finds the same
+            recipes
+        """
+        from app.filter_index import FilterIndex, allergen_mask
+        from app.models import Recipes, RecipeAllergies, RecipeSummary
+        from sqlalchemy import bindparam
+
+        blacklist = db.session.query(RecipeAllergies.recipe_id).filter(RecipeAllergies.allergy_id.in_(allergy_list))
+        expected = [recipe_id for recipe_id, in db.session.query(Recipes.recipe_id)
+                    .filter(~Recipes.recipe_id.in_(blacklist))
+                    .order_by(Recipes.recipe_id)]
+
+        found = [recipe_id for recipe_id, in db.session.query(RecipeSummary.recipe_id)
+                 .filter(RecipeSummary.allergen_mask.op('&')(bindparam('user_mask')) == 0)
+                 .params(user_mask=allergen_mask(allergy_list))
+                 .order_by(RecipeSummary.recipe_id)]
+        assert found == expected
+
+        index = FilterIndex.build()
+        assert index.recipe_ids(index.recipes & index.eligible(0, allergy_list)).tolist() == expected
+
+    @pytest.mark.parametrize("diet_type, allergy_list, min_cal, max_cal, time, nutrient_ranges",
+                             [(1, [], 0, 1000, 99999, None), (3, [1], 100, 600, 60, None),
+                              (2, [2, 3], 0, 800, 45, {'proteins': (20, None)})])
+    def test_filter_index_facets_match_matching(self, db, diet_type, allergy_list, min_cal, max_cal, time,
+                                                nutrient_ranges):
+        """
+        GIVEN the in-memory filter index
+        WHEN the facets of a search are counted
+        THEN the total, and the count for each diet type, each further allergy, each calorie range and each maximum
+            time, are the number of recipes the filter index finds with that filter changed
+        """
+        from app.filter_index import FilterIndex
+
+        index = FilterIndex.build()
+
+        def count(**changes):
+            filters = dict(diet_type=diet_type, allergy_list=allergy_list, min_cal=min_cal, max_cal=max_cal, time=time,
+                           nutrient_ranges=nutrient_ranges)
+            filters.update(changes)
+            return len(index.recipe_ids(index.matching(**filters)))
+
+        facets = index.facets(diet_type, allergy_list, min_cal, max_cal, time, nutrient_ranges)
+        assert facets['total'] == count()
+        for diet_type_id, diet_name in config.DIET_CHOICES:
+            assert facets['diet_types'][diet_type_id] == count(diet_type=diet_type_id)
+        for allergy_id, allergy_name in config.ALLERGY_CHOICES:
+            assert facets['allergies'][allergy_id] == count(allergy_list=list(set(allergy_list) | {allergy_id}))
+        for max_time, time_count in zip(config.FACET_TIME_BUCKETS, facets['time']):
+            assert time_count == count(time=max_time)
+        edges = config.FACET_CALORIE_BUCKETS
+        for low, high, calorie_count in zip(edges, edges[1:], facets['calories']):
+            assert calorie_count == count(min_cal=low, max_cal=high)
+
+    def test_filter_index_calorie_facets_include_edges(self):
+        """
+        GIVEN a filter index of recipes with calories on the edges of the facet calorie ranges
+        WHEN the facets are counted
+        THEN a recipe on an edge is counted in both ranges whose calorie filter finds it, and a recipe without calories
+            in none
+        """
+        from app.filter_index import FilterIndex
+
+        edges = config.FACET_CALORIE_BUCKETS
+        index = FilterIndex([(0, 1, 0, edges[0], 10), (1, 1, 0, edges[1], 10), (2, 1, 0, edges[-1], 10),
+                             (3, 1, 0, None, 10)])
+        expected = [len(index.recipe_ids(index.matching(min_cal=low, max_cal=high)))
+                    for low, high in zip(edges, edges[1:])]
+        assert expected[:2] == [2, 1]
+        assert index.facets()['calories'] == expected
+
+    def test_advanced_search_nutrient_ranges_and_sort(self, test_client, db):
+        """
+        GIVEN a flask application
+        WHEN user makes an advanced search for recipes with at least 20g protein and at most 2g salt, sorted by most
+            protein per calorie
+        THEN every recipe shown is in those ranges, in descending order of protein per calorie
+        """
+        from app.models import NutritionValues
+
+        response = advanced_search_function(test_client, min_proteins=20, max_salts=2, sort='-proteins_per_kcal')
+        assert response.status_code == 200
+        response_recipe_ids = get_recipe_ids(test_client, response)
+        assert response_recipe_ids
+
+        nutrition = {row.recipe_id: row for row in db.session.query(NutritionValues)
+                     .filter(NutritionValues.recipe_id.in_(response_recipe_ids))}
+        for recipe_id in response_recipe_ids:
+            assert nutrition[recipe_id].proteins >= 20
+            assert nutrition[recipe_id].salts <= 2
+        ratios = [nutrition[recipe_id].proteins / nutrition[recipe_id].calories for recipe_id in response_recipe_ids]
+        assert ratios == sorted(ratios, reverse=True)
+
+    def test_search_results_cached_and_paged(self, test_client, db):
+        """
+        GIVEN a flask application
+        WHEN the pages of a search are viewed, and the same search is made again with different capitals and spacing
+        THEN the pages hold the recipes found by search_function, in order, and the search only runs once
+        """
+        from app.main.main_functions import search_function as search_recipes, search_cache_stats
+
+        expected = [recipe.recipe_id for recipe in search_recipes(search_term='rice', diet_type=3)]
+        assert len(expected) > config.RECIPES_PER_PAGE
+
+        before = search_cache_stats()
+        response_recipe_ids = []
+        for page in range(1, len(expected) // config.RECIPES_PER_PAGE + 2):
+            response = test_client.get('/recipes', query_string={'search_term': 'rice', 'diet_type': 3,
+                                                                 'page': page})
+            assert response.status_code == 200
+            response_recipe_ids += get_recipe_ids(test_client, response)
+        assert response_recipe_ids == expected
+
+        response = test_client.get('/recipes', query_string={'search_term': '  Rice', 'diet_type': 3})
+        assert get_recipe_ids(test_client, response) == expected[:config.RECIPES_PER_PAGE]
+
+        after = search_cache_stats()
+        assert after['misses'] - before['misses'] <= 1
+        assert after['hits'] - before['hits'] >= len(expected) // config.RECIPES_PER_PAGE + 1
+
+    @pytest.mark.parametrize("first_search, second_search",
+                             [({'search_term': 'rice', 'diet_type': 3}, {'search_term': 'chiken', 'allergy_list': [1]}),
+                              ({'sort': '-proteins_per_kcal', 'min_proteins': 20}, {'sort': '-proteins_per_kcal',
+                                                                                    'max_cal': 500}),
+                              ({}, {'time': 99999})])
+    def test_search_queries_baked_per_shape(self, db, first_search, second_search):
+        """
+        GIVEN a flask application
+        WHEN two searches of the same shape (filters, sort order and whether there is a search term) are made
+        THEN the second search reuses the first search's compiled query, and both find the same recipes, in the same
+            order, as the query built afresh
+        """
+        from app.main.main_functions import search_query, _search_bakery
+        from app.models import Recipes
+
+        def search_ids(**args_dict):
+            return [recipe_id for recipe_id, in search_query(Recipes.recipe_id, **args_dict)]
+
+        found = search_ids(**first_search)
+        baked_queries = len(_search_bakery.cache)
+        found_again = search_ids(**second_search)
+        assert len(_search_bakery.cache) == baked_queries
+
+        db.session().enable_baked_queries = False
+        try:
+            assert found == search_ids(**first_search)
+            assert found_again == search_ids(**second_search)
+        finally:
+            db.session().enable_baked_queries = True
+
+    def test_search_results_cache_invalidated_by_catalog_rebuild(self, test_client, db):
+        """
+        GIVEN a flask application, with a search's results cached
+        WHEN a recipe is added and the catalog is rebuilt
+        THEN the same search finds the new recipe
+        """
+        from app.catalog import rebuild_catalog
+        from app.models import Recipes, RecipeDietTypes, NutritionValues
+
+        response = test_client.get('/recipes', query_string={'search_term': 'pilau'})
+        recipe_count = len(get_recipe_ids(test_client, response))
+        assert recipe_count < config.RECIPES_PER_PAGE
+
+        recipe_id = db.session.query(func.max(Recipes.recipe_id)).scalar() + 1
+        db.session.add(Recipes(recipe_id=recipe_id, recipe_name='Zanzibar pilau', photo='zanzibar-pilau.jpg', serves=2,
+                               cook_time=20, prep_time=10, total_time=30))
+        db.session.add(RecipeDietTypes(recipe_id=recipe_id, diet_type_id=4))
+        db.session.add(NutritionValues(recipe_id=recipe_id, calories=400))
+        db.session.commit()
+        rebuild_catalog()
+
+        response = test_client.get('/recipes', query_string={'search_term': 'pilau'})
+        assert recipe_id in get_recipe_ids(test_client, response)
+
+    @pytest.mark.parametrize("search_term, expected_text", [('lasagna', 'lasagne'),  # Misspelt
+                                                            ('chick pea', 'chickpea'),  # Split in two
+                                                            ('chiken curry', 'chicken')])  # Misspelt with another word
+    def test_search_falls_back_to_fuzzy_matching(self, test_client, db, search_term, expected_text):
+        """
+        GIVEN a flask application
+        WHEN a simple search is made for a term with a typo, which finds no recipes as it is
+        THEN recipes with the word the term was meant as are found
+        """
+        from app.models import Recipes
+        response = search_function(test_client, search_term)
+        assert b'Sorry, no recipes found' not in response.data
+
+        response_recipe_ids = get_recipe_ids(test_client, response)
+        recipe_names = [recipe_name.lower() for recipe_name, in db.session.query(Recipes.recipe_name)
+                        .filter(Recipes.recipe_id.in_(response_recipe_ids))]
+        assert [recipe_name for recipe_name in recipe_names if expected_text in recipe_name]
+
+    def test_fuzzy_index_alternatives(self):
+        """
+        GIVEN a fuzzy search index of a few recipe names and ingredients
+        WHEN the alternatives of the words of search terms are worked out
+        THEN misspelt words have similar words of the vocabulary as alternatives, words which are split or joined have
+            the joined or split words, and words of the vocabulary have no alternatives
+        """
+        from app.fuzzy import FuzzyIndex
+        index = FuzzyIndex(['Veggie lasagne', '400g can chickpeas, drained', '2 tsp curry powder', 'Chick peas',
+                            'Chicken stock'])
+        assert index.similar_words('lasagna') == ['lasagne']
+        assert index.alternatives(['lasagna', 'curry']) == [[('lasagna',), ('lasagne',)], [('curry',)]]
+        assert index.alternatives(['chick', 'peas']) == [[('chick', 'peas'), ('chickpeas',)]]
+        assert ('chicken', 'stock') in index.alternatives(['chickenstock'])[0]
+        assert index.alternatives(['powder']) == [[('powder',)]]
+
+
+class TestPantry:
+
+    def test_pantry_page_ranks_recipes_by_missing_ingredients(self, test_client, db):
+        """
+        GIVEN a flask application
+        WHEN a user enters the ingredients in their pantry
+        THEN recipes using them are shown, with those needing the fewest more ingredients first, and with the
+            ingredients they would need to buy
+        """
+        from app.pantry import ingredient_words
+        from app.models import RecipeIngredients
+
+        response = test_client.get('/pantry', query_string={'ingredients': 'chicken, rice, onions'})
+        assert response.status_code == 200
+        response_recipe_ids = get_recipe_ids(test_client, response)
+        assert response_recipe_ids
+
+        for recipe_id in response_recipe_ids:
+            words = {word for ingredient, in db.session.query(RecipeIngredients.ingredient)
+                     .filter(RecipeIngredients.recipe_id == recipe_id) for word in ingredient_words(ingredient)}
+            assert words & {'chicken', 'rice', 'onion'}
+        missing_counts = [int(count) for count in re.findall(rb'You need (\d+) more', response.data)]
+        assert missing_counts == sorted(missing_counts)
+
+        response = test_client.get('/pantry')
+        assert response.status_code == 200
+        assert b'Sorry, no recipes found' not in response.data
+
+    def test_pantry_index_search(self):
+        """
+        GIVEN a pantry index of the ingredients of a few recipes
+        WHEN recipes are searched for with the ingredients in a pantry
+        THEN recipes using the pantry's ingredients are ranked by how many more they need (staples such as salt are in
+            every pantry), and recipes using only staples are not found
+        """
+        from app.pantry import PantryIndex, parse_pantry
+        index = PantryIndex([(1, '2 chicken breasts, sliced'), (1, '200g basmati rice'), (1, '1 tsp salt'),
+                             (2, '4 chicken thighs'), (2, '3 large carrots'), (2, '1 red onion'),
+                             (3, 'pinch of salt'), (3, '1 tsp sugar'),
+                             (4, '1 tbsp olive oil'), (4, '400g can chopped tomatoes'), (4, '1 onion')])
+
+        pantry = parse_pantry('Chicken,rice\n tomato')
+        assert pantry == [('chicken',), ('rice',), ('tomato',)]
+        assert index.search(pantry) == [(1, 3, 0), (4, 2, 1), (2, 1, 2)]
+        assert index.search(pantry, eligible_ids=[2, 3]) == [(2, 1, 2)]
+        assert index.search(parse_pantry('red onion')) == [(2, 1, 2)]
+        assert index.missing_ingredients(2, pantry) == ['3 large carrots', '1 red onion']
 
 
 class TestEmail: